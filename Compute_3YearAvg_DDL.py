@@ -12,6 +12,9 @@ in order to write the results to the database.
 Optionally, the downloaded JSON data from de DDL are stored for reference in a directory set in the INPUT PARAMETERS
 on top of this script (storeDDLFiles = True)
 
+The requests to the DDL are done by a pool of threads, the responses are parsed and the averages computed by a pool
+of processes (nrParseProcesses), and the results are written to MongoDB in batches; these stages run concurrently.
+
 The calculation method for determining the 3-yr average is obtained from the RIVM normendatase:
 https://acceptatie.rvs.rivm.nl/Data/SubtanceNormValues
 
@@ -20,15 +23,35 @@ https://acceptatie.rvs.rivm.nl/Data/SubtanceNormValues
 __author__ = 'beekhuiz'
 
 import os, sys
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+from functools import partial
 import pymongo
-import requests
+from pymongo import ReplaceOne
+from bson import BSON
 from datetime import datetime
-from dateutil import parser
-import ogr, osr
+import osr
 import json
 import logging
 from logging.handlers import RotatingFileHandler
-import numpy as np
+from ddlfetcher import DDLFetcher
+from normcatalogue import buildNormResolutionTable, resolveNorms
+from eistatistics import computeYearStatistics
+from ddlstream import spoolResponse, parseWaarnemingenFile, getPeakRSS
+from ingestpipeline import IngestPipeline
+from replaycache import ReplayCache, CachedFetcher, cachedRequest, CACHE_OFF
+from eisummaries import getSummaryCollections, createDataIndexes, createSummaryIndexes, getResultFilter, \
+    getSummaryUpdates, bumpDataVersion
+from bulkwriter import BulkWriter
+from metrics import MetricsRegistry, MetricsExporter
+from profiling import ProfileStore, isSampled, profileCall
+from eiyears import createYearIndexes, getYearCollections, getPeriodYears, getCompleteYears, readCoverage, getCoverageUpdate, \
+    getYearDocuments, getYearUpdates, readYearDocuments, combineYears
+from eiseries import getSeriesCollection, createSeriesIndexes, splitSeries, getSeriesUpdate
+from eimeasurements import getMeasurementsCollection, createMeasurementIndexes, deleteMeasurements, \
+    getMeasurementUpdates
 
 
 #------------------------------------------------------------------#
@@ -37,11 +60,16 @@ import numpy as np
 
 endtimeDT = datetime(2015,1,1,0,0,0)    # compute for 2012, 2013 and 2014
 starttimeDT = datetime(2012,1,1,0,0,0)  # endtimeDT - timedelta(days=365 * 3)
+# the statistics of each year are stored (MONGO_DB_COLLECTION + "_years"); for a next period only the years that have
+# not been retrieved before are requested from the DDL, so the period should start and end on 1 January
 
+MONGO_DB_URI = "mongodb://localhost:27017"
 MONGO_DB_CLIENT = "EI_Toets"
 MONGO_DB_COLLECTION = "EIData_Test"          # name of the collection in the MongoDB database to which data is written
 overwriteExistingCollection = False     # if true, the collection with name MONGO_DB_COLLECTION will be dropped;
                                         # if false, new records ('documents') are added to the current collection
+                                        # the locations and parameters summary collections (MONGO_DB_COLLECTION +
+                                        # "_locations" / "_parameters") are updated together with the collection
 
 outputEPSG = 4326  # WGS84
 
@@ -51,9 +79,54 @@ dataDir = os.path.join("d:/EIToetsOutput", "DDL_DataAllNorms12")    # only relev
 
 logFile = 'd:/EIToetsOutput/ComputeAvgLogAllNorms12.log'
 
-# set max limit nr of records to read from DDL
+# the responses of the RIVM normendatabase, the DDL metadata catalogue and the OnlineWaarnemingenService can be kept in
+# a compressed replay cache, e.g. to recompute the averages without downloading the data again:
+# 'off': always download; 'first': read from the cache, download and store what is missing;
+# 'only': read only from the cache, without requests (a missing waarnemingen response counts as a failed request)
+# with the replay cache, the waarnemingen responses are stored in the cache instead of in dataDir (storeDDLFiles)
+replayCacheMode = 'off'
+replayCacheDir = 'd:/EIToetsOutput/ReplayCache'
+
+# the status of each parameter / location combination is written to the checkpoint file of the period, so a next run
+# continues where the last run stopped; it is removed when overwriteExistingCollection = True
+checkpointFile = 'd:/EIToetsOutput/Checkpoint_' + MONGO_DB_COLLECTION + '_' + starttimeDT.strftime("%Y%m%d") + '_' + \
+                 endtimeDT.strftime("%Y%m%d") + '.txt'
+
+# set max limit nr of records (time series) to compute; at most this nr of combinations is requested from the DDL
 nrRecords = 20
 
+# concurrent requests to the DDL OnlineWaarnemingenService
+nrFetchWorkers = 8              # max nr of requests in flight
+maxRequestsPerSecond = 10       # max nr of requests per second, including retries; halved when the DDL returns 429
+maxRetries = 5                  # max nr of retries of a request after a connection error, 429 or 5xx
+
+# the results are written to MongoDB in unordered bulk writes; a batch is written when one of the limits is reached
+writeBatchSize = 500                    # max nr of write operations in a batch
+writeBatchBytes = 8 * 1024 * 1024       # max size of the documents in a batch
+writeFlushInterval = 10                 # max nr of seconds between batches
+
+# the responses are parsed and the averages computed by a pool of processes
+nrParseProcesses = None         # nr of processes; None is the nr of cores, 0 parses the responses in this process
+maxPendingResponses = None      # max nr of responses waiting to be parsed or written; None is 2 x nr of processes
+statsInterval = 60              # nr of seconds between the throughput and queue depth statistics in the log
+
+# the metrics of the ingest (stage timings, retries, queue depths) in the Prometheus text format, written to a file for
+# the textfile collector of the node_exporter and / or pushed to a Prometheus Pushgateway; None to not export them
+metricsTextFile = None          # e.g. '/var/lib/node_exporter/textfile_collector/ei_ingest.prom'
+metricsPushUrl = None           # e.g. 'http://localhost:9091'
+metricsExportInterval = 15      # nr of seconds between the exports
+
+# profiles (cProfile) of a sample of the parameter / location combinations, to see where the time goes: the parsing and
+# statistics in the parse process and the storing in the main process; a combination is in the sample in each run.
+# The profiles are kept in a ring of profileMaxFiles files (see profiling.py); 0 to not profile
+profileSampleRate = 0           # fraction of the combinations that is profiled, e.g. 0.01
+profileDir = 'd:/EIToetsOutput/Profiles'
+profileMaxFiles = 100
+
+# store each valid measurement (MONGO_DB_COLLECTION + "_measurements"), so the data aansluitpunt can compute the
+# averages of another period (/avg with start and end) without a new run
+storeMeasurements = True
+
 RIVMNormDBUrl = "https://rvs.rivm.nl/zoeksysteem/Data/SubtanceNormValues"
 RWS_Metadata_URL = "https://acceptatie.waterwebservices.rijkswaterstaat.nl/METADATASERVICES_DBO/OphalenCatalogus/"
 RWS_Waarnemingen_URL = "https://acceptatie.waterwebservices.rijkswaterstaat.nl/ONLINEWAARNEMINGENSERVICES_DBO/OphalenWaarnemingen/"
@@ -63,500 +136,829 @@ RWS_Waarnemingen_URL = "https://acceptatie.waterwebservices.rijkswaterstaat.nl/O
 #-------- FUNCTIONS ------------------------------------------------#
 #-------------------------------------------------------------------#
 
-def transformPoint(x, y, inputEPSG, outputEPSG):
+logger = logging.getLogger("data_aansluitpunt_log")    # the handler is added when the script starts
+
+coordTransformCache = {}   # (inputEPSG, outputEPSG) -> osr.CoordinateTransformation
+
+
+def getCoordinateTransformation(inputEPSG, outputEPSG):
     """
-    :param the x and y coordinates of a certain point in the inputEPSG (EPSG code) coordinate system
-    the coordinates are transformed to the output EPSG code
-    :return: a tuple with the x and y coordinates
+    :return: the osr.CoordinateTransformation from the inputEPSG to the outputEPSG coordinate system; the
+    transformation is created once for each combination of EPSG codes
     """
 
-    # create a geometry from coordinates
-    point = ogr.Geometry(ogr.wkbPoint)
-    point.AddPoint(x, y)
+    key = (inputEPSG, outputEPSG)
 
-    # create coordinate transformation
-    inSpatialRef = osr.SpatialReference()
-    inSpatialRef.ImportFromEPSG(inputEPSG)
+    if key not in coordTransformCache:
+        inSpatialRef = osr.SpatialReference()
+        inSpatialRef.ImportFromEPSG(inputEPSG)
 
-    outSpatialRef = osr.SpatialReference()
-    outSpatialRef.ImportFromEPSG(outputEPSG)
+        outSpatialRef = osr.SpatialReference()
+        outSpatialRef.ImportFromEPSG(outputEPSG)
 
-    coordTransform = osr.CoordinateTransformation(inSpatialRef, outSpatialRef)
+        # GDAL 3 uses the axis order of the EPSG definition (lat, lon for WGS84); keep x, y = lon, lat
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            inSpatialRef.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            outSpatialRef.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
 
-    point.Transform(coordTransform)    # transform point
+        coordTransformCache[key] = osr.CoordinateTransformation(inSpatialRef, outSpatialRef)
 
-    pointOutputEPSG = (point.GetX(), point.GetY())
+    return coordTransformCache[key]
 
-    return pointOutputEPSG
 
+def transformPoints(xs, ys, inputEPSG, outputEPSG):
+    """
+    :param xs, ys: lists with the x and y coordinates of points in the inputEPSG (EPSG code) coordinate system
+    the coordinates are transformed to the output EPSG code in one call
+    :return: a list with a tuple with the x and y coordinates of each point
+    """
 
-#------------------------------------------------------------------#
-#-------- START SCRIPT --------------------------------------------#
-#------------------------------------------------------------------#
+    if len(xs) == 0:
+        return []
 
-# connect to database
-client = pymongo.MongoClient(serverSelectionTimeoutMS=1)
-db = client[MONGO_DB_CLIENT]
-#db = client.EI_Toets
-if overwriteExistingCollection:     # if the collection is not dropped, new data is added to current collection
-    db.drop_collection(MONGO_DB_COLLECTION)
-collection = db[MONGO_DB_COLLECTION]
+    coordTransform = getCoordinateTransformation(inputEPSG, outputEPSG)
+    transformedPoints = coordTransform.TransformPoints([(float(x), float(y)) for x, y in zip(xs, ys)])
 
-# test if connection to MongoDB works
-try:
-    client.server_info()
-except pymongo.errors.ServerSelectionTimeoutError as err:
-    print(err)
-    print "Error in connecting or creating MongoDB collection; have you started MongoDB?"
-    sys.exit()
+    return [(point[0], point[1]) for point in transformedPoints]
 
 
+def transformLocations(jobs, inputEPSG, outputEPSG):
+    """
+    Transform the coordinates of all locations of the jobs in one batch; each location is transformed once, although
+    it occurs in the jobs of all its parameters
+    :return: dict Locatie_MessageID -> [x, y] in the output EPSG code
+    """
 
-#region set up logging
-logger = logging.getLogger("data_aansluitpunt_log")
-file_handler = RotatingFileHandler(logFile, 'a', 10 * 1024 * 1024, 10)
-file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-logger.setLevel(logging.INFO)
-file_handler.setLevel(logging.INFO)
-logger.addHandler(file_handler)
-logger.info('Start computing average measurement values for DDL')
-#endregion
+    locationsByMessageID = {}
+    for job in jobs:
+        locationsByMessageID[job.locMessageID] = job.location
 
-starttimeDDString = starttimeDT.strftime("%Y-%m-%dT%H:%M:%S")
-endtimeDDString = endtimeDT.strftime("%Y-%m-%dT%H:%M:%S")
+    locMessageIDs = list(locationsByMessageID.keys())
+    transformedPoints = transformPoints([locationsByMessageID[locMessageID]['X'] for locMessageID in locMessageIDs],
+                                        [locationsByMessageID[locMessageID]['Y'] for locMessageID in locMessageIDs],
+                                        inputEPSG, outputEPSG)
 
+    return dict((locMessageID, [point[0], point[1]]) for locMessageID, point in zip(locMessageIDs, transformedPoints))
 
 
-#read existing data in database and store parameter + loc codes as unique identifier
-mongocursor = collection.find()
-loadedTimeSeries = []
-for record in mongocursor:
-    parCode = record['properties']['aquoParCode']
-    locID = record['properties']['locID']
-    loadedTimeSeries.append(parCode + "_" + locID)
+# status of a parameter / location combination in the checkpoint file
+CHECKPOINT_PROCESSED = 'processed'  # one or more results are stored in the collection
+CHECKPOINT_SKIPPED = 'skipped'      # the data was retrieved, but there were no results to store
+CHECKPOINT_FAILED = 'failed'        # the data could not be retrieved from the DDL; retried in the next run
 
 
-# create data directory to store downloaded files from DDL
-if storeDDLFiles and os.path.exists(dataDir) == False:
-    os.makedirs(dataDir)
+def readCheckpoint(fileName):
+    """
+    :param fileName: the checkpoint file, with on each line the status and the parCode + "_" + locID of a combination
+    :return: dict with the last status of each parCode + "_" + locID
+    """
 
-inputEPSG = 25831   # the DDL uses EPSG 25831
+    checkpointStatus = {}
+    with open(fileName) as fi:
+        for line in fi:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 2:    # skip a partially written last line of a crashed run
+                checkpointStatus[fields[1]] = fields[0]
 
+    return checkpointStatus
 
-#region Read data from RIVM normendatabase to check if it's P90 or JGM
-RIVMString = requests.get(RIVMNormDBUrl)
-#RIVMString = requests.get('https://acceptatie.rvs.rivm.nl/Data/SubtanceNormValues', auth=HTTPBasicAuth('rvs', 'nitr@@t'))  # old db
-RIVMDict = json.loads(RIVMString.text)  # convert json string to python dict
-normsList = RIVMDict['norms']
-substancesList = RIVMDict['substances']
-logger.info('Normendatabase RIVM loaded')
-print "Normendatabase RIVM loaded"
-#endregion
 
-#region Get metadata from RWS metadata service
-payload = {"CatalogusFilter": {"Grootheden": True, "Parameters": True, "Eenheden": True}}
-headers = {'content-type': 'application/json'}
-r = requests.post(RWS_Metadata_URL, data=json.dumps(payload), headers=headers)
-resultJSON = r.json()
+def writeCheckpoint(checkpoint, status, uniqComb):
+    """
+    Append the status of a combination to the (opened) checkpoint file
+    """
 
+    checkpoint.write(status + "\t" + uniqComb + "\n")
+    checkpoint.flush()
 
-comb = resultJSON['AquoMetadataLocatieLijst']
-locations = resultJSON['LocatieLijst']
-aquometadatalijst = resultJSON['AquoMetadataLijst']
-logger.info('Metadata from DDL loaded')
-print "Metadata from DDL loaded"
-#endregion
 
+# a parameter / location combination for which the average has to be computed; locCoords (the coordinates of the
+# location in the output EPSG code) and fetchYears (the years of the period to request from the DDL) are set after
+# planning
+Job = namedtuple('Job', ['parCode', 'locID', 'location', 'aquometadata', 'locMessageID', 'locCoords', 'fetchYears'])
 
-#region TEMP COMPUTE NR TIMESERIES
 
-nrTotalRecords = 0
-nrConcRecords = 0
-nrRecordsToCompute = 0
-nrRecordsAlreadyDone = 0
+def planJobs(comb, locations, aquometadatalijst, loadedTimeSeries):
+    """
+    Create the work-list of parameter / location combinations to compute from the DDL metadata catalogue: only
+    combinations of the grootheid concentratie (CONCTTE) that have not been computed before, each combination once
+    :param comb: the AquoMetadataLocatieLijst of the catalogue
+    :param locations: the LocatieLijst of the catalogue
+    :param aquometadatalijst: the AquoMetadataLijst of the catalogue
+    :param loadedTimeSeries: the parCode + "_" + locID of the time series that have already been computed
+    :return: tuple with the list of Jobs and a dict with the number of records of each kind
+    """
 
-for record in comb:
+    # index the locations and the aquometadata on their message ID; the first one is used if an ID occurs twice
+    locationIndex = {}
+    for location in locations:
+        locationIndex.setdefault(location.get('Locatie_MessageID'), location)
 
-    messageID = record['AquoMetaData_MessageID']
-    locMessageID = record['Locatie_MessageID']
+    aquometadataIndex = {}
+    for aquometadata in aquometadatalijst:
+        aquometadataIndex.setdefault(aquometadata.get('AquoMetadata_MessageID'), aquometadata)
 
-    aquometadata = [aquometadata for aquometadata in aquometadatalijst if aquometadata.get('AquoMetadata_MessageID') == messageID]
-    location = [location for location in locations if location.get('Locatie_MessageID') == locMessageID]
+    jobs = []
+    plannedTimeSeries = set()
+    planStats = {'nrTotalRecords': 0, 'nrConcRecords': 0, 'nrRecordsAlreadyDone': 0, 'nrDuplicateRecords': 0}
 
-    # stored as list, create dict
-    location = location[0]
-    aquometadata = aquometadata[0]
+    for record in comb:
 
-    aquoCodeGrootheid = aquometadata['Grootheid']['Code']
-    parCode = aquometadata['Parameter']['Code']
-    #print parCode
+        planStats['nrTotalRecords'] += 1
 
-    locID = location['Code']
+        location = locationIndex[record['Locatie_MessageID']]
+        aquometadata = aquometadataIndex[record['AquoMetaData_MessageID']]
 
-    if aquoCodeGrootheid == 'CONCTTE':  # only compute avg for grootheid concentratie
-        nrConcRecords += 1
+        if aquometadata['Grootheid']['Code'] != 'CONCTTE':  # only compute avg for grootheid concentratie
+            continue
+        planStats['nrConcRecords'] += 1
 
-        #check if parameter / location combination has already been computed
-        uniqComb = parCode + "_" + locID
+        parCode = aquometadata['Parameter']['Code']
+        locID = location['Code']
+        uniqComb = parCode + "_" + locID    # used for checking if this time series has already been processed to the MongoDB
+
+        # the DDL returns all data of a parameter at a location in one request, so each combination is computed once
         if uniqComb in loadedTimeSeries:
-            nrRecordsAlreadyDone += 1
+            planStats['nrRecordsAlreadyDone'] += 1
+        elif uniqComb in plannedTimeSeries:
+            planStats['nrDuplicateRecords'] += 1
         else:
-            nrRecordsToCompute += 1
+            plannedTimeSeries.add(uniqComb)
+            jobs.append(Job(parCode, locID, location, aquometadata, record['Locatie_MessageID'], None, None))
+
+    return jobs, planStats
+
 
-    nrTotalRecords += 1
+def getFetchPeriod(job):
+    """
+    :return: tuple with the start and end datetime of the years to request for a job, within the period
+    """
 
-print "Total concentration records: " + str(nrConcRecords)
-print "Records already computed: " + str(nrRecordsAlreadyDone)
-print "Records still to compute: " + str(nrRecordsToCompute)
-#endregion
+    return max(starttimeDT, datetime(min(job.fetchYears), 1, 1)), min(endtimeDT, datetime(max(job.fetchYears) + 1, 1, 1))
 
 
-n = 0   # keep track of number computed records
+def getWaarnemingenRequest(job):
+    """
+    :return: the (JSON) request for the OnlineWaarnemingenService of a job
+    """
 
-for record in comb:
+    # convert datetime to format used by DDL
+    fetchStartDT, fetchEndDT = getFetchPeriod(job)
+    starttimeDDL = fetchStartDT.strftime("%Y-%m-%dT%H:%M:%S.000+01:00")
+    endtimeDDL = fetchEndDT.strftime("%Y-%m-%dT%H:%M:%S.000+01:00")
 
-    if n >= nrRecords:
-        break
+    aquoMetadataType = "Parameter"
 
-    #region Get location and parameter info from metadata file
-    messageID = record['AquoMetaData_MessageID']
-    locMessageID = record['Locatie_MessageID']
+    payload = {"AquoPlusWaarnemingMetadata":
+                   {"AquoMetadata": {aquoMetadataType: {"Code": job.parCode}}},
+               "Locatie": {"X": repr(job.location['X']), "Y": repr(job.location['Y']), "Code": job.locID},
+               "Periode": {"Begindatumtijd": starttimeDDL, "Einddatumtijd": endtimeDDL}}
 
-    location = [location for location in locations if location.get('Locatie_MessageID') == locMessageID]
-    aquometadata = [aquometadata for aquometadata in aquometadatalijst if aquometadata.get('AquoMetadata_MessageID') == messageID]
+    return json.dumps(payload)
 
-    # stored as list, create dict
-    location = location[0]
-    aquometadata = aquometadata[0]
 
-    # convert datetime to format used by DDL
-    starttimeDDL = starttimeDT.strftime("%Y-%m-%dT%H:%M:%S.000+01:00")
-    endtimeDDL = endtimeDT.strftime("%Y-%m-%dT%H:%M:%S.000+01:00")
+def generateJobs(jobs):
+    """
+    Yield the jobs of the work-list, together with the request for the OnlineWaarnemingenService
+    """
+
+    for job in jobs:
+        yield job, getWaarnemingenRequest(job)
+
+
+def getDDLFileName(job):
+    """
+    :return: name of the file in which the DDL response of the job is stored
+    """
+
+    return os.path.join(dataDir, 'record' + job.parCode + "_" + str(job.locMessageID) + '.json')
+
+
+def fetchResponse(spoolDir, replayCache, ingestMetrics, job, r):
+    """
+    Write the response of the OnlineWaarnemingenService to a file while it is downloaded; called in the fetch worker
+    threads. The file is in the replay cache if it is used, else the DDL file of the job if storeDDLFiles = True, else
+    a temporary file in spoolDir.
+    :param ingestMetrics: IngestMetrics, for the duration of the fetch: the time until the headers were received plus
+    the time of the download of the body
+    :return: tuple (status code, name of the file or None, number of bytes, True if the file is temporary)
+    """
+
+    if r.status_code != 200:
+        return r.status_code, None, 0, False
+
+    startTime = time.time()
+
+    if replayCache.mode != CACHE_OFF:
+        fileName, nrBytes = replayCache.put(RWS_Waarnemingen_URL, getWaarnemingenRequest(job), r.iter_content(64 * 1024))
+        ingestMetrics.observeStage('fetch', r.elapsed.total_seconds() + time.time() - startTime)
+        return r.status_code, fileName, nrBytes, False
+
+    if storeDDLFiles:
+        fileName = getDDLFileName(job)
+        if os.path.exists(fileName):
+            logger.error("File " + fileName + " already exists, overwrite this file")
+    else:
+        fd, fileName = tempfile.mkstemp(suffix='.json', dir=spoolDir)
+        os.close(fd)
+
+    nrBytes = spoolResponse(r, fileName)
+    ingestMetrics.observeStage('fetch', r.elapsed.total_seconds() + time.time() - startTime)
+
+    return r.status_code, fileName, nrBytes, not storeDDLFiles
+
+
+def readCachedResponse(job, fileName):
+    """
+    Use the response of a job from the replay cache
+    :return: tuple as returned by fetchResponse; the size of the response is not known (None)
+    """
+
+    return 200, fileName, None, False
+
+
+normResolutionTable = None  # (aquoCode, stateCode) -> calculation method and norms; set in each process of the pool
+
+
+def setNormResolutionTable(table):
+    """
+    Initialize a process of the pool with the norm resolution table
+    """
+
+    global normResolutionTable
+    normResolutionTable = table
+
+
+def processResponse(job, fetched):
+    """
+    Parse the response of a job and compute the statistics of the requested years of its time series; called in the
+    processes of the pool
+    :param fetched: the tuple returned by fetchResponse
+    :return: dict with the statusCode, the value of Succesvol (None if the response has no key Succesvol), the
+    yearDocuments (list of documents for the years collection), the seriesDocuments (the measurements of each year, for
+    the series collection), log messages, the size of the response, the peak RSS of the process and the timings of the
+    stages in seconds (for the ingest metrics, which are kept in the main process)
+    """
+
+    statusCode, fileName, nrBytes, isTemporary = fetched
+    timings = {'parse': 0.0, 'normResolve': 0.0, 'aggregate': 0.0}
+    processed = {'statusCode': statusCode, 'succesvol': None, 'yearDocuments': [], 'seriesDocuments': [],
+                 'messages': [], 'nrBytes': nrBytes, 'timings': timings}
+
+    if statusCode != 200:
+        return processed
+
+    startTime = time.time()
+    try:
+        processed['succesvol'], waarnemingen = parseWaarnemingenFile(fileName)
+    finally:
+        if isTemporary:
+            os.remove(fileName)
+    timings['parse'] = time.time() - startTime
+
+    if processed['succesvol'] != True:
+        return processed
+
+    fetchStartDT, fetchEndDT = getFetchPeriod(job)
+    fetchStartString = fetchStartDT.strftime("%Y-%m-%dT%H:%M:%S")
+    fetchEndString = fetchEndDT.strftime("%Y-%m-%dT%H:%M:%S")
+
+    # the metingen of each WaarnemingLijst were collected in columns while the response was parsed
+    for aquoMetadata, columns in waarnemingen:
+
+        EIData = {}
+
+        #region store all relevant EI metadata
+        EIData['bemonsteringsSoortOmschrijving'] = aquoMetadata['BemonsteringsSoort']['Omschrijving']
+        EIData['bemonsteringsSoortCode'] = aquoMetadata['BemonsteringsSoort']['Code']
+        EIData['compartimentOmschrijving'] = aquoMetadata['Compartiment']['Omschrijving']
+        EIData['compartimentCode'] = aquoMetadata['Compartiment']['Code']
+        EIData['hoedanigheidOmschrijving'] = aquoMetadata['Hoedanigheid']['Omschrijving']
+        EIData['hoedanigheidCode'] = aquoMetadata['Hoedanigheid']['Code']
+        EIData['eenheidOmschrijving'] = aquoMetadata['Eenheid']['Omschrijving']
+        EIData['eenheidCode'] = aquoMetadata['Eenheid']['Code']
+        #endregion
+
+        #region Get calculation method from RIVM normendatabase
+
+        # the norms with the same Norm StateCode as the metadata Hoedanigheidcode of the DDL-measurements are looked up
+        # in the norm resolution table, which is built once after loading the RIVM normendatabase
+        startTime = time.time()
+        EIData['valueProcessingMethodCode'], normsForSubstanceStateCodeList = \
+            resolveNorms(normResolutionTable, job.parCode, EIData['hoedanigheidCode'])
+        timings['normResolve'] += time.time() - startTime
+
+        #endregion
+
+        # only data of a 'Steekmonster' is stored
+        if EIData['bemonsteringsSoortOmschrijving'] != "Steekmonster":
+            processed['messages'].append("Data is not stored, bemonstering is: " + EIData['bemonsteringsSoortOmschrijving'])
+            continue
+
+        #region Calculate the statistics of each year
+
+        # only compute average if the valueprocessingmethod is JGM, MAX or P90
+        if EIData['valueProcessingMethodCode'] in ['JGM', 'MAX', 'P90']:
 
-    parCode = aquometadata['Parameter']['Code']
-    locID = location['Code']
-    aquoCodeGrootheid = aquometadata['Grootheid']['Code']   # RWS defines for each parameter a 'Grootheid'
-    uniqComb = parCode + "_" + locID    # used for checking if this time series has already been processed to the MongoDB
+            for referentievlak in set(columns.referentievlakken) - set(["WATSGL"]):
+                processed['messages'].append("Referentievlak: " + referentievlak)
 
-    fileName = os.path.join(dataDir, 'record' + parCode + "_" + str(locMessageID) + '.json')
+            startTime = time.time()
 
-    logger.info("Compute " + parCode + " and location " + locID)
-    print "Compute " + parCode + " and location " + locID
+            # compute the statistics of all years with array operations; only the requested years are stored
+            EIYearData = computeYearStatistics(columns, EIData['valueProcessingMethodCode'], fetchStartString, fetchEndString)
+            EIYearData = [EIYearDict for EIYearDict in EIYearData if EIYearDict['year'] in job.fetchYears]
+
+            # the measurements are stored in the series collection; the yearData refers to them with a seriesID
+            for EIYearDict in EIYearData:
+                processed['seriesDocuments'].append(splitSeries(job.parCode, job.locID, EIData, EIYearDict))
+
+            processed['yearDocuments'].extend(getYearDocuments(job.parCode, job.locID, EIData, EIYearData))
+            timings['aggregate'] += time.time() - startTime
+            processed['messages'].append("Succesfully calculated statistics of years: " +
+                                         ", ".join(str(EIYearDict['year']) for EIYearDict in EIYearData))
+
+        #endregion
+
+    processed['peakRSS'] = getPeakRSS()
+
+    return processed
+
+
+sampleProfileStore = None   # the ProfileStore of profileDir; created in each process when the first profile is stored
+
+
+def callProfiled(stage, job, function, *args):
+    """
+    Call a function for a job, with a profile if the parameter / location combination is in the sample
+    :param stage: name of the stage, in the description of the profile
+    :return: the result of the function
+    """
+
+    global sampleProfileStore
+
+    if not isSampled(job.parCode + "_" + job.locID, profileSampleRate):
+        return function(*args)
+
+    if sampleProfileStore is None:
+        sampleProfileStore = ProfileStore(profileDir, profileMaxFiles)
+    return profileCall(sampleProfileStore, {'stage': stage, 'parCode': job.parCode, 'locID': job.locID}, function,
+                       *args)
+
+
+def processSampledResponse(job, fetched):
+    """
+    processResponse, with a profile for the combinations in the sample; used instead of processResponse if
+    profileSampleRate > 0
+    """
+
+    return callProfiled('process', job, processResponse, job, fetched)
+
+
+def buildResult(job, series, EIYearData, avg, table):
+    """
+    Create the GeoJSON feature of a time series, as stored in the data collection
+    :param series: the metadata of the time series, as stored with its years (see eiyears.SERIES_FIELDS)
+    :param EIYearData: the statistics of the years of the period, sorted by year
+    :param avg: the average of the year values
+    :param table: the norm resolution table
+    """
+
+    EIData = dict(series)
+    EIData['fileName'] = getDDLFileName(job)
+    EIData['startTimeReq'] = starttimeDT.strftime("%Y-%m-%dT%H:%M:%S")
+    EIData['endTimeReq'] = endtimeDT.strftime("%Y-%m-%dT%H:%M:%S")
+    EIData['normsForSubstanceStateCodeList'] = resolveNorms(table, job.parCode, EIData['hoedanigheidCode'])[1]
+    EIData['avg'] = avg
+    EIData['yearData'] = EIYearData
+
+    result = {
+        'type': 'Feature',
+        'geometry': {
+                'type': 'Point',
+                'coordinates': job.locCoords
+            },
+        'properties': {
+            # default obligatory properties
+            'source': 'DDL',
+            'sourceDesc': 'Gegevens uit de data distributielaag van Rijkswaterstaat',
+            'aquoParOmschrijving': job.aquometadata['Parameter']['Omschrijving'],
+            'aquoParCode': job.parCode,
+            'parDescription': job.aquometadata['Parameter_Wat_Omschrijving'],
+            'locID': job.locID,
+            'locName': job.location['Naam'],
+
+            'EIData': EIData,
+
+            # Source specific properties
+            'sourceProp': {'X': repr(job.location['X']),
+                           'Y': repr(job.location['Y'])
+            }
+        }
+    } # end result
+
+    return result
+
+
+def storeCombination(db, writer, table, job, yearDocuments, seriesDocuments):
+    """
+    Store the newly computed years of a parameter / location combination, combine them with the stored years of the
+    period, and store the resulting time series with their multi-year average in the data collection
+    :param yearDocuments: the year documents of the years that have been retrieved for the job (job.fetchYears)
+    :param seriesDocuments: the measurements of these years
+    :return: the number of time series stored
+    """
+
+    for seriesDocument in seriesDocuments:
+        seriesCollection, update, size = getSeriesUpdate(db, MONGO_DB_COLLECTION, seriesDocument)
+        writer.add(seriesCollection, update, size)
+
+    if storeMeasurements:
+        # replace the measurements of the retrieved years, also of the series that no longer have valid measurements;
+        # the delete of all series of the combination precedes the inserts of all its series
+        deleteMeasurements(db, MONGO_DB_COLLECTION, job.parCode, job.locID, job.fetchYears)
+        for seriesDocument in seriesDocuments:
+            for measurementsCollection, update, size in getMeasurementUpdates(db, MONGO_DB_COLLECTION, seriesDocument):
+                writer.add(measurementsCollection, update, size)
+
+    for yearsCollection, update in getYearUpdates(db, MONGO_DB_COLLECTION, yearDocuments):
+        writer.add(yearsCollection, update)
+
+    # the years that have ended are not requested again for a next period
+    fetchedYears = getCompleteYears(job.fetchYears)
+    if fetchedYears:
+        coverageCollection, update = getCoverageUpdate(db, MONGO_DB_COLLECTION, job.parCode, job.locID, fetchedYears)
+        writer.add(coverageCollection, update)
+
+    storedYears = [year for year in getPeriodYears(starttimeDT, endtimeDT) if year not in job.fetchYears]
+    allYearDocuments = readYearDocuments(db, MONGO_DB_COLLECTION, job.parCode, job.locID, storedYears) + yearDocuments
+
+    nrStored = 0
+    for series, EIYearData, avg in combineYears(allYearDocuments):
+        result = buildResult(job, series, EIYearData, avg, table)
+        logger.info("Average value of " + job.parCode + " and location " + job.locID + ": " + str(avg))
+
+        # replace the time series if it was stored before, so a rerun does not create duplicates
+        writer.add(db[MONGO_DB_COLLECTION], ReplaceOne(getResultFilter(result), result, upsert=True), len(BSON.encode(result)))
+        for summaryCollection, update in getSummaryUpdates(db, MONGO_DB_COLLECTION, result):
+            writer.add(summaryCollection, update)   # add location and parameter to the summaries
+        nrStored += 1
+
+    return nrStored
+
+
+class IngestMetrics(object):
+    """
+    The metrics of the ingest in the Prometheus text format: the duration of the stages (fetch, parse, normResolve,
+    aggregate, transform, write), the requests and retries of the DDLFetcher, the queue depths of the pipeline and the
+    number of stored time series
+    """
+
+    def __init__(self):
+        self.registry = MetricsRegistry(logger)
+        self.stageDuration = self.registry.histogram('ei_ingest_stage_duration_seconds',
+                                                     'Duration of the stages of the ingest, per response or batch',
+                                                     ['stage'])
+        self.nrSeriesStored = self.registry.counter('ei_ingest_series_stored_total', 'Number of time series stored')
+        self.registry.gauge('ei_ingest_peak_rss_megabytes', 'Peak resident set size of the main process', (),
+                            getPeakRSS)
+
+    def observeStage(self, stage, seconds):
+        self.stageDuration.observe(seconds, stage=stage)
+
+    def observeTimings(self, timings):
+        """
+        Record the timings of the stages in a parse process, as returned by processResponse
+        """
+
+        for stage, seconds in timings.items():
+            self.observeStage(stage, seconds)
+
+    def observeBatch(self, nrOperations, seconds):
+        self.observeStage('write', seconds)
+
+    def watch(self, fetcher, pipeline, writer):
+        """
+        Add the metrics that are read from the statistics of the fetcher, the pipeline and the writer when the metrics
+        are exported
+        """
+
+        self.registry.gauge('ei_ingest_ddl_requests_total', 'Number of requests to the DDL, and of their retries and '
+                            'failures', ['result'],
+                            lambda: dict(((result,), fetcher.getStats()[key]) for result, key in
+                                         (('requests', 'nrRequests'), ('retries', 'nrRetries'),
+                                          ('failures', 'nrFailures'))), 'counter')
+        self.registry.gauge('ei_ingest_ddl_requests_per_second', 'Current maximum request rate to the DDL', (),
+                            lambda: fetcher.getStats()['requestsPerSecond'])
+        self.registry.gauge('ei_ingest_responses_total', 'Number of responses fetched, processed and written', ['stage'],
+                            lambda: dict(((stage,), pipeline.getStats()[key]) for stage, key in
+                                         (('fetched', 'nrFetched'), ('processed', 'nrProcessed'),
+                                          ('written', 'nrConsumed'))), 'counter')
+        self.registry.gauge('ei_ingest_queue_depth', 'Number of responses waiting for a stage, and of write operations '
+                            'in the MongoDB buffer', ['queue'],
+                            lambda: {('process',): pipeline.getStats()['processQueueDepth'],
+                                     ('write',): pipeline.getStats()['writeQueueDepth'],
+                                     ('mongodb',): writer.getStats()['nrBuffered']})
+
+
+def storeSampledCombination(db, writer, table, job, yearDocuments, seriesDocuments):
+    """
+    storeCombination, with a profile for the combinations in the sample; the write operations are buffered, so the
+    profile holds the reading of the stored years and the building of the results, not the bulk writes
+    """
+
+    return callProfiled('store', job, storeCombination, db, writer, table, job, yearDocuments, seriesDocuments)
+
+
+def logPipelineStats(pipeline, writer):
+    """
+    Log the throughput and queue depth of the stages of the pipeline
+    """
+
+    stats = pipeline.getStats()
+    writeStats = writer.getStats()
+
+    message = "Fetched: %d (%.2f/s), processed: %d (%.2f/s, mean %.2f s), written: %d (%.2f/s); " \
+              "queue depth process: %d, write: %d, MongoDB buffer: %d" % \
+              (stats['nrFetched'], stats['fetchedPerSecond'], stats['nrProcessed'], stats['processedPerSecond'],
+               stats['meanProcessTime'], stats['nrConsumed'], stats['consumedPerSecond'],
+               stats['processQueueDepth'], stats['writeQueueDepth'], writeStats['nrBuffered'])
+    logger.info(message)
+    print message
+
+
+#------------------------------------------------------------------#
+#-------- START SCRIPT --------------------------------------------#
+#------------------------------------------------------------------#
+
+def main():
+
+    # connect to database
+    client = pymongo.MongoClient(MONGO_DB_URI, serverSelectionTimeoutMS=1)
+    db = client[MONGO_DB_CLIENT]
+    #db = client.EI_Toets
+    if overwriteExistingCollection:     # if the collection is not dropped, new data is added to current collection
+        db.drop_collection(MONGO_DB_COLLECTION)
+        for summaryCollection in getSummaryCollections(db, MONGO_DB_COLLECTION) + getYearCollections(db, MONGO_DB_COLLECTION) + \
+                (getSeriesCollection(db, MONGO_DB_COLLECTION),
+                 getMeasurementsCollection(db, MONGO_DB_COLLECTION)):
+            db.drop_collection(summaryCollection.name)
+    collection = db[MONGO_DB_COLLECTION]
+
+    # test if connection to MongoDB works
+    try:
+        client.server_info()
+    except pymongo.errors.ServerSelectionTimeoutError as err:
+        print(err)
+        print "Error in connecting or creating MongoDB collection; have you started MongoDB?"
+        sys.exit()
+
+    # indexes for the queries of the data aansluitpunt, including the 2dsphere index on the geometry of the results
+    createDataIndexes(db, MONGO_DB_COLLECTION)
+    createSummaryIndexes(db, MONGO_DB_COLLECTION)
+    createYearIndexes(db, MONGO_DB_COLLECTION)
+    createSeriesIndexes(db, MONGO_DB_COLLECTION)
+    createMeasurementIndexes(db, MONGO_DB_COLLECTION)
+
+
+    #region set up logging
+    file_handler = RotatingFileHandler(logFile, 'a', 10 * 1024 * 1024, 10)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    logger.setLevel(logging.INFO)
+    file_handler.setLevel(logging.INFO)
+    logger.addHandler(file_handler)
+    logger.info('Start computing average measurement values for DDL')
     #endregion
 
 
-    if aquoCodeGrootheid == 'CONCTTE' and uniqComb not in loadedTimeSeries:  # only compute avg for grootheid concentratie
+    #region read the parameter + loc codes of the time series that have already been computed
+    # the checkpoint file lists the combinations processed, skipped and failed in previous runs; if it does not exist
+    # yet, it is created from the combinations in the collection (read from the aquoParCode + locID index only)
+    if overwriteExistingCollection and os.path.exists(checkpointFile):
+        os.remove(checkpointFile)
 
-        # check if parameter / location combination has already been computed
-        # uniqComb = parCode + "_" + locID
-        # if uniqComb in loadedTimeSeries:
-        #     break
+    if not os.path.exists(checkpointFile):
+        # the time series of the period; documents stored before the period was recorded count for any period
+        periodQuery = {'$or': [{'properties.EIData.startTimeReq': starttimeDT.strftime("%Y-%m-%dT%H:%M:%S"),
+                                'properties.EIData.endTimeReq': endtimeDT.strftime("%Y-%m-%dT%H:%M:%S")},
+                               {'properties.EIData.startTimeReq': {'$exists': False}}]}
+        mongocursor = collection.find(periodQuery, {'_id': 0, 'properties.aquoParCode': 1, 'properties.locID': 1})
+        with open(checkpointFile, 'w') as fo:
+            for uniqComb in set(record['properties']['aquoParCode'] + "_" + record['properties']['locID'] for record in mongocursor):
+                fo.write(CHECKPOINT_PROCESSED + "\t" + uniqComb + "\n")
 
-        #region Get the data from the OnlineWaarnemingenService
-        aquoMetadataType = "Parameter"
+    checkpointStatus = readCheckpoint(checkpointFile)
 
-        payload = {"AquoPlusWaarnemingMetadata":
-                       {"AquoMetadata": {aquoMetadataType: {"Code": parCode}}},
-                   "Locatie": {"X": repr(location['X']), "Y": repr(location['Y']), "Code": locID},
-                   "Periode": {"Begindatumtijd": starttimeDDL, "Einddatumtijd": endtimeDDL}}
+    # processed and skipped combinations are not computed again; failed combinations are retried
+    loadedTimeSeries = set(uniqComb for uniqComb, status in checkpointStatus.items() if status != CHECKPOINT_FAILED)
+    print "Records failed in previous runs, retried: " + str(len(checkpointStatus) - len(loadedTimeSeries))
 
-        headers = {'content-type': 'application/json'}
+    checkpoint = open(checkpointFile, 'a')
+    #endregion
 
-        r = requests.post(RWS_Waarnemingen_URL, data=json.dumps(payload), headers=headers)
 
-        # check if data was retrieved successfully from the DDL
-        requestSucces = False
+    # create data directory to store downloaded files from DDL
+    if storeDDLFiles and os.path.exists(dataDir) == False:
+        os.makedirs(dataDir)
 
-        if r.status_code == 200:
-            resultJSON = r.json()
-            if 'Succesvol' in resultJSON.keys():
-                if resultJSON['Succesvol'] == True:
-                    requestSucces = True
-                else:
-                    logger.error("Key 'Succesvol' is False")
-                    print "Key 'Succesvol' is False"
-            else:
-                logger.error("No key 'Succesvol' in source DDL")
-                print "No key 'Succesvol' in source DDL"
-        else:
-            logger.error("Error in retrieving data from DDL for " + parCode + " and location " + locID + ", status code: " + str(r.status_code))
-        # endregion
+    inputEPSG = 25831   # the DDL uses EPSG 25831
 
 
-        if requestSucces:
+    replayCache = ReplayCache(replayCacheDir, replayCacheMode)
 
-            # store data of DDL
-            if storeDDLFiles:
-                if os.path.exists(fileName):
-                    logger.error("File " + fileName + " already exists, overwrite this file")
-                fo = open(fileName, 'w')
-                fo.write(r.content)
-                fo.close()
+    #region Read data from RIVM normendatabase to check if it's P90 or JGM
+    RIVMString = cachedRequest(replayCache, RIVMNormDBUrl)
+    #RIVMString = requests.get('https://acceptatie.rvs.rivm.nl/Data/SubtanceNormValues', auth=HTTPBasicAuth('rvs', 'nitr@@t'))  # old db
+    RIVMDict = json.loads(RIVMString)  # convert json string to python dict
+    table = buildNormResolutionTable(RIVMDict)  # (aquoCode, stateCode) -> calculation method and norms
+    logger.info('Normendatabase RIVM loaded')
+    print "Normendatabase RIVM loaded"
+    #endregion
 
-            for waarnemingLijst in resultJSON['WaarnemingenLijst']:
+    #region Get metadata from RWS metadata service
+    payload = {"CatalogusFilter": {"Grootheden": True, "Parameters": True, "Eenheden": True}}
+    headers = {'content-type': 'application/json'}
+    resultJSON = json.loads(cachedRequest(replayCache, RWS_Metadata_URL, json.dumps(payload), headers))
 
-                EIData = {}
 
-                #region store all relevant EI metadata
-                aquoMetadata = waarnemingLijst['AquoMetadata']
+    comb = resultJSON['AquoMetadataLocatieLijst']
+    locations = resultJSON['LocatieLijst']
+    aquometadatalijst = resultJSON['AquoMetadataLijst']
+    logger.info('Metadata from DDL loaded')
+    print "Metadata from DDL loaded"
+    #endregion
 
-                EIData['bemonsteringsSoortOmschrijving'] = aquoMetadata['BemonsteringsSoort']['Omschrijving']
-                EIData['bemonsteringsSoortCode'] = aquoMetadata['BemonsteringsSoort']['Code']
-                EIData['compartimentOmschrijving'] = aquoMetadata['Compartiment']['Omschrijving']
-                EIData['compartimentCode'] = aquoMetadata['Compartiment']['Code']
-                EIData['hoedanigheidOmschrijving'] = aquoMetadata['Hoedanigheid']['Omschrijving']
-                EIData['hoedanigheidCode'] = aquoMetadata['Hoedanigheid']['Code']
-                EIData['eenheidOmschrijving'] = aquoMetadata['Eenheid']['Omschrijving']
-                EIData['eenheidCode'] = aquoMetadata['Eenheid']['Code']
-                EIData['fileName'] = os.path.join(dataDir, fileName)
-                #endregion
 
-                #region Get calculation method from RIVM normendatabase
+    #region Plan the parameter / location combinations to compute
 
-                normIDList = []
-                valueProcessingMethodCode = ''
+    jobs, planStats = planJobs(comb, locations, aquometadatalijst, loadedTimeSeries)
 
-                # find the norm id of this substance by aquocode
-                for substance in substancesList:
-                    if substance['aquoCode'] == parCode:
-                        norms = substance['norms']
+    print "Total concentration records: " + str(planStats['nrConcRecords'])
+    print "Records already computed: " + str(planStats['nrRecordsAlreadyDone'])
+    print "Duplicate records: " + str(planStats['nrDuplicateRecords'])
+    print "Records still to compute: " + str(len(jobs))
+    logger.info("Records to compute: " + str(len(jobs)) + " of " + str(planStats['nrConcRecords']) + " concentration records")
 
-                        for norm in norms:
-                            normIDList.append(norm['id'])
+    # the coordinates of all locations to compute are transformed at once
+    ingestMetrics = IngestMetrics()
+    startTime = time.time()
+    locationCoords = transformLocations(jobs, inputEPSG, outputEPSG)
+    ingestMetrics.observeStage('transform', time.time() - startTime)
+    jobs = [job._replace(locCoords=locationCoords[job.locMessageID]) for job in jobs]
 
+    # only the years of the period that have not been retrieved before are requested; the combinations for which all
+    # years are stored are only combined into the average of the period
+    coverage = readCoverage(db, MONGO_DB_COLLECTION)
+    periodYears = getPeriodYears(starttimeDT, endtimeDT)
+    jobs = [job._replace(fetchYears=[year for year in periodYears if year not in coverage.get(job.parCode + "_" + job.locID, ())])
+            for job in jobs]
+    combineJobs = [job for job in jobs if not job.fetchYears]
+    fetchJobs = [job for job in jobs if job.fetchYears]
 
-                # get the processingmethodcodes based on the retrieved id
-                normsForSubstanceList = []
+    print "Records with all years stored: " + str(len(combineJobs))
+    logger.info("Records with all years stored: " + str(len(combineJobs)) + ", records to request: " + str(len(fetchJobs)))
+    #endregion
 
-                if normIDList:
-                    for normID in normIDList:
-                        for norm in normsList:
-                            if norm['id'] == normID:
-                                normInfoDict = {}
-                                normInfoDict['valueProcessingMethodCode'] = norm['valueProcessingMethodCode']
-                                normInfoDict['valueProcessingMethodDescription'] = norm['valueProcessingMethodDescription']
-                                normInfoDict['id'] = norm['id']
-                                normInfoDict['stateCode'] = norm['stateCode']
-                                normInfoDict['stateDescription'] = norm['stateDescription']
-                                normInfoDict['normDescription'] = norm['normDescription']
-                                normsForSubstanceList.append(normInfoDict)
 
+    n = 0   # keep track of number computed records
 
-                # Get all the norms that have the same Norm StateCode as the metadata Hoedanigheidcode of the DDL-measurements
-                normsForSubstanceStateCodeList = []
-                valueProcessingMethodCodeList = []
+    # the requests to the OnlineWaarnemingenService are done concurrently, and the responses are parsed and the averages
+    # computed by a pool of processes; the results are written here, in the order in which they are finished
+    fetcher = DDLFetcher(RWS_Waarnemingen_URL, nrFetchWorkers, maxRequestsPerSecond, maxRetries, logger=logger)
+    if replayCache.mode != CACHE_OFF:     # only the responses that are not in the replay cache are requested
+        fetcher = CachedFetcher(fetcher, replayCache, readCachedResponse)
+    # with profileSampleRate, a sample of the combinations is profiled; otherwise the functions are called directly
+    processFunction, storeFunction = processResponse, storeCombination
+    if profileSampleRate > 0:
+        processFunction, storeFunction = processSampledResponse, storeSampledCombination
 
-                # match the norm stateCode with the Hoedanigheidscode
-                for normInfo in normsForSubstanceList:
-                    if normInfo['stateCode'] == EIData['hoedanigheidCode']:
-                        normsForSubstanceStateCodeList.append(normInfo)
-                        valueProcessingMethodCodeList.append(normInfo['valueProcessingMethodCode'])
+    pipeline = IngestPipeline(fetcher, processFunction, nrParseProcesses, maxPendingResponses,
+                              setNormResolutionTable, (table,), logger)
 
-                EIData['normsForSubstanceStateCodeList'] = normsForSubstanceStateCodeList
-                EIData['valueProcessingMethodCode'] = valueProcessingMethodCodeList
-
-                if "JGM" in valueProcessingMethodCodeList:
-                    EIData['valueProcessingMethodCode'] = "JGM"
-                elif "MAX" in valueProcessingMethodCodeList:
-                    EIData['valueProcessingMethodCode'] = "MAX"
-                elif "P90" in valueProcessingMethodCodeList:
-                    EIData['valueProcessingMethodCode'] = "P90"
-                else:
-                    EIData['valueProcessingMethodCode'] = "Other"
-
-                #endregion
-
-
-                #region Calculate the average
-
-                metingen = waarnemingLijst['MetingenLijst']
-
-                # only compute average if the valueprocessingmethod is JGM, MAX or P90
-                if EIData['valueProcessingMethodCode'] in ['JGM', 'MAX', 'P90']:
-
-                    # get all the years
-                    years = []
-                    meettijden = []
-
-                    for meting in metingen:
-                        tijdstip = dt = parser.parse(meting['Tijdstip'])
-                        meettijden.append(tijdstip)
-                        years.append(tijdstip.year)
-                        meting['year'] = tijdstip.year     # add year to the metingen
-
-                    uniqYears = set(years)
-
-                    EIYearData = []
-                    avgYears = []   # list of all average values for each year
-
-                    # compute average for each year
-                    for year in uniqYears:
-
-                        meetwaarden = []
-                        meettijden = []
-                        nrInvalidMeas = 0
-                        nrValidMeas = 0
-                        totalMeas = 0
-                        measLimit = -9999
-
-                        for meting in metingen:
-
-                            if meting['year'] == year:
-
-                                metadata = meting['WaarnemingMetadata']
-
-                                #print "Referentievlak: " + metadata['ReferentievlakLijst'][0] + ", kwaliteitscode " + metadata['KwaliteitswaardecodeLijst'][0]
-                                if metadata['ReferentievlakLijst'][0] != "WATSGL":
-                                    print "Referentievlak: " + metadata['ReferentievlakLijst'][0]
-
-                                if int(metadata['KwaliteitswaardecodeLijst'][0]) < 50 and metadata['ReferentievlakLijst'][0] == "WATSGL":
-                                    meetwaarde = meting['Meetwaarde']['Waarde_Numeriek']
-
-                                    #print "ref vlak OK!"
-
-                                    # check if "Waarde Limietsymbool" is one of the keys; if yes, the value is the lower limit
-                                    if "Waarde_Limietsymbool" in meting['Meetwaarde'].keys():
-                                        measLimit = meetwaarde
-                                        meetwaarde *= 0.5
-
-                                    meetwaarden.append(meetwaarde)
-                                    meettijden.append(meting['Tijdstip'])
-                                    nrValidMeas += 1
-                                else:
-                                    nrInvalidMeas += 1
-
-                        if len(meetwaarden) > 0:
-                            maxValue = max(meetwaarden, key=float)
-                            minValue = min(meetwaarden)
-
-                            if EIData['valueProcessingMethodCode'] in ['JGM', 'MAX']:
-                                avg = sum(meetwaarden) / float(len(meetwaarden))
-                            elif EIData['valueProcessingMethodCode'] == 'P90':
-                                avg = np.percentile(meetwaarden, 90) # gives the 90th (linear interpolated) percentile
-                            else:
-                                avg = -9999
-                        else:
-                            avg = -9999
-                            maxValue = -9999
-                            minValue = -9999
-
-                        avgYears.append(avg)
-                        totalNrMeas = nrValidMeas + nrInvalidMeas
-
-                        if len(meettijden) > 0:
-                            firstObsDate = meettijden[0]
-                            lastObsDate = meettijden[-1]
-                        else:
-                            firstObsDate = -9999
-                            lastObsDate = -9999
-
-                        EIYearDict = {
-                            # EI-toets specific info
-                            'year': year,
-                            'avg': avg,
-                            'totalNrMeas': totalNrMeas,
-                            'nrInvalidMeas': nrInvalidMeas,
-                            'nrValidMeas': nrValidMeas,
-                            'validMeasValues': meetwaarden,
-                            'validMeasTimes': meettijden,
-                            'maxValue': maxValue,
-                            'minValue': minValue,
-                            'startTimeReq': starttimeDDString,
-                            'endTimeReq': endtimeDDString,
-                            'firstObsDate': firstObsDate,
-                            'lastObsDate': lastObsDate,
-                            'measLimit': measLimit
-                        }
-
-                        EIYearData.append(EIYearDict)
-
-                    # compute average over all years
-                    if len(avgYears) > 0:
-                        EIData['avg'] = sum(avgYears) / float(len(avgYears))
-                    else:
-                        EIData['avg'] = 0
-
-                    EIData['yearData'] = EIYearData
-                    logger.info("Succesfully calculated average value of: " + str(EIData['avg']))
-
-                #endregion
-
-                #region Store all non-EI data of this location&parameter to the MongoDB as a GeoJSON feature
-
-                # only store data if an average is computed and if measurement is a 'Steekmonster'
-                if EIData['bemonsteringsSoortOmschrijving'] != "Steekmonster":
-                    print "Data is not stored, bemonstering is: " + EIData['bemonsteringsSoortOmschrijving']
-
-                if 'avg' in EIData.keys() and EIData['bemonsteringsSoortOmschrijving'] == "Steekmonster":
-
-                    pointLoc = transformPoint(location['X'], location['Y'], inputEPSG, outputEPSG)
-                    locCoords = [pointLoc[0], pointLoc[1]]
-
-                    result = {
-                        'type': 'Feature',
-                        'geometry': {
-                                'type': 'Point',
-                                'coordinates': locCoords
-                            },
-                        'properties': {
-                            # default obligatory properties
-                            'source': 'DDL',
-                            'sourceDesc': 'Gegevens uit de data distributielaag van Rijkswaterstaat',
-                            'aquoParOmschrijving': aquometadata['Parameter']['Omschrijving'],
-                            'aquoParCode': parCode,
-                            'parDescription': aquometadata['Parameter_Wat_Omschrijving'],
-                            'locID': locID,
-                            'locName': location['Naam'],
-
-                            'EIData': EIData,
-
-                            # Source specific properties
-                            'sourceProp': {'X': repr(location['X']),
-                                           'Y': repr(location['Y'])
-                            }
-                        }
-                    } # end result
-
-                    post_id = collection.insert_one(result).inserted_id
-
-                    n += 1
-                    print "Finished computations: " + str(n)
+    # the results and summary updates are buffered and written in batches. The checkpoint of a combination is written
+    # after its results have been written; on Ctrl-C or an error the results that are computed are written first.
+    writer = BulkWriter(writeBatchSize, writeBatchBytes, writeFlushInterval, logger=logger,
+                        batchObserver=ingestMetrics.observeBatch)
 
-            #endregion
+    # the metrics are exported periodically while the script runs, and once more at the end
+    ingestMetrics.watch(fetcher, pipeline, writer)
+    metricsExporter = MetricsExporter(ingestMetrics.registry, metricsTextFile, metricsPushUrl, 'ei_ingest',
+                                      metricsExportInterval, logger)
 
-print "Script done"
+    spoolDir = tempfile.mkdtemp(prefix='DDLResponses_')     # responses waiting to be parsed
+    lastStatsTime = time.time()
 
+    try:
+        for job in combineJobs:
 
+            if n >= nrRecords:
+                break
 
-# merge averages if data is spread in multiple time periods
+            nrStored = storeFunction(db, writer, table, job, [], [])
+            n += nrStored
+            ingestMetrics.nrSeriesStored.inc(nrStored)
+            print "Finished computations: " + str(n)
 
+            status = CHECKPOINT_PROCESSED if nrStored > 0 else CHECKPOINT_SKIPPED
+            writer.callAfterFlush(partial(writeCheckpoint, checkpoint, status, job.parCode + "_" + job.locID))
 
-# #read existing data in database and store parameter + loc codes as unique identifier
-# mongocursor = collection.find()
-#
-# loadedTimeSeries = []
-#
-# for record in mongocursor:
-#
-#     for yearData in record['properties']['EIData']['yearData']:
-#
-#         parCode = record['properties']['aquoParCode']
-#         locID = record['properties']['locID']
-#         year = yearData['year']
-#
-#         loadedTimeSeries.append(parCode + "_" + locID + "_" + str(year))
-#
-#
-# len(loadedTimeSeries)
-#
-#
-#
-# a = {'year':[1,2,3]}
-# b = {'year':[4,5,3]}
-# b.items()
-#
-# c = dict(a.items() + b.items() +  [(k, a[k] + b[k]) for k in set(b) & set(a)])
+        # the jobs are fetched ahead of the results, so only as many combinations are requested as are needed to reach
+        # the limit if each stores a time series; the combinations that are skipped are not replaced in this run
+        limitedFetchJobs = fetchJobs[:max(0, nrRecords - n)]
 
+        for job, processed, error in pipeline.run(generateJobs(limitedFetchJobs), partial(fetchResponse, spoolDir, replayCache, ingestMetrics)):
 
+            if n >= nrRecords:
+                break
 
+            parCode, locID = job.parCode, job.locID
 
+            logger.info("Compute " + parCode + " and location " + locID)
+            print "Compute " + parCode + " and location " + locID
+
+            nrStoredBefore = n
+
+            #region check if data was retrieved successfully from the DDL
+            requestFailed = True    # the DDL could not be reached or returned an error; the combination is retried in a next run
+
+            if error is not None:
+                logger.error("Error in retrieving or processing data from DDL for " + parCode + " and location " + locID + ": " + str(error))
+            elif processed['statusCode'] == 200:
+                requestFailed = False
+                if processed['succesvol'] is None:
+                    logger.error("No key 'Succesvol' in source DDL")
+                    print "No key 'Succesvol' in source DDL"
+                elif processed['succesvol'] != True:
+                    logger.error("Key 'Succesvol' is False")
+                    print "Key 'Succesvol' is False"
+            else:
+                logger.error("Error in retrieving data from DDL for " + parCode + " and location " + locID + ", status code: " + str(processed['statusCode']))
+            # endregion
+
+            if not requestFailed:
+
+                ingestMetrics.observeTimings(processed['timings'])
+
+                if processed['nrBytes'] is not None:
+                    logger.info("Parsed response of %d bytes" % processed['nrBytes'])
+                if processed.get('peakRSS') is not None:
+                    logger.info("Peak RSS of the parse process: %.0f MB" % processed['peakRSS'])
+
+                for message in processed['messages']:
+                    logger.info(message)
+                    print message
+
+                if processed['succesvol'] == True:
+                    nrStored = storeFunction(db, writer, table, job, processed['yearDocuments'], processed['seriesDocuments'])
+                    n += nrStored
+                    ingestMetrics.nrSeriesStored.inc(nrStored)
+                    print "Finished computations: " + str(n)
+
+            if requestFailed:
+                status = CHECKPOINT_FAILED
+            elif n > nrStoredBefore:
+                status = CHECKPOINT_PROCESSED
+            else:
+                status = CHECKPOINT_SKIPPED
+            writer.callAfterFlush(partial(writeCheckpoint, checkpoint, status, parCode + "_" + locID))
+
+            if time.time() - lastStatsTime >= statsInterval:
+                logPipelineStats(pipeline, writer)
+                lastStatsTime = time.time()
+    finally:
+        # stop fetching and processing; the combinations that were not written are computed again in the next run
+        pipeline.stop()
+        try:
+            writer.close()
+        finally:
+            # let the data aansluitpunt know that the data has changed, so it drops its cached responses; also after
+            # an error or Ctrl-C, as the results that were computed have been written
+            bumpDataVersion(db, MONGO_DB_COLLECTION)
+        metricsExporter.stop()
+        checkpoint.close()
+        shutil.rmtree(spoolDir, ignore_errors=True)
+
+    logPipelineStats(pipeline, writer)
+
+    fetchStats = fetcher.getStats()
+    logger.info("DDL requests: %d, retries: %d, failed: %d" % (fetchStats['nrRequests'], fetchStats['nrRetries'], fetchStats['nrFailures']))
+
+    cacheStats = replayCache.getStats()
+    logger.info("Replay cache hits: %d, misses: %d, stored: %d" % (cacheStats['nrHits'], cacheStats['nrMisses'], cacheStats['nrStored']))
+
+    writeStats = writer.getStats()
+    logger.info("MongoDB writes: %d in %d batches (%d failed), mean batch size: %.1f, mean batch latency: %.3f s, "
+                "%.1f writes/s" %
+                (writeStats['nrOperations'], writeStats['nrBatches'], writeStats['nrFailed'], writeStats['meanBatchSize'],
+                 writeStats['meanWriteLatency'], writeStats['operationsPerSecond']))
+    print "MongoDB writes per second: %.1f" % writeStats['operationsPerSecond']
+
+    peakRSS = getPeakRSS()
+    if peakRSS is not None:
+        logger.info("Peak RSS: %.0f MB" % peakRSS)
+
+    print "Script done"
+
+
+if __name__ == '__main__':  # the processes of the pool import this script, so only the main process runs it
+    main()
@@ -1,60 +1,119 @@
 import os, sys
-from flask import Flask, current_app, make_response, request, render_template
+from flask import Flask, Response, current_app, make_response, request, render_template, g, stream_with_context, \
+    send_file
 import pymongo
-import requests
+import bson
 import json
-from operator import itemgetter  # used for sorting dictionary lists of unique locations, parameters and sources alphabetically
-from datetime import timedelta
-from functools import update_wrapper
+import base64
+import types
+import time
+import timeit
+import random
+import hmac
+import cProfile
+from datetime import datetime, timedelta
+from functools import update_wrapper, partial
 import ConfigParser
 import atexit
 from apscheduler.schedulers.background import BackgroundScheduler
+from normcatalogue import downloadCatalogue, loadSnapshot, saveSnapshot
+from eisummaries import getSummaryCollections, createDataIndexes, createSummaryIndexes, getDataVersion
+from eiseries import getSeriesCollection, createSeriesIndexes, decodeSeries
+from eimeasurements import createMeasurementIndexes, computePeriodAverages
+from responsecache import ResponseCache
+from metrics import MetricsRegistry
+from profiling import ProfileStore
+
+Config = ConfigParser.ConfigParser()
+Config.read("config.ini")
+
+
+def getOptionalSetting(option, default):
+    """
+    :return: the value of an optional setting of config.ini, e.g. to run against local stand-ins of MongoDB and the
+    RIVM normendatabase (see benchmarks/bench_routes.py), or the default if it is not set
+    """
+
+    return Config.get('SectionOne', option) if Config.has_option('SectionOne', option) else default
+
+
+RIVM_NORM_DB_URL = getOptionalSetting('rivm_norm_db_url', 'https://rvs.rivm.nl/zoeksysteem/Data/SubtanceNormValues')
+MONGODB_URI = getOptionalSetting('mongodb_uri', 'mongodb://localhost:27017')
+PROFILE_DIR = getOptionalSetting('profile_dir', None)     # directory of the profiles; profiling is off without it
+PROFILE_TOKEN = getOptionalSetting('profile_token', None)
+PROFILE_SAMPLE_RATE = float(getOptionalSetting('profile_sample_rate', 0))
+PROFILE_MAX_FILES = int(getOptionalSetting('profile_max_files', 100))
+PROFILE_HEADER = 'X-EI-Profile'
+RIVM_NORM_DB_FILE = 'RIVMNormDB.json'           # the RIVM norm database, for reference
+RIVM_SNAPSHOT_FILE = 'RIVMNormDB.snapshot'      # the parsed norm catalogue, loaded at startup
 
 sched = BackgroundScheduler()
-RIVMDict = {}
-normsList = []
-substancesList = []
+normCatalogue = None    # the NormCatalogue in use; None until the snapshot or the first download has been loaded
+
+# status of the refresh of the RIVM norm database
+RIVMStatus = {'lastCheck': None,            # time (UTC) of the last successful check for a new RIVM database
+              'lastChange': None,           # time (UTC) of the last download of a changed RIVM database
+              'lastDuration': None,         # duration of the last refresh in seconds
+              'lastError': None,            # error message of the last failed refresh
+              'nrRefreshes': 0,
+              'nrErrors': 0}
+
+
+def loadRIVMSnapshot():
+    """
+    Load the norm catalogue that was stored by the last refresh, so the data aansluitpunt can start without waiting
+    for the download of the RIVM norm database
+    """
+
+    global normCatalogue
+
+    catalogue = loadSnapshot(RIVM_SNAPSHOT_FILE, RIVM_NORM_DB_FILE)
+    if catalogue is not None:
+        normCatalogue = catalogue
+        print "RIVM norm database loaded from snapshot"
+    else:
+        print "No RIVM norm database snapshot found, waiting for the download"
+
 
 # Define the function that is to be executed
 def updateRIVMDB():
+    """
+    Download the RIVM norm database if it has changed, and replace the norm catalogue. The new catalogue is built
+    completely before it replaces the current one in a single assignment, so a request never sees a mix of old and new
+    data. If the download fails, the current catalogue remains in use.
+    """
 
     print("Reading RIVM DATA")
 
-    # set RIVMDict, norms and substanceslist to global; we want to change the global variables
-    global RIVMDict
-    global normsList
-    global substancesList
-
-    # Retrieve the latest RIVM Norm database when starting the script
-    r = requests.get('https://rvs.rivm.nl/zoeksysteem/Data/SubtanceNormValues')
+    # set the norm catalogue to global; we want to change the global variable
+    global normCatalogue
 
-    if r.status_code == 200:
-        fo = open('RIVMNormDB.json', 'w')
-        fo.write(r.content)
-        fo.close()
-    else:
-        print "Error in retrieving RIVM Norm database"
+    startTime = time.time()
 
-    # load in the RIVM norm database
     try:
-        with open('RIVMNormDB.json') as RIVMDataFile:
-            RIVMDict = json.load(RIVMDataFile)  # convert json string to python dict
-            normsList = RIVMDict['norms']
-            substancesList = RIVMDict['substances']
-    except:
-        print "Error in loading RIVM norms database, exiting"
-        sys.exit()
+        newCatalogue = downloadCatalogue(RIVM_NORM_DB_URL, normCatalogue)
+        if newCatalogue is not None:
+            saveSnapshot(newCatalogue, RIVM_SNAPSHOT_FILE, RIVM_NORM_DB_FILE)
+            normCatalogue = newCatalogue
+            RIVMStatus['lastChange'] = datetime.utcnow()
+    except Exception as err:
+        print "Error in retrieving RIVM Norm database: " + str(err)
+        RIVMStatus['lastError'] = str(err)
+        RIVMStatus['nrErrors'] += 1
+    else:
+        RIVMStatus['lastCheck'] = datetime.utcnow()
+        RIVMStatus['nrRefreshes'] += 1
 
+    RIVMStatus['lastDuration'] = time.time() - startTime
 
-# Explicitly kick off the background thread
-sched.add_job(updateRIVMDB, 'interval', id='rivm_dbupdate_id', days=7, start_date='2016-07-24 03:30:00')
-sched.start()
 
-# load the data at the start
-updateRIVMDB()
+# load the data of the last refresh at the start
+loadRIVMSnapshot()
 
-Config = ConfigParser.ConfigParser()
-Config.read("config.ini")
+# Explicitly kick off the background thread; the first refresh runs immediately
+sched.add_job(updateRIVMDB, 'interval', id='rivm_dbupdate_id', days=7, start_date='2016-07-24 03:30:00',
+              next_run_time=datetime.now())
+sched.start()
 
 app = Flask(__name__)
 
@@ -63,6 +122,251 @@ app.config['DEVELOP'] = Config.get('SectionOne', 'develop') in ['True', 'true',
 
 my_dir = os.path.dirname(__file__)
 
+# maximum number of timeseries in one page of /avg
+AVG_PAGE_MAX_LIMIT = 1000
+
+# maximum number of results and default maximum distance (in meters) of a bbox or near selection
+SPATIAL_MAX_RESULTS = 500
+SPATIAL_DEFAULT_MAX_DISTANCE = 10000
+
+# maximum number of parameter / location pairs in one /avg/batch request
+AVG_BATCH_MAX_PAIRS = 500
+
+# cache of the responses of the endpoints that read from MongoDB; the cache is dropped when the compute script has
+# changed the data (the data version stamp of the EIData collection is checked at most every 5 seconds)
+responseCache = ResponseCache(lambda: getDataVersion(db, "EIData"), maxEntries=1000, maxBytes=64 * 1024 * 1024,
+                              versionCheckInterval=5)
+
+
+# metrics of the data aansluitpunt, in the Prometheus text format on /metrics
+metricsRegistry = MetricsRegistry()
+requestCounter = metricsRegistry.counter('ei_http_requests_total', 'Number of HTTP requests',
+                                         ['route', 'method', 'status'])
+requestDuration = metricsRegistry.histogram('ei_http_request_duration_seconds',
+                                            'Duration of the HTTP requests, including the streaming of the response',
+                                            ['route'])
+mongoDuration = metricsRegistry.histogram('ei_mongo_duration_seconds', 'Time spent waiting for MongoDB per request',
+                                          ['route'])
+mongoDocumentsReturned = metricsRegistry.counter('ei_mongo_documents_returned_total',
+                                                 'Number of documents read from MongoDB', ['route'])
+serializationDuration = metricsRegistry.histogram('ei_serialization_duration_seconds',
+                                                  'Time spent in serializing JSON per request', ['route'])
+responseBytes = metricsRegistry.counter('ei_response_bytes_total', 'Number of bytes of the response bodies', ['route'])
+
+
+def getMongoServerDocuments():
+    """
+    :return: dict with the number of documents and index keys scanned and the number of documents returned by the
+    MongoDB server since its start; a ratio of scanned to returned far above 1 means a query without a suitable index
+    """
+
+    serverMetrics = db.command('serverStatus')['metrics']
+    return {('scanned',): serverMetrics['queryExecutor']['scannedObjects'],
+            ('scannedKeys',): serverMetrics['queryExecutor']['scanned'],
+            ('returned',): serverMetrics['document']['returned']}
+
+
+metricsRegistry.gauge('ei_mongo_server_documents_total',
+                      'Number of documents scanned and returned by the MongoDB server (all clients)', ['kind'],
+                      getMongoServerDocuments, 'counter')
+metricsRegistry.gauge('ei_rivm_catalogue_age_seconds', 'Age of the RIVM norm catalogue in use', (),
+                      lambda: (datetime.utcnow() - normCatalogue.lastModified).total_seconds()
+                      if normCatalogue is not None else None)
+metricsRegistry.gauge('ei_rivm_seconds_since_last_check',
+                      'Seconds since the last successful check for a new RIVM norm database', (),
+                      lambda: (datetime.utcnow() - RIVMStatus['lastCheck']).total_seconds()
+                      if RIVMStatus['lastCheck'] else None)
+metricsRegistry.gauge('ei_rivm_refresh_errors_total', 'Number of failed refreshes of the RIVM norm database', (),
+                      lambda: RIVMStatus['nrErrors'], 'counter')
+
+
+def getResponseCacheRequests():
+    stats = responseCache.getStats()
+    return {('hit',): stats['hits'], ('miss',): stats['misses']}
+
+
+metricsRegistry.gauge('ei_response_cache_requests_total', 'Number of hits and misses of the response cache',
+                      ['result'], getResponseCacheRequests, 'counter')
+metricsRegistry.gauge('ei_response_cache_entries', 'Number of responses in the response cache', (),
+                      lambda: responseCache.getStats()['entries'])
+
+
+class RequestMetrics(object):
+    """
+    Timings of a single request, collected in flask.g and recorded in the metrics when the response is closed
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.startTime = timeit.default_timer()
+        self.mongoTime = None           # None if the request does not use MongoDB
+        self.nrDocuments = 0
+        self.serializationTime = 0.0
+        self.nrBytes = 0
+
+
+def addMongoTime(seconds, nrDocuments=0):
+    requestMetrics = getattr(g, 'requestMetrics', None)
+    if requestMetrics is not None:
+        requestMetrics.mongoTime = (requestMetrics.mongoTime or 0.0) + seconds
+        requestMetrics.nrDocuments += nrDocuments
+
+
+def timedCursor(mongocursor):
+    """
+    Iterate over a MongoDB cursor, and add the time spent waiting for the documents to the metrics of the request
+    """
+
+    iterator = iter(mongocursor)
+    while True:
+        startTime = timeit.default_timer()
+        try:
+            record = next(iterator)
+        except StopIteration:
+            addMongoTime(timeit.default_timer() - startTime)
+            return
+        addMongoTime(timeit.default_timer() - startTime, 1)
+        yield record
+
+
+def timedDumps(obj):
+    """
+    json.dumps, with the time spent added to the metrics of the request
+    """
+
+    startTime = timeit.default_timer()
+    result = json.dumps(obj)
+    requestMetrics = getattr(g, 'requestMetrics', None)
+    if requestMetrics is not None:
+        requestMetrics.serializationTime += timeit.default_timer() - startTime
+    return result
+
+
+def countBytes(requestMetrics, chunks):
+    """
+    Yield the chunks of a streamed response and count their bytes
+    """
+
+    for chunk in chunks:
+        requestMetrics.nrBytes += len(chunk)
+        yield chunk
+
+
+def recordRequest(requestMetrics, method, status):
+    route = requestMetrics.route
+    requestCounter.inc(route=route, method=method, status=status)
+    requestDuration.observe(timeit.default_timer() - requestMetrics.startTime, route=route)
+    if requestMetrics.mongoTime is not None:
+        mongoDuration.observe(requestMetrics.mongoTime, route=route)
+        mongoDocumentsReturned.inc(requestMetrics.nrDocuments, route=route)
+    serializationDuration.observe(requestMetrics.serializationTime, route=route)
+    responseBytes.inc(requestMetrics.nrBytes, route=route)
+
+
+@app.before_request
+def startRequestMetrics():
+    g.requestMetrics = RequestMetrics(request.url_rule.rule if request.url_rule is not None else 'unmatched')
+
+
+@app.after_request
+def finishRequestMetrics(response):
+    """
+    Record the metrics of the request when the response is closed, i.e. after a streamed response has been sent
+    """
+
+    requestMetrics = getattr(g, 'requestMetrics', None)
+    if requestMetrics is None:
+        return response
+
+    if response.is_streamed:
+        response.response = countBytes(requestMetrics, response.response)
+    else:
+        requestMetrics.nrBytes = response.content_length or 0
+    response.call_on_close(partial(recordRequest, requestMetrics, request.method, response.status_code))
+
+    return response
+
+
+# opt-in profiling of single requests: with profile_dir in config.ini, a request is profiled if it has the header
+# X-EI-Profile with the profile_token, or with a probability of profile_sample_rate. The profiles are listed and
+# downloaded with /admin/profiles (with the same header). Without profile_dir the hooks are not registered.
+profileStore = ProfileStore(PROFILE_DIR, PROFILE_MAX_FILES) if PROFILE_DIR else None
+
+
+def hasProfileToken():
+    """
+    :return: True if the request has the header X-EI-Profile with the profile_token; both are compared as UTF-8 bytes,
+    as compare_digest can not compare a non-ASCII unicode string
+    """
+
+    token = request.headers.get(PROFILE_HEADER)
+    if PROFILE_TOKEN is None or token is None:
+        return False
+
+    try:
+        token = token.encode('utf-8') if isinstance(token, unicode) else token
+        profileToken = PROFILE_TOKEN.encode('utf-8') if isinstance(PROFILE_TOKEN, unicode) else PROFILE_TOKEN
+        return hmac.compare_digest(token, profileToken)
+    except (UnicodeError, TypeError):
+        return False
+
+
+# the endpoints that are never profiled: the admin routes always have the token, and their profiles would push the
+# profiles of the requests out of the ring
+UNPROFILED_ENDPOINTS = frozenset(['listProfiles', 'getProfile', 'getMetrics'])
+
+
+def startRequestProfile():
+    if request.endpoint in UNPROFILED_ENDPOINTS:
+        return
+    if hasProfileToken() or random.random() < PROFILE_SAMPLE_RATE:
+        g.profileName = profileStore.newName()
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+
+def setProfileName(response):
+    """
+    Return the name of the profile of the request, so it can be downloaded from /admin/profiles/<name>
+    """
+
+    if getattr(g, 'profile', None) is not None:
+        g.profileStatus = response.status_code
+        response.headers[PROFILE_HEADER + '-Name'] = g.profileName
+    return response
+
+
+def finishRequestProfile(exception):
+    """
+    Store the profile of the request when the request context is closed, i.e. after a streamed response has been sent
+    """
+
+    profile = getattr(g, 'profile', None)
+    if profile is None:
+        return
+    profile.disable()
+    g.profile = None
+
+    requestMetrics = g.requestMetrics
+    info = {'method': request.method,
+            'path': request.full_path,
+            'route': requestMetrics.route,
+            'status': getattr(g, 'profileStatus', 500),
+            'seconds': timeit.default_timer() - requestMetrics.startTime,
+            'mongoSeconds': requestMetrics.mongoTime,
+            'nrDocuments': requestMetrics.nrDocuments,
+            'serializationSeconds': requestMetrics.serializationTime,
+            'nrBytes': requestMetrics.nrBytes}
+    try:
+        profileStore.save(profile, info, g.profileName)
+    except EnvironmentError as err:     # the request itself has succeeded
+        print "Error in storing the profile of a request: " + str(err)
+
+
+if profileStore is not None:
+    app.before_request(startRequestProfile)
+    app.after_request(setProfileName)
+    app.teardown_request(finishRequestProfile)
 
 
 def crossdomain(origin=None, methods=None, headers=None, max_age=21600, attach_to_all=True, automatic_options=True):
@@ -111,6 +415,52 @@ def crossdomain(origin=None, methods=None, headers=None, max_age=21600, attach_t
     return decorator
 
 
+def cachedResponse(f):
+    """
+    Decorator that returns the response of an endpoint from the response cache. The cache key is the path of the
+    request and the sorted query arguments, so the order of the arguments does not matter.
+    An endpoint can return a string or a generator of strings; a generator is streamed to the client and is cached
+    when it is finished.
+    """
+
+    def wrapped_function(*args, **kwargs):
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+
+        resp = responseCache.get(key)
+        if resp is None:
+            dataVersion = responseCache.getCurrentVersion()     # the response is not cached if the data changes
+            resp = f(*args, **kwargs)
+            if isinstance(resp, basestring):    # only cache JSON strings, not flask Response objects
+                responseCache.put(key, resp, dataVersion)
+            elif isinstance(resp, types.GeneratorType):
+                resp = Response(stream_with_context(teeToCache(key, resp, dataVersion)), mimetype='application/json')
+
+        return resp
+
+    return update_wrapper(wrapped_function, f)
+
+
+def teeToCache(key, chunks, dataVersion):
+    """
+    Yield the chunks of a streamed response and put the complete response in the response cache at the end
+    :param dataVersion: the data version stamp of the response cache before the response was computed
+    """
+
+    parts = []
+    size = 0
+
+    for chunk in chunks:
+        if parts is not None:
+            parts.append(chunk)
+            size += len(chunk)
+            if size > responseCache.maxBytes:   # too large to cache; stop collecting
+                parts = None
+        yield chunk
+
+    if parts is not None:
+        responseCache.put(key, ''.join(parts), dataVersion)
+
+
 @app.route('/', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*')
 def index():
@@ -124,185 +474,525 @@ def getNorms():
     get the norms for a substance, or get all norms
     """
 
+    catalogue = normCatalogue
+    if catalogue is None:   # no snapshot and the first download has failed; not an empty catalogue with an ETag
+        return "The RIVM norm database has not been loaded yet, please try again later", 503, {'Retry-After': '60'}
+
     if 'parCode' in request.args.keys():
-        parCode = request.args['parCode']
-
-        allInfo = {}
-
-        normsForSubstance = []
-
-        # find the norm id of this substance by aquocode
-        for substance in substancesList:
-            if substance['aquoCode'] == parCode:
-
-                #region store info of this substance
-                allInfo['aquoCode'] = substance['aquoCode']
-                allInfo['name'] = substance['name']
-                allInfo['englishName'] = substance['englishName']
-                allInfo['casNumber'] = substance['casNumber']
-                allInfo['hasZzsEntry'] = substance['hasZzsEntry']
-                #endregion
-
-                # go through all norms of this substance
-                norms = substance['norms']
-
-                for norm in norms:
-
-                    normData = {}
-                    normData['value'] = norm['value']
-
-                    #region get the norm ID and retrieve all info of the norm ID out of the norms dictionary
-                    normID = norm['id']
-                    normInfo = {}
-
-                    for norm in normsList:
-                        if norm['id'] == normID:
-                            normInfo['id'] = norm['id']
-                            normInfo['description'] = norm['description']
-                            normInfo['compartmentName'] = norm['compartmentName']
-                            normInfo['categoryDescription'] = norm['categoryDescription']
-                            normInfo['normCode'] = norm['normCode']
-                            normInfo['normDescription'] = norm['normDescription']
-                            normInfo['normSubgroupCode'] = norm['normSubgroupCode']
-                            normInfo['normSubgroupDescription'] = norm['normSubgroupDescription']
-                            normInfo['compartmentCode'] = norm['compartmentCode']
-                            normInfo['compartmentDescription'] = norm['compartmentDescription']
-                            normInfo['compartmentSubgroupCode'] = norm['compartmentSubgroupCode']
-                            normInfo['compartmentSubgroupDescription'] = norm['compartmentSubgroupDescription']
-                            normInfo['quantityCode'] = norm['quantityCode']
-                            normInfo['quantityDescription'] = norm['quantityDescription']
-                            normInfo['stateCode'] = norm['stateCode']
-                            normInfo['stateDescription'] = norm['stateDescription']
-                            normInfo['valueProcessingMethodCode'] = norm['valueProcessingMethodCode']
-                            normInfo['valueProcessingMethodDescription'] = norm['valueProcessingMethodDescription']
-
-                    normData['info'] = normInfo
-                    #endregion
-
-                    normsForSubstance.append(normData)
-
-        allInfo['norms'] = normsForSubstance
-
-        return json.dumps(allInfo)
+        return catalogue.getNormsResponse(request.args['parCode'])
     elif request.query_string == "":    # empty query string: return all
-        return json.dumps(RIVMDict)
+        return getFullCatalogueResponse(catalogue)
     else:
         return "Please give a valid aquo code 'parCode' as GET parameter, or leave out the GET parameter to obtain all norms and substances"
 
 
+def getFullCatalogueResponse(catalogue):
+    """
+    Return the pre-serialized RIVM norm database, compressed with the best encoding accepted by the client.
+    The response has an ETag and Last-Modified header, so a client that already has the current catalogue gets a
+    304 Not Modified without a body.
+    :param catalogue: the NormCatalogue to return
+    :return: flask Response
+    """
+
+    encoding = 'identity'
+    for acceptedEncoding in ['br', 'gzip']:
+        if acceptedEncoding in catalogue.fullResponse and request.accept_encodings[acceptedEncoding] > 0:
+            encoding = acceptedEncoding
+            break
+
+    resp = Response(catalogue.fullResponse[encoding], mimetype='application/json')
+    if encoding != 'identity':
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.headers['Cache-Control'] = 'no-cache'  # clients may store the catalogue, but have to revalidate it
+
+    # each encoding is a different representation, so it gets its own ETag
+    resp.set_etag(catalogue.etag if encoding == 'identity' else catalogue.etag + '-' + encoding)
+    resp.last_modified = catalogue.lastModified
+
+    return resp.make_conditional(request)   # sets status 304 and removes the body if the client copy is current
+
+
 @app.route('/locations', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*')
+@cachedResponse
 def getLocations():
     """
-    Get all unique timeseries location information for a certain parameter and / or locationID
+    Get all unique timeseries location information for a certain parameter and / or locationID, optionally only the
+    locations within a bounding box (bbox=minLon,minLat,maxLon,maxLat) or near a point (near=lon,lat and optionally
+    maxDistance in meters); locations near a point are sorted by distance
     :return: JSON containing the locations
     """
 
-    searchList = []
+    # the unique locations are read from the locations summary collection, maintained by the compute script
+    searchDict = {}
 
     if 'parCode' in request.args.keys():
-        searchList.append({"properties.aquoParCode": request.args['parCode']})
+        searchDict['aquoParCodes'] = request.args['parCode']
 
     if 'locID' in request.args.keys():
-        searchList.append({"properties.locID": request.args['locID']})
-
-    searchDict = {}
-    if searchList:
-        searchDict["$and"] = searchList
-
-
-    mongocursor = collection.find(searchDict)
-    timeseries = []
-
-    for record in mongocursor:
-        del record['_id'] # remove mongoID, that should not be part of the output (and is not JSON Serializable)
-        timeseries.append(record)
+        searchDict['_id'] = request.args['locID']
 
-    uniqLocIDSeries = list({v['properties']['locID']: v for v in timeseries}.values())
+    try:
+        geometryQuery, sortedOnDistance = getGeometryQuery(request.args)
+        limit = getSpatialLimit(request.args) if geometryQuery is not None else 0
+    except ValueError as err:
+        return str(err), 400
 
-    uniqLocList = []
-    for uniqLocIDSerie in uniqLocIDSeries:
-        uniqLoc = {}
-        uniqLoc['type'] = 'Feature'
-        uniqLoc['properties'] = {}
-        uniqLoc['properties']['source'] = uniqLocIDSerie['properties']['source']
-        uniqLoc['properties']['locID'] = uniqLocIDSerie['properties']['locID']
-        uniqLoc['properties']['locName'] = uniqLocIDSerie['properties']['locName']
-        uniqLoc['geometry'] = uniqLocIDSerie['geometry']
-        uniqLocList.append(uniqLoc)
+    if geometryQuery is not None:
+        searchDict['geometry'] = geometryQuery
 
-    uniqLocList.sort(key=lambda e: e['properties']['locName'])  # sort alphabetically on locName
+    mongocursor = locationsCollection.find(searchDict, {'_id': 0, 'aquoParCodes': 0}).limit(limit)
+    if not sortedOnDistance:
+        mongocursor = mongocursor.sort('properties.locName', pymongo.ASCENDING)  # sort alphabetically on locName
+    uniqLocList = list(timedCursor(mongocursor))
 
     uniqLocationsDict = {}
     uniqLocationsDict['type'] = "FeatureCollection"
     uniqLocationsDict['features'] = uniqLocList
 
-    return json.dumps(uniqLocationsDict)
+    return timedDumps(uniqLocationsDict)
 
 
 @app.route('/parameters', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*')
+@cachedResponse
 def getParameters():
     """
     Get all the Aquo parameters in the database
     :return:
     """
 
+    # the unique parameters are read from the parameters summary collection, maintained by the compute script
     searchDict = {} # potential for selecting a subset
-    mongocursor = collection.find(searchDict)
+    mongocursor = parametersCollection.find(searchDict, {'_id': 0})
+    uniqParList = list(timedCursor(mongocursor.sort('aquoParOmschrijving', pymongo.ASCENDING)))  # sort alphabetically
+
+    return timedDumps(uniqParList)
+
+
+
+def getGeometryQuery(args):
+    """
+    Get the MongoDB query on the GeoJSON geometry for the spatial request arguments:
+    bbox=minLon,minLat,maxLon,maxLat for the locations within a bounding box, or
+    near=lon,lat (with optionally maxDistance in meters) for the locations near a point
+    :param args: the request arguments
+    :return: tuple with the query on the geometry field (None if there is no spatial selection), and True if the
+    results are sorted on distance
+    """
+
+    if 'bbox' in args.keys() and 'near' in args.keys():
+        raise ValueError("Please give either a 'bbox' or 'near', not both")
+
+    if 'bbox' in args.keys():
+        try:
+            minLon, minLat, maxLon, maxLat = [float(value) for value in args['bbox'].split(',')]
+        except ValueError:
+            raise ValueError("Please give 'bbox' as minLon,minLat,maxLon,maxLat (WGS84)")
+        if not (-180 <= minLon < maxLon <= 180 and -90 <= minLat < maxLat <= 90):
+            raise ValueError("Please give 'bbox' as minLon,minLat,maxLon,maxLat (WGS84)")
+
+        polygon = [[[minLon, minLat], [maxLon, minLat], [maxLon, maxLat], [minLon, maxLat], [minLon, minLat]]]
+        return {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': polygon}}}, False
+
+    if 'near' in args.keys():
+        try:
+            lon, lat = [float(value) for value in args['near'].split(',')]
+            maxDistance = float(args.get('maxDistance', SPATIAL_DEFAULT_MAX_DISTANCE))
+        except ValueError:
+            raise ValueError("Please give 'near' as lon,lat (WGS84) and 'maxDistance' in meters")
+        if not (-180 <= lon <= 180 and -90 <= lat <= 90 and maxDistance > 0):
+            raise ValueError("Please give 'near' as lon,lat (WGS84) and 'maxDistance' in meters")
+
+        return {'$near': {'$geometry': {'type': 'Point', 'coordinates': [lon, lat]}, '$maxDistance': maxDistance}}, True
+
+    return None, False
+
+
+def getSpatialLimit(args):
+    """
+    :param args: the request arguments
+    :return: the maximum number of results of a spatial selection
+    """
+
+    try:
+        limit = int(args.get('limit', SPATIAL_MAX_RESULTS))
+    except ValueError:
+        limit = 0
+    if limit < 1 or limit > SPATIAL_MAX_RESULTS:
+        raise ValueError("Please give a 'limit' between 1 and " + str(SPATIAL_MAX_RESULTS))
+
+    return limit
+
+
+def getProjection(fields):
+    """
+    :param fields: comma separated list of (dotted) field names to return, or of field names with a '-' in front to
+    leave out
+    :return: MongoDB projection dict, or None if the fields are not valid
+    """
+
+    projection = {}
+
+    for field in fields.split(','):
+        field = field.strip()
+        if field == '':
+            continue
+
+        include = 0 if field.startswith('-') else 1
+        field = field.lstrip('-')
+        if field == '' or '$' in field or field == '_id':
+            return None
+
+        projection[field] = include
+
+    if len(set(projection.values())) > 1:   # MongoDB can not combine included and excluded fields
+        return None
+
+    return projection
 
-    timeseries = []
 
+def encodeResumeToken(objectID):
+    """
+    :return: opaque token for continuing after the document with this MongoDB id
+    """
+
+    return base64.urlsafe_b64encode(str(objectID))
+
+
+def decodeResumeToken(token):
+    """
+    :return: the MongoDB id encoded in the resume token
+    """
+
+    return bson.objectid.ObjectId(base64.urlsafe_b64decode(token.encode('ascii')))
+
+
+def generateJSONList(mongocursor):
+    """
+    Write the documents of the cursor as a JSON list, while the cursor yields them
+    """
+
+    yield '['
+    separator = ''
     for record in mongocursor:
+        yield separator + timedDumps(record)
+        separator = ', '
+    yield ']'
 
-        del record['_id'] # remove mongoID, that should not be part of the output (and is not JSON Serializable)
-        timeseries.append(record)
 
-    uniqParCodeSeries = list({v['properties']['aquoParCode']: v for v in timeseries}.values())
-    uniqParList = []
-    for uniqParCodeSerie in uniqParCodeSeries:
-        uniqParList.append({'aquoParCode': uniqParCodeSerie['properties']['aquoParCode'],
-                            'aquoParOmschrijving': uniqParCodeSerie['properties']['aquoParOmschrijving'],
-                            'parDescription': uniqParCodeSerie['properties']['parDescription']})
-    uniqParList = sorted(uniqParList, key=itemgetter('aquoParOmschrijving'))  # sort alphabetically
+def generatePage(mongocursor, limit):
+    """
+    Write the documents of the cursor as one page: {"timeseries": [...], "resume": token}. The resume token is null
+    if this is the last page.
+    """
 
-    return json.dumps(uniqParList)
+    yield '{"timeseries": ['
+    separator = ''
+    nrRecords = 0
+    lastID = None
+    for record in timedCursor(mongocursor):
+        lastID = record.pop('_id')
+        nrRecords += 1
+        yield separator + timedDumps(record)
+        separator = ', '
 
+    resume = encodeResumeToken(lastID) if nrRecords == limit else None
+    yield '], "resume": ' + json.dumps(resume) + '}'
 
 
 @app.route('/avg', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*')
+@cachedResponse
 def getAverage():
     """
     get the timeseries average (including all additional information necessary to interpret the average) for a
-    combination of a location and parameter
+    combination of a location and parameter. With start and end, the averages of that period are computed from the
+    stored measurements.
     :return:
     """
 
-    searchList = []
+    if 'start' in request.args.keys() or 'end' in request.args.keys():
+        return getPeriodAverage(request.args)
+
+    searchDict = {}
 
     if 'parCode' in request.args.keys():
-        searchList.append({"properties.aquoParCode": request.args['parCode']})
+        searchDict["properties.aquoParCode"] = request.args['parCode']
 
     if 'locID' in request.args.keys():
-        searchList.append({"properties.locID": request.args['locID']})
+        searchDict["properties.locID"] = request.args['locID']
+
+    # optional spatial selection; the timeseries near a point are sorted by distance
+    try:
+        geometryQuery, sortedOnDistance = getGeometryQuery(request.args)
+    except ValueError as err:
+        return str(err), 400
+
+    if geometryQuery is not None:
+        searchDict["geometry"] = geometryQuery
+
+    if searchDict:
+
+        # optional projection, e.g. fields=-properties.EIData.normsForSubstanceStateCodeList to leave out the norms
+        projection = getProjection(request.args.get('fields', ''))
+        if projection is None:
+            return "Please give 'fields' as a comma separated list of fields to return, or of fields to leave out " \
+                   "with a '-' in front of each field", 400
+
+        # optional pagination: at most 'limit' timeseries, continuing after the 'resume' token of the previous page;
+        # also for a bbox selection, but not for the timeseries near a point, which are sorted on distance instead of
+        # on the mongoID
+        if 'resume' in request.args.keys() or ('limit' in request.args.keys() and not sortedOnDistance):
+            if sortedOnDistance:
+                return "Pagination with 'resume' is not possible for timeseries near a point", 400
+            try:
+                limit = int(request.args.get('limit', AVG_PAGE_MAX_LIMIT))
+                resumeID = decodeResumeToken(request.args['resume']) if 'resume' in request.args.keys() else None
+            except (ValueError, TypeError, bson.errors.InvalidId):
+                return "Please give an integer 'limit' and a 'resume' token from the previous page", 400
+            if limit < 1 or limit > AVG_PAGE_MAX_LIMIT:
+                return "Please give a 'limit' between 1 and " + str(AVG_PAGE_MAX_LIMIT), 400
+
+            if resumeID is not None:
+                searchDict["_id"] = {"$gt": resumeID}
+
+            # the mongoID is needed for the resume token and removed from the output; it is returned by default, but
+            # has to be named in a projection of fields to return
+            if 1 in projection.values():
+                projection['_id'] = 1
+            mongocursor = collection.find(searchDict, projection or None)
+            mongocursor = mongocursor.sort("_id", pymongo.ASCENDING).limit(limit)
+
+            return generatePage(mongocursor, limit)
+
+        projection['_id'] = 0   # remove mongoID, that should not be part of the output (and is not JSON Serializable)
+        mongocursor = collection.find(searchDict, projection)
+
+        # a spatial selection without pagination returns at most 'limit' (near) or SPATIAL_MAX_RESULTS timeseries
+        if geometryQuery is not None:
+            try:
+                mongocursor = mongocursor.limit(getSpatialLimit(request.args))
+            except ValueError as err:
+                return str(err), 400
+
+        return generateJSONList(timedCursor(mongocursor))
+
+    else:
+        return "Please give a parCode, a locID, a bbox and/or near as request parameters"
+
+
+def getPeriodAverage(args):
+    """
+    get the timeseries of a combination of a location and parameter with the statistics of each year and the multi-year
+    average of the period from 'start' to (not including) 'end', both dates as YYYY-MM-DD
+    :return: JSON list of the timeseries that have valid measurements in the period
+    """
+
+    if 'parCode' not in args.keys() or 'locID' not in args.keys():
+        return "Please give a parCode and a locID with 'start' and 'end'", 400
+
+    try:
+        startTime = datetime.strptime(args.get('start', ''), "%Y-%m-%d")
+        endTime = datetime.strptime(args.get('end', ''), "%Y-%m-%d")
+    except ValueError:
+        return "Please give 'start' and 'end' as dates (YYYY-MM-DD)", 400
+    if endTime <= startTime:
+        return "Please give an 'end' after 'start'", 400
+
+    features = list(timedCursor(collection.find({"properties.aquoParCode": args['parCode'],
+                                                 "properties.locID": args['locID']}, {'_id': 0})))
+
+    # the time of the aggregation pipeline is counted as MongoDB time
+    startTimer = timeit.default_timer()
+    periodFeatures = computePeriodAverages(db, "EIData", features, startTime, endTime)
+    addMongoTime(timeit.default_timer() - startTimer)
 
-    if searchList:
+    return timedDumps(periodFeatures)
 
-        searchDict = {} # potential for selecting a subset
-        searchDict["$and"] = searchList
 
-        mongocursor = collection.find(searchDict)
+@app.route('/avg/batch', methods=['POST', 'OPTIONS'])
+@crossdomain(origin='*', headers=['content-type'])
+def getAverageBatch():
+    """
+    get the timeseries averages for many combinations of a parameter and a location in one request.
+    The request body is JSON: {"pairs": [{"parCode": "...", "locID": "..."}, ...]}
+    :return: JSON object with for each pair the key parCode + "_" + locID and as value the list of timeseries, streamed
+    while the documents are read from MongoDB
+    """
+
+    requestJSON = request.get_json(force=True, silent=True)
+    if not isinstance(requestJSON, dict) or not isinstance(requestJSON.get('pairs'), list):
+        return 'Please give a JSON body with a list of "pairs", each with a "parCode" and a "locID"', 400
+
+    # unique pairs, in the order of the request
+    pairs = []
+    seenPairs = set()
+    for pair in requestJSON['pairs']:
+        if not isinstance(pair, dict) or not isinstance(pair.get('parCode'), basestring) or \
+                not isinstance(pair.get('locID'), basestring):
+            return 'Each pair should have a "parCode" and a "locID"', 400
+        if (pair['parCode'], pair['locID']) not in seenPairs:
+            seenPairs.add((pair['parCode'], pair['locID']))
+            pairs.append((pair['parCode'], pair['locID']))
+
+    if len(pairs) > AVG_BATCH_MAX_PAIRS:
+        return "Please give at most " + str(AVG_BATCH_MAX_PAIRS) + " pairs per request", 400
+
+    if not pairs:
+        return json.dumps({})
+
+    # one query for all pairs; sorted on the (aquoParCode, locID) index so the documents of a pair are consecutive
+    searchDict = {"$or": [{"properties.aquoParCode": parCode, "properties.locID": locID} for parCode, locID in pairs]}
+    mongocursor = collection.find(searchDict, {'_id': 0}).sort([("properties.aquoParCode", pymongo.ASCENDING),
+                                                                ("properties.locID", pymongo.ASCENDING)])
+
+    def generateResponse():
+        pairsWithData = set()
+        currentPair = None
+
+        yield '{'
+        for record in timedCursor(mongocursor):
+            pair = (record['properties']['aquoParCode'], record['properties']['locID'])
+            if pair != currentPair:
+                yield ('], ' if currentPair is not None else '') + json.dumps(pair[0] + "_" + pair[1]) + ': ['
+                currentPair = pair
+                pairsWithData.add(pair)
+            else:
+                yield ', '
+            yield timedDumps(record)
 
-        timeseries = []
-        for record in mongocursor:
-            del record['_id'] # remove mongoID, that should not be part of the output (and is not JSON Serializable)
-            timeseries.append(record)
+        # pairs without data get an empty list
+        pairsWithoutData = [json.dumps(parCode + "_" + locID) + ': []' for parCode, locID in pairs
+                            if (parCode, locID) not in pairsWithData]
+        if currentPair is not None:
+            yield ']' + (', ' if pairsWithoutData else '')
+        yield ', '.join(pairsWithoutData) + '}'
 
-        return json.dumps(timeseries)
+    return Response(stream_with_context(generateResponse()), mimetype='application/json')
 
+
+@app.route('/series', methods=['GET', 'OPTIONS'])
+@crossdomain(origin='*')
+@cachedResponse
+def getSeries():
+    """
+    get the valid measurements of a timeseries, which are stored separately from the averages: by the seriesID in the
+    yearData of /avg, or by parCode and locID with an optional year
+    :return: JSON list with the values and times (milliseconds since 1970-01-01 UTC) of each timeseries and year
+    """
+
+    if 'seriesID' in request.args.keys():
+        searchDict = {'_id': request.args['seriesID']}
+    elif 'parCode' in request.args.keys() and 'locID' in request.args.keys():
+        searchDict = {'aquoParCode': request.args['parCode'], 'locID': request.args['locID']}
+        if 'year' in request.args.keys():
+            try:
+                searchDict['year'] = int(request.args['year'])
+            except ValueError:
+                return "Please give the 'year' as an integer", 400
     else:
-        return "Please give a parCode and/or a locID as request parameters"
+        return "Please give a seriesID, or a parCode and a locID as request parameters", 400
+
+    mongocursor = seriesCollection.find(searchDict).sort([("aquoParCode", pymongo.ASCENDING),
+                                                          ("locID", pymongo.ASCENDING),
+                                                          ("year", pymongo.ASCENDING)])
+
+    return generateJSONList(decodeSeries(record) for record in timedCursor(mongocursor))
+
+
+@app.route('/cachestats', methods=['GET', 'OPTIONS'])
+@crossdomain(origin='*')
+def getCacheStats():
+    """
+    Get the hit, miss and eviction counters of the response cache
+    :return: JSON with the cache statistics
+    """
+
+    return json.dumps(responseCache.getStats())
+
+
+@app.route('/rivmstatus', methods=['GET', 'OPTIONS'])
+@crossdomain(origin='*')
+def getRIVMStatus():
+    """
+    Get the status of the refresh of the RIVM norm database: the duration of the last refresh, and the staleness of
+    the norm catalogue in use
+    :return: JSON with the refresh status
+    """
+
+    now = datetime.utcnow()
+    catalogue = normCatalogue
+
+    status = {
+        'lastCheck': RIVMStatus['lastCheck'].isoformat() if RIVMStatus['lastCheck'] else None,
+        'lastChange': RIVMStatus['lastChange'].isoformat() if RIVMStatus['lastChange'] else None,
+        'lastDuration': RIVMStatus['lastDuration'],
+        'lastError': RIVMStatus['lastError'],
+        'nrRefreshes': RIVMStatus['nrRefreshes'],
+        'nrErrors': RIVMStatus['nrErrors'],
+        'secondsSinceLastCheck': (now - RIVMStatus['lastCheck']).total_seconds() if RIVMStatus['lastCheck'] else None,
+        'catalogueLastModified': catalogue.lastModified.isoformat() if catalogue else None,
+        'catalogueAge': (now - catalogue.lastModified).total_seconds() if catalogue else None,
+        'nrSubstances': len(catalogue.substancesList) if catalogue else 0,
+        'nrNorms': len(catalogue.normsList) if catalogue else 0
+    }
+
+    return json.dumps(status)
+
+
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    """
+    Get the metrics of the data aansluitpunt for Prometheus: request counts and latencies per route, MongoDB time and
+    documents, serialization time, response bytes, the response cache and the age of the RIVM norm catalogue
+    :return: the metrics in the Prometheus text format
+    """
+
+    return Response(metricsRegistry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/admin/profiles', methods=['GET'])
+def listProfiles():
+    """
+    List the stored request profiles; needs the header X-EI-Profile with the profile_token
+    :return: JSON list with the descriptions of the profiles, newest first
+    """
+
+    if profileStore is None:
+        return "Profiling is not enabled", 404
+    if not hasProfileToken():
+        return "Please give the profile token in the " + PROFILE_HEADER + " header", 403
+
+    return json.dumps(profileStore.list())
+
+
+@app.route('/admin/profiles/<name>', methods=['GET'])
+def getProfile(name):
+    """
+    Download a request profile as a pstats file, or with format=text the functions with the highest cumulative time
+    (sort=tottime for the highest own time); needs the header X-EI-Profile with the profile_token
+    """
+
+    if profileStore is None:
+        return "Profiling is not enabled", 404
+    if not hasProfileToken():
+        return "Please give the profile token in the " + PROFILE_HEADER + " header", 403
+
+    fileName = profileStore.getFileName(name)
+    if fileName is None:
+        return "Profile " + name + " not found", 404
+
+    if request.args.get('format') == 'text':
+        sortKey = request.args.get('sort', 'cumulative')
+        if sortKey not in ('cumulative', 'tottime', 'ncalls'):
+            return "Please give 'sort' as cumulative, tottime or ncalls", 400
+        return Response(profileStore.getText(name, sortKey), content_type='text/plain; charset=utf-8')
+
+    return send_file(fileName, mimetype='application/octet-stream', as_attachment=True,
+                     attachment_filename=name + '.prof')
 
 
 # Shutdown the scheduler thread if the web process is stopped;
@@ -312,9 +1002,11 @@ atexit.register(lambda: sched.shutdown(wait=False))
 if __name__ == '__main__':
 
     # connect to database
-    client = pymongo.MongoClient(serverSelectionTimeoutMS=1)
+    client = pymongo.MongoClient(MONGODB_URI, serverSelectionTimeoutMS=1)
     db = client.EI_Toets
     collection = db["EIData"]
+    locationsCollection, parametersCollection = getSummaryCollections(db, "EIData")
+    seriesCollection = getSeriesCollection(db, "EIData")
 
     # test if connection to MongoDB works
     try:
@@ -324,11 +1016,18 @@ if __name__ == '__main__':
         print "Error in connecting or creating MongoDB collection; have you started MongoDB?"
         sys.exit()
 
+    # indexes for the searches on parameter, location and geometry; create_index does nothing if the index exists
+    createDataIndexes(db, "EIData")
+    createSummaryIndexes(db, "EIData")
+    createSeriesIndexes(db, "EIData")
+    createMeasurementIndexes(db, "EIData")
+
 
     # run the app with use_reloader=False to ensure that apscheduler is not run twice
+    port = int(getOptionalSetting('port', 5000))
     if app.config['DEVELOP']:
-        app.run(debug=True, use_reloader=False)                # DEVELOPMENT
+        app.run(debug=True, use_reloader=False, port=port)                # DEVELOPMENT
     else:
-        app.run(host='0.0.0.0', use_reloader=False)            # SERVER
+        app.run(host='0.0.0.0', use_reloader=False, port=port)            # SERVER
 
 
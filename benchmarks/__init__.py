@@ -0,0 +1,4 @@
+'''
+Benchmarks for the data aansluitpunt and the Compute_3YearAvg_DDL script. Run from the root of the repository, e.g.:
+python -m benchmarks.bench_norms
+'''
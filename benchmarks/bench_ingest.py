@@ -0,0 +1,178 @@
+'''
+Benchmark of the ingest of the Compute_3YearAvg_DDL script: time series per second, measurements per second and peak
+RSS, against local stand-ins of the DDL and the RIVM normendatabase (benchmarks.fakeserver) and a throwaway mongod
+(benchmarks.mongod). The scale of the synthetic data is set with the arguments; the results are written as JSON (see
+benchmarks.results for comparing two runs).
+
+python -m benchmarks.bench_ingest [--locations 100] [--parameters 50] [--parameters-per-location 10] [--series 2]
+    [--measurements 50] [--processes N] [--fetch-workers 8] [--mongod mongod] [--output ingest.json]
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import pymongo
+
+import Compute_3YearAvg_DDL as compute
+from ddlstream import getPeakRSS
+from benchmarks.synthetic import makeRIVMDict, makeCatalogusDict
+from benchmarks.fakeserver import FakeServer
+from benchmarks.mongod import ThrowawayMongod
+from benchmarks.results import writeResults
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+
+DATABASE_NAME = 'EI_Toets'
+COLLECTION_NAME = 'EIData'     # the collection of the data aansluitpunt, so bench_routes can use the ingested data
+
+
+def addScaleArguments(argParser):
+    """
+    Add the arguments for the scale of the synthetic data and of the ingest
+    """
+
+    argParser.add_argument('--substances', type=int, default=6000, help='number of synthetic RIVM substances')
+    argParser.add_argument('--norms', type=int, default=1000, help='number of synthetic RIVM norms')
+    argParser.add_argument('--locations', type=int, default=100, help='number of DDL locations')
+    argParser.add_argument('--parameters', type=int, default=50, help='number of DDL parameters')
+    argParser.add_argument('--parameters-per-location', type=int, default=10,
+                           help='number of parameters measured at each location')
+    argParser.add_argument('--series', type=int, default=2, help='number of time series in a waarnemingen response')
+    argParser.add_argument('--measurements', type=int, default=50, help='number of measurements per series per year')
+    argParser.add_argument('--processes', type=int, default=None,
+                           help='number of parse processes of the script; default the number of cores')
+    argParser.add_argument('--fetch-workers', type=int, default=8, help='number of concurrent DDL requests')
+    argParser.add_argument('--mongod', default='mongod', help='the mongod executable')
+
+
+def getScaleParameters(args):
+    return {'substances': args.substances, 'norms': args.norms, 'locations': args.locations,
+            'parameters': args.parameters, 'parametersPerLocation': args.parameters_per_location,
+            'series': args.series, 'measurements': args.measurements, 'processes': args.processes,
+            'fetchWorkers': args.fetch_workers}
+
+
+def makeFakeServer(args):
+    """
+    :return: the (started) FakeServer with the synthetic data of the scale arguments
+    """
+
+    fake = FakeServer(makeRIVMDict(args.substances, args.norms),
+                      makeCatalogusDict(args.locations, args.parameters, args.parameters_per_location),
+                      args.series, args.measurements)
+    fake.start()
+    return fake
+
+
+def getChildrenPeakRSS():
+    """
+    :return: the largest peak resident set size of the finished child processes (the parse processes) in MB; None if
+    it can not be measured on this platform
+    """
+
+    if resource is None:
+        return None
+
+    maxRSS = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return maxRSS / (1024.0 * 1024.0) if sys.platform == 'darwin' else maxRSS / 1024.0
+
+
+def countDocuments(collection, sumField=None):
+    """
+    :return: the number of documents of the collection, or the sum of a numeric field
+    """
+
+    result = list(collection.aggregate([{'$group': {'_id': None, 'n': {'$sum': '$' + sumField if sumField else 1}}}]))
+    return result[0]['n'] if result else 0
+
+
+def runIngest(fake, mongoUri, workDir, args):
+    """
+    Run the Compute_3YearAvg_DDL script against the stand-ins, for all parameter / location combinations
+    :param fake: the started FakeServer
+    :param mongoUri: the uri of the (throwaway) MongoDB
+    :param workDir: directory for the log, checkpoint and output of the script
+    :return: dict with the results
+    """
+
+    # the input parameters of the script
+    compute.RIVMNormDBUrl = fake.RIVMUrl
+    compute.RWS_Metadata_URL = fake.catalogusUrl
+    compute.RWS_Waarnemingen_URL = fake.waarnemingenUrl
+    compute.MONGO_DB_URI = mongoUri
+    compute.MONGO_DB_CLIENT = DATABASE_NAME
+    compute.MONGO_DB_COLLECTION = COLLECTION_NAME
+    compute.overwriteExistingCollection = True
+    compute.storeDDLFiles = False
+    compute.replayCacheMode = 'off'
+    compute.logFile = os.path.join(workDir, 'compute.log')
+    compute.checkpointFile = os.path.join(workDir, 'checkpoint.txt')
+    compute.nrRecords = sys.maxint
+    compute.nrFetchWorkers = args.fetch_workers
+    compute.maxRequestsPerSecond = 100000
+    compute.nrParseProcesses = args.processes
+
+    # the script prints a line per time series; it is written to a file, as it would be in production
+    stdout = sys.stdout
+    sys.stdout = open(os.path.join(workDir, 'compute.out'), 'w')
+    start = timeit.default_timer()
+    try:
+        compute.main()
+    finally:
+        elapsedTime = timeit.default_timer() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+        for handler in list(compute.logger.handlers):   # main() adds a file handler in each run
+            compute.logger.removeHandler(handler)
+            handler.close()
+
+    db = pymongo.MongoClient(mongoUri)[DATABASE_NAME]
+    nrSeries = countDocuments(db[COLLECTION_NAME])
+    nrMeasurements = countDocuments(db[COLLECTION_NAME + '_years'], 'yearData.totalNrMeas')
+    fetchStats = fake.getStats()
+
+    return {'seconds': elapsedTime,
+            'nrSeries': nrSeries,
+            'nrMeasurements': nrMeasurements,
+            'seriesPerSecond': nrSeries / elapsedTime,
+            'measurementsPerSecond': nrMeasurements / elapsedTime,
+            'nrRequests': fetchStats.get('nr_waarnemingen', 0),
+            'megabytesDownloaded': fetchStats.get('bytes_waarnemingen', 0) / (1024.0 * 1024.0),
+            'peakRSS': getPeakRSS(),
+            'peakRSSParseProcesses': getChildrenPeakRSS()}
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    addScaleArguments(argParser)
+    argParser.add_argument('--output', default='ingest.json', help='JSON file for the results')
+    args = argParser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='benchmark_ingest_')
+    fake = makeFakeServer(args)
+    try:
+        with ThrowawayMongod(args.mongod) as mongod:
+            results = runIngest(fake, mongod.uri, workDir, args)
+    finally:
+        fake.stop()
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    print "Ingest: %d series, %d measurements in %.1f s: %.1f series/s, %.0f measurements/s" % (
+        results['nrSeries'], results['nrMeasurements'], results['seconds'], results['seriesPerSecond'],
+        results['measurementsPerSecond'])
+    if results['peakRSS'] is not None:
+        print "Peak RSS: %.0f MB, parse processes: %.0f MB" % (results['peakRSS'], results['peakRSSParseProcesses'])
+
+    writeResults(args.output, 'ingest', getScaleParameters(args), results)
+    print "Results written to " + args.output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''
+Microbenchmark of the resolution of the norms and the calculation method (JGM, MAX, P90) of a time series in the
+Compute_3YearAvg_DDL script, at the full size of the RIVM norm catalogue.
+
+Compares the original scan over the substances and norms lists for each time series with the lookup in the norm
+resolution table. By default a synthetic catalogue is generated; use --rivm-file to benchmark with a downloaded
+RIVMNormDB.json.
+
+python -m benchmarks.bench_normresolution [--rivm-file RIVMNormDB.json] [--substances 6000] [--norms 1000]
+'''
+
+import argparse
+import json
+import random
+import timeit
+
+from normcatalogue import buildNormResolutionTable, resolveNorms
+from benchmarks.synthetic import makeRIVMDict, STATE_CODES
+from benchmarks.timing import timeLookups, report
+
+
+def legacyResolveNorms(parCode, hoedanigheidCode, substancesList, normsList):
+    """
+    The norm resolution of the Compute_3YearAvg_DDL script before the norm resolution table was introduced, kept as
+    reference for the benchmark
+    """
+
+    normIDList = []
+
+    for substance in substancesList:
+        if substance['aquoCode'] == parCode:
+            for norm in substance['norms']:
+                normIDList.append(norm['id'])
+
+    normsForSubstanceList = []
+    for normID in normIDList:
+        for norm in normsList:
+            if norm['id'] == normID:
+                normInfoDict = {}
+                normInfoDict['valueProcessingMethodCode'] = norm['valueProcessingMethodCode']
+                normInfoDict['valueProcessingMethodDescription'] = norm['valueProcessingMethodDescription']
+                normInfoDict['id'] = norm['id']
+                normInfoDict['stateCode'] = norm['stateCode']
+                normInfoDict['stateDescription'] = norm['stateDescription']
+                normInfoDict['normDescription'] = norm['normDescription']
+                normsForSubstanceList.append(normInfoDict)
+
+    normsForSubstanceStateCodeList = []
+    valueProcessingMethodCodeList = []
+    for normInfo in normsForSubstanceList:
+        if normInfo['stateCode'] == hoedanigheidCode:
+            normsForSubstanceStateCodeList.append(normInfo)
+            valueProcessingMethodCodeList.append(normInfo['valueProcessingMethodCode'])
+
+    if "JGM" in valueProcessingMethodCodeList:
+        valueProcessingMethodCode = "JGM"
+    elif "MAX" in valueProcessingMethodCodeList:
+        valueProcessingMethodCode = "MAX"
+    elif "P90" in valueProcessingMethodCodeList:
+        valueProcessingMethodCode = "P90"
+    else:
+        valueProcessingMethodCode = "Other"
+
+    return valueProcessingMethodCode, normsForSubstanceStateCodeList
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argParser.add_argument('--rivm-file', help='RIVM norm database (JSON); if not given a synthetic one is generated')
+    argParser.add_argument('--substances', type=int, default=6000, help='number of synthetic substances')
+    argParser.add_argument('--norms', type=int, default=1000, help='number of synthetic norms')
+    argParser.add_argument('--norms-per-substance', type=int, default=8, help='number of norms per synthetic substance')
+    argParser.add_argument('--lookups', type=int, default=200, help='number of time series to resolve')
+    args = argParser.parse_args()
+
+    if args.rivm_file:
+        with open(args.rivm_file) as RIVMDataFile:
+            RIVMDict = json.load(RIVMDataFile)
+    else:
+        RIVMDict = makeRIVMDict(args.substances, args.norms, args.norms_per_substance)
+
+    print "Catalogue: %d substances, %d norms" % (len(RIVMDict['substances']), len(RIVMDict['norms']))
+
+    start = timeit.default_timer()
+    normResolutionTable = buildNormResolutionTable(RIVMDict)
+    print "Norm resolution table build time: %.1f ms" % (1000 * (timeit.default_timer() - start))
+
+    stateCodes = sorted(set(norm['stateCode'] for norm in RIVMDict['norms'])) or STATE_CODES
+    rnd = random.Random(3)
+    keys = [(rnd.choice(RIVMDict['substances'])['aquoCode'], rnd.choice(stateCodes)) for i in range(args.lookups)]
+
+    # check that both implementations give the same result
+    for parCode, stateCode in keys[:20]:
+        assert legacyResolveNorms(parCode, stateCode, RIVMDict['substances'], RIVMDict['norms']) == \
+            resolveNorms(normResolutionTable, parCode, stateCode)
+
+    report('linear scan', timeLookups(lambda key: legacyResolveNorms(key[0], key[1], RIVMDict['substances'],
+                                                                     RIVMDict['norms']), keys))
+    report('table', timeLookups(lambda key: resolveNorms(normResolutionTable, key[0], key[1]), keys))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Benchmark of the /norms?parCode= lookup at the full size of the RIVM norm catalogue.
+
+Compares the original linear scan over the substances and norms lists with the indexed NormCatalogue. By default a
+synthetic catalogue is generated; use --rivm-file to benchmark with a downloaded RIVMNormDB.json.
+
+python -m benchmarks.bench_norms [--rivm-file RIVMNormDB.json] [--substances 6000] [--norms 1000] [--lookups 200]
+'''
+
+import argparse
+import json
+import random
+import timeit
+
+from normcatalogue import NormCatalogue
+from benchmarks.synthetic import makeRIVMDict
+from benchmarks.timing import timeLookups, report
+
+
+def legacyGetNorms(parCode, substancesList, normsList):
+    """
+    The /norms?parCode= implementation before the NormCatalogue was introduced, kept as reference for the benchmark
+    """
+
+    allInfo = {}
+    normsForSubstance = []
+
+    for substance in substancesList:
+        if substance['aquoCode'] == parCode:
+
+            allInfo['aquoCode'] = substance['aquoCode']
+            allInfo['name'] = substance['name']
+            allInfo['englishName'] = substance['englishName']
+            allInfo['casNumber'] = substance['casNumber']
+            allInfo['hasZzsEntry'] = substance['hasZzsEntry']
+
+            for norm in substance['norms']:
+                normData = {}
+                normData['value'] = norm['value']
+                normID = norm['id']
+                normInfo = {}
+
+                for norm in normsList:
+                    if norm['id'] == normID:
+                        for field in ['id', 'description', 'compartmentName', 'categoryDescription', 'normCode',
+                                      'normDescription', 'normSubgroupCode', 'normSubgroupDescription',
+                                      'compartmentCode', 'compartmentDescription', 'compartmentSubgroupCode',
+                                      'compartmentSubgroupDescription', 'quantityCode', 'quantityDescription',
+                                      'stateCode', 'stateDescription', 'valueProcessingMethodCode',
+                                      'valueProcessingMethodDescription']:
+                            normInfo[field] = norm[field]
+
+                normData['info'] = normInfo
+                normsForSubstance.append(normData)
+
+    allInfo['norms'] = normsForSubstance
+
+    return json.dumps(allInfo)
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argParser.add_argument('--rivm-file', help='RIVM norm database (JSON); if not given a synthetic one is generated')
+    argParser.add_argument('--substances', type=int, default=6000, help='number of synthetic substances')
+    argParser.add_argument('--norms', type=int, default=1000, help='number of synthetic norms')
+    argParser.add_argument('--norms-per-substance', type=int, default=8, help='number of norms per synthetic substance')
+    argParser.add_argument('--lookups', type=int, default=200, help='number of parCode lookups to time')
+    args = argParser.parse_args()
+
+    if args.rivm_file:
+        with open(args.rivm_file) as RIVMDataFile:
+            RIVMDict = json.load(RIVMDataFile)
+    else:
+        RIVMDict = makeRIVMDict(args.substances, args.norms, args.norms_per_substance)
+
+    print "Catalogue: %d substances, %d norms" % (len(RIVMDict['substances']), len(RIVMDict['norms']))
+
+    start = timeit.default_timer()
+    catalogue = NormCatalogue(RIVMDict)
+    print "Catalogue build time: %.1f ms" % (1000 * (timeit.default_timer() - start))
+
+    rnd = random.Random(2)
+    parCodes = [rnd.choice(RIVMDict['substances'])['aquoCode'] for i in range(args.lookups)]
+
+    # check that both implementations give the same response
+    for parCode in parCodes[:10]:
+        assert json.loads(legacyGetNorms(parCode, RIVMDict['substances'], RIVMDict['norms'])) == \
+            json.loads(catalogue.getNormsResponse(parCode))
+
+    report('linear scan', timeLookups(lambda parCode: legacyGetNorms(parCode, RIVMDict['substances'], RIVMDict['norms']), parCodes))
+    report('catalogue', timeLookups(catalogue.getNormsResponse, parCodes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+'''
+Benchmark of the latency (p50, p95, p99) of each route of the data aansluitpunt under concurrent load.
+
+The data is ingested with the Compute_3YearAvg_DDL script (see benchmarks.bench_ingest) into a throwaway mongod, and
+app.py is started as a separate process against it, with the RIVM normendatabase of benchmarks.fakeserver. For each
+route, a number of client threads send requests with parameters drawn from the ingested data; the response cache of the
+data aansluitpunt is in use, as in production. Request profiling is enabled with a token, so /admin/profiles is
+measured too, and avg_profiled measures /avg with the profiling header; the other requests are not profiled. The results
+are written as JSON (see benchmarks.results for comparing two runs).
+
+python -m benchmarks.bench_routes [scale arguments of bench_ingest] [--concurrency 8] [--requests 400]
+    [--output routes.json]
+'''
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import pymongo
+import requests
+
+from benchmarks.bench_ingest import addScaleArguments, getScaleParameters, makeFakeServer, runIngest, \
+    DATABASE_NAME, COLLECTION_NAME
+from benchmarks.mongod import ThrowawayMongod, getFreePort
+from benchmarks.results import writeResults
+from benchmarks.timing import percentile, report
+
+
+APP_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+PROFILE_TOKEN = 'benchmark'
+PROFILE_HEADERS = {'X-EI-Profile': PROFILE_TOKEN}
+
+
+def startApp(workDir, mongoUri, RIVMUrl, startTimeout=120):
+    """
+    Start the data aansluitpunt in a separate process, with a config.ini in the work directory, and wait until it has
+    loaded the RIVM normendatabase
+    :return: tuple (the process, the base url)
+    """
+
+    port = getFreePort()
+    with open(os.path.join(workDir, 'config.ini'), 'w') as fo:
+        fo.write("[SectionOne]\nsecret_key: benchmark\ndevelop: False\nmongodb_uri: %s\nrivm_norm_db_url: %s\n"
+                 "port: %d\nprofile_dir: %s\nprofile_token: %s\n" %
+                 (mongoUri, RIVMUrl, port, os.path.join(workDir, 'profiles'), PROFILE_TOKEN))
+
+    logFile = open(os.path.join(workDir, 'app.log'), 'w')
+    process = subprocess.Popen([sys.executable, APP_FILE], cwd=workDir, stdout=logFile, stderr=subprocess.STDOUT)
+    logFile.close()
+    baseUrl = 'http://127.0.0.1:%d' % port
+
+    deadline = time.time() + startTimeout
+    while True:
+        try:
+            if requests.get(baseUrl + '/rivmstatus', timeout=5).json()['lastCheck'] is not None:
+                return process, baseUrl
+        except (requests.RequestException, ValueError, KeyError):
+            pass
+        if process.poll() is not None or time.time() > deadline:
+            stopApp(process)
+            raise RuntimeError("The data aansluitpunt did not start; see app.log")
+        time.sleep(0.5)
+
+
+def stopApp(process):
+    if process.poll() is None:
+        process.terminate()
+        process.wait()
+
+
+def getRouteRequests(db):
+    """
+    :return: list of (route name, function(rnd) that returns the (method, path, body, headers) of a request), for each
+    route of the data aansluitpunt except the download of a profile (/admin/profiles/<name>); the parameters of the
+    requests are drawn from the ingested data
+    """
+
+    collection = db[COLLECTION_NAME]
+    pairs = [(record['properties']['aquoParCode'], record['properties']['locID'], record['geometry']['coordinates'])
+             for record in collection.find({}, {'properties.aquoParCode': 1, 'properties.locID': 1, 'geometry': 1})]
+    if not pairs:
+        raise RuntimeError("No time series were ingested")
+    parCodes = sorted(set(parCode for parCode, locID, coordinates in pairs))
+
+    def pair(rnd):
+        return rnd.choice(pairs)
+
+    def bbox(rnd):
+        lon, lat = pair(rnd)[2]
+        return "%f,%f,%f,%f" % (lon - 0.2, lat - 0.1, lon + 0.2, lat + 0.1)
+
+    def near(rnd):
+        lon, lat = pair(rnd)[2]
+        return "%f,%f" % (lon, lat)
+
+    def batchBody(rnd):
+        return json.dumps({'pairs': [{'parCode': parCode, 'locID': locID}
+                                     for parCode, locID, coordinates in rnd.sample(pairs, min(50, len(pairs)))]})
+
+    def get(path, headers=None):
+        return 'GET', path, None, headers
+
+    return [
+        ('index', lambda rnd: get('/')),
+        ('norms', lambda rnd: get('/norms?parCode=' + rnd.choice(parCodes))),
+        ('norms_all', lambda rnd: get('/norms')),
+        ('locations', lambda rnd: get('/locations?parCode=' + rnd.choice(parCodes))),
+        ('locations_bbox', lambda rnd: get('/locations?bbox=' + bbox(rnd))),
+        ('parameters', lambda rnd: get('/parameters')),
+        ('avg', lambda rnd: get('/avg?parCode=%s&locID=%s' % pair(rnd)[:2])),
+        ('avg_near', lambda rnd: get('/avg?near=' + near(rnd) + '&maxDistance=20000')),
+        ('avg_page', lambda rnd: get('/avg?parCode=' + rnd.choice(parCodes) + '&limit=100')),
+        ('avg_bbox_page', lambda rnd: get('/avg?bbox=' + bbox(rnd) + '&limit=100')),
+        ('avg_period', lambda rnd: get('/avg?parCode=%s&locID=%s&start=2013-01-01&end=2015-01-01' % pair(rnd)[:2])),
+        ('avg_profiled', lambda rnd: get('/avg?parCode=%s&locID=%s' % pair(rnd)[:2], PROFILE_HEADERS)),
+        ('avg_batch', lambda rnd: ('POST', '/avg/batch', batchBody(rnd), {'content-type': 'application/json'})),
+        ('series', lambda rnd: get('/series?parCode=%s&locID=%s' % pair(rnd)[:2])),
+        ('cachestats', lambda rnd: get('/cachestats')),
+        ('rivmstatus', lambda rnd: get('/rivmstatus')),
+        ('metrics', lambda rnd: get('/metrics')),
+        ('admin_profiles', lambda rnd: get('/admin/profiles', PROFILE_HEADERS)),
+    ]
+
+
+def runLoad(baseUrl, makeRequest, nrRequests, concurrency, seed):
+    """
+    Send nrRequests requests with concurrency client threads, each with its own keep-alive session
+    :param makeRequest: function(rnd) that returns the (method, path, body, headers) of a request
+    :return: tuple (sorted list of the latencies in seconds, number of errors, wall clock time in seconds)
+    """
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [nrRequests]
+
+    def client(clientID):
+        rnd = random.Random(seed * 1000 + clientID)
+        session = requests.Session()
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    break
+                remaining[0] -= 1
+            method, path, body, headers = makeRequest(rnd)
+            start = timeit.default_timer()
+            try:
+                r = session.request(method, baseUrl + path, data=body, timeout=60, headers=headers)
+                r.content   # the response is streamed by some routes; the latency includes the whole body
+                ok = r.status_code == 200
+            except requests.RequestException:
+                ok = False
+            latency = timeit.default_timer() - start
+            with lock:
+                latencies.append(latency)
+                if not ok:
+                    errors[0] += 1
+        session.close()
+
+    start = timeit.default_timer()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sorted(latencies), errors[0], timeit.default_timer() - start
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    addScaleArguments(argParser)
+    argParser.add_argument('--concurrency', type=int, default=8, help='number of concurrent clients')
+    argParser.add_argument('--requests', type=int, default=400, help='number of requests per route')
+    argParser.add_argument('--output', default='routes.json', help='JSON file for the results')
+    args = argParser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='benchmark_routes_')
+    fake = makeFakeServer(args)
+    results = {}
+
+    try:
+        with ThrowawayMongod(args.mongod) as mongod:
+            print "Ingesting the synthetic data"
+            results['ingest'] = runIngest(fake, mongod.uri, workDir, args)
+
+            process, baseUrl = startApp(workDir, mongod.uri, fake.RIVMUrl)
+            try:
+                db = pymongo.MongoClient(mongod.uri)[DATABASE_NAME]
+                for name, makeRequest in getRouteRequests(db):
+                    latencies, nrErrors, elapsedTime = runLoad(baseUrl, makeRequest, args.requests, args.concurrency, 1)
+                    report(name, latencies)
+                    results[name] = {'nrRequests': len(latencies),
+                                     'nrErrors': nrErrors,
+                                     'requestsPerSecond': len(latencies) / elapsedTime,
+                                     'mean': sum(latencies) / len(latencies),
+                                     'p50': percentile(latencies, 50),
+                                     'p95': percentile(latencies, 95),
+                                     'p99': percentile(latencies, 99)}
+                    if nrErrors:
+                        print "%-12s %d errors" % (name, nrErrors)
+            finally:
+                stopApp(process)
+    finally:
+        fake.stop()
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    parameters = getScaleParameters(args)
+    parameters.update({'concurrency': args.concurrency, 'requests': args.requests})
+    writeResults(args.output, 'routes', parameters, results)
+    print "Results written to " + args.output
+
+
+if __name__ == '__main__':
+    main()
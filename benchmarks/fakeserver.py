@@ -0,0 +1,153 @@
+'''
+Local HTTP stand-in of the DDL (OphalenCatalogus and OphalenWaarnemingen) and of the RIVM normendatabase
+(SubtanceNormValues), serving the synthetic data of benchmarks.synthetic, so the Compute_3YearAvg_DDL script and the
+data aansluitpunt can be benchmarked without network access and with the same data in each run.
+
+server = FakeServer(RIVMDict, catalogusDict, seriesPerRequest=2, measurementsPerYear=50)
+server.start()
+... server.RIVMUrl, server.catalogusUrl, server.waarnemingenUrl ...
+server.stop()
+'''
+
+import hashlib
+import json
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from benchmarks.synthetic import makeWaarnemingenDict
+
+
+RIVM_PATH = '/zoeksysteem/Data/SubtanceNormValues'
+CATALOGUS_PATH = '/METADATASERVICES_DBO/OphalenCatalogus/'
+WAARNEMINGEN_PATH = '/ONLINEWAARNEMINGENSERVICES_DBO/OphalenWaarnemingen/'
+
+RIVM_LAST_MODIFIED = 'Mon, 01 Jan 2018 00:00:00 GMT'
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class FakeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles the requests of one connection; the data is in the FakeServer (self.server.fake)
+    """
+
+    protocol_version = 'HTTP/1.1'   # keep-alive, as the DDL and the requests sessions of the clients
+
+    def do_GET(self):
+        fake = self.server.fake
+
+        if self.path.split('?')[0] != RIVM_PATH:
+            self.sendBody(404, 'Not found')
+            return
+
+        if self.headers.get('If-None-Match') == fake.RIVMETag:
+            fake.count('rivmNotModified')
+            self.sendBody(304, '')
+            return
+
+        fake.count('rivm', len(fake.RIVMString))
+        self.sendBody(200, fake.RIVMString, {'ETag': fake.RIVMETag, 'Last-Modified': RIVM_LAST_MODIFIED})
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.path == CATALOGUS_PATH:
+            fake.count('catalogus', len(fake.catalogusString))
+            self.sendBody(200, fake.catalogusString)
+        elif self.path == WAARNEMINGEN_PATH:
+            try:
+                requestDict = json.loads(body)
+            except ValueError:
+                self.sendBody(400, 'Invalid JSON')
+                return
+            response = json.dumps(makeWaarnemingenDict(requestDict, fake.seriesPerRequest, fake.measurementsPerYear,
+                                                       fake.seed))
+            fake.count('waarnemingen', len(response))
+            self.sendBody(200, response)
+        else:
+            self.sendBody(404, 'Not found')
+
+    def sendBody(self, statusCode, body, headers=None):
+        self.send_response(statusCode)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # no line per request on stderr
+
+
+class FakeServer(object):
+    """
+    Threaded HTTP server on localhost (a free port) with the synthetic DDL and RIVM data
+    """
+
+    def __init__(self, RIVMDict, catalogusDict, seriesPerRequest=2, measurementsPerYear=50, seed=1):
+        """
+        :param RIVMDict: the RIVM norm database (benchmarks.synthetic.makeRIVMDict)
+        :param catalogusDict: the DDL metadata catalogue (benchmarks.synthetic.makeCatalogusDict)
+        :param seriesPerRequest, measurementsPerYear, seed: see benchmarks.synthetic.makeWaarnemingenDict
+        """
+
+        self.RIVMString = json.dumps(RIVMDict)
+        self.RIVMETag = '"' + hashlib.sha1(self.RIVMString).hexdigest() + '"'
+        self.catalogusString = json.dumps(catalogusDict)
+        self.seriesPerRequest = seriesPerRequest
+        self.measurementsPerYear = measurementsPerYear
+        self.seed = seed
+
+        self.httpServer = None
+        self.thread = None
+        self.statsLock = threading.Lock()
+        self.stats = {}
+
+    def start(self):
+        self.httpServer = ThreadedHTTPServer(('127.0.0.1', 0), FakeRequestHandler)
+        self.httpServer.fake = self
+        self.thread = threading.Thread(target=self.httpServer.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.httpServer is not None:
+            self.httpServer.shutdown()
+            self.httpServer.server_close()
+            self.httpServer = None
+
+    @property
+    def baseUrl(self):
+        return 'http://127.0.0.1:%d' % self.httpServer.server_address[1]
+
+    @property
+    def RIVMUrl(self):
+        return self.baseUrl + RIVM_PATH
+
+    @property
+    def catalogusUrl(self):
+        return self.baseUrl + CATALOGUS_PATH
+
+    @property
+    def waarnemingenUrl(self):
+        return self.baseUrl + WAARNEMINGEN_PATH
+
+    def count(self, name, nrBytes=0):
+        with self.statsLock:
+            self.stats['nr_' + name] = self.stats.get('nr_' + name, 0) + 1
+            self.stats['bytes_' + name] = self.stats.get('bytes_' + name, 0) + nrBytes
+
+    def getStats(self):
+        """
+        :return: dict with the number of requests and bytes sent of each service
+        """
+
+        with self.statsLock:
+            return dict(self.stats)
@@ -0,0 +1,108 @@
+'''
+Throwaway local MongoDB server for the benchmarks: a mongod on a free port with its data in a temporary directory,
+which is removed when the server is stopped. The benchmarks never touch the MongoDB of the data aansluitpunt.
+The log of mongod is written next to the data directory, and is kept if mongod does not start.
+'''
+
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import pymongo
+
+
+def getFreePort():
+    """
+    :return: a TCP port on localhost that is not in use
+    """
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def getTail(fileName, nrLines=20):
+    """
+    :return: the last lines of a text file
+    """
+
+    with open(fileName) as fi:
+        return ''.join(fi.readlines()[-nrLines:])
+
+
+class ThrowawayMongod(object):
+    """
+    mongod process with a temporary data directory
+    """
+
+    def __init__(self, mongodPath='mongod', startTimeout=30):
+        """
+        :param mongodPath: the mongod executable
+        :param startTimeout: max number of seconds to wait for the server to accept connections
+        """
+
+        self.mongodPath = mongodPath
+        self.startTimeout = startTimeout
+        self.dbPath = None
+        self.port = None
+        self.process = None
+        self.logFile = None
+        self.logFileName = None
+
+    @property
+    def uri(self):
+        return 'mongodb://127.0.0.1:%d' % self.port
+
+    def start(self):
+        self.dbPath = tempfile.mkdtemp(prefix='benchmark_mongod_')
+        self.port = getFreePort()
+        fd, self.logFileName = tempfile.mkstemp(prefix='benchmark_mongod_', suffix='.log')
+        self.logFile = os.fdopen(fd, 'w')
+        self.process = subprocess.Popen([self.mongodPath, '--dbpath', self.dbPath, '--port', str(self.port),
+                                         '--bind_ip', '127.0.0.1'], stdout=self.logFile, stderr=subprocess.STDOUT)
+
+        client = pymongo.MongoClient(self.uri, serverSelectionTimeoutMS=500)
+        deadline = time.time() + self.startTimeout
+        while True:
+            try:
+                client.server_info()
+                break
+            except pymongo.errors.ServerSelectionTimeoutError:
+                if self.process.poll() is not None or time.time() > deadline:
+                    logFileName = self.logFileName
+                    self.stop(keepLog=True)
+                    raise RuntimeError("mongod did not start; the log of mongod is kept in %s, it ends with:\n%s" %
+                                       (logFileName, getTail(logFileName)))
+        client.close()
+
+    def stop(self, keepLog=False):
+        """
+        Stop mongod and remove its data directory and (unless keepLog) its log
+        """
+
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                self.process.wait()
+            self.process = None
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
+        if self.dbPath is not None:
+            shutil.rmtree(self.dbPath, ignore_errors=True)
+            self.dbPath = None
+        if self.logFileName is not None:
+            if not keepLog and os.path.exists(self.logFileName):
+                os.remove(self.logFileName)
+            self.logFileName = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *excInfo):
+        self.stop()
@@ -0,0 +1,102 @@
+'''
+JSON results of the benchmarks, so the results of two runs can be compared:
+
+python -m benchmarks.results old.json new.json
+'''
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime
+
+
+def getGitCommit():
+    """
+    :return: the commit of the repository that is benchmarked, or None if git is not available
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def writeResults(fileName, benchmark, parameters, results):
+    """
+    Write the results of a benchmark as JSON, with the parameters and the environment of the run
+    :param benchmark: name of the benchmark
+    :param parameters: dict with the parameters of the benchmark (e.g. the scale of the synthetic data)
+    :param results: dict with the results; a nested dict of numbers
+    """
+
+    output = {'benchmark': benchmark,
+              'time': datetime.utcnow().isoformat() + 'Z',
+              'commit': getGitCommit(),
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'parameters': parameters,
+              'results': results}
+
+    with open(fileName, 'w') as fo:
+        json.dump(output, fo, indent=2, sort_keys=True)
+
+
+def flatten(results, prefix=''):
+    """
+    :return: dict with the dotted name -> value of the numbers in the nested results
+    """
+
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+
+    return flat
+
+
+def compareResults(oldFileName, newFileName):
+    """
+    Print the results of two runs of a benchmark side by side, with the relative change
+    """
+
+    with open(oldFileName) as fi:
+        old = json.load(fi)
+    with open(newFileName) as fi:
+        new = json.load(fi)
+
+    if old['parameters'] != new['parameters']:
+        print "Warning: the runs have different parameters"
+
+    oldResults = flatten(old['results'])
+    newResults = flatten(new['results'])
+
+    print "%-50s %14s %14s %9s" % (old['benchmark'], (old['commit'] or 'old')[:10], (new['commit'] or 'new')[:10], 'change')
+    for name in sorted(set(oldResults) | set(newResults)):
+        oldValue = oldResults.get(name)
+        newValue = newResults.get(name)
+        if oldValue is not None and newValue is not None and oldValue != 0:
+            change = "%+8.1f%%" % (100.0 * (newValue - oldValue) / abs(oldValue))
+        else:
+            change = ''
+        print "%-50s %14s %14s %9s" % (name, formatValue(oldValue), formatValue(newValue), change)
+
+
+def formatValue(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '%.4g' % value
+    return str(value)
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Compare the JSON results of two runs of a benchmark')
+    argParser.add_argument('old')
+    argParser.add_argument('new')
+    args = argParser.parse_args()
+
+    compareResults(args.old, args.new)
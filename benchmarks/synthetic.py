@@ -0,0 +1,174 @@
+'''
+Generators of synthetic data with the same structure as the data sources used by the data aansluitpunt, so benchmarks
+can run at a realistic scale without access to the RIVM normendatabase or the DDL.
+'''
+
+import random
+from datetime import datetime, timedelta
+
+
+STATE_CODES = ['NVT', 'Opgelost', 'Totaal', 'Nopgelst']
+VALUE_PROCESSING_METHOD_CODES = ['JGM', 'MAX', 'P90', 'Other']
+
+
+def makeRIVMDict(nrSubstances=6000, nrNorms=1000, normsPerSubstance=8, seed=1):
+    """
+    Create a RIVM norm database with the structure of https://rvs.rivm.nl/zoeksysteem/Data/SubtanceNormValues
+    :param nrSubstances: number of substances
+    :param nrNorms: number of distinct norms
+    :param normsPerSubstance: number of norm values per substance
+    :param seed: seed of the random generator, so the same database is generated in each run
+    :return: dict with the keys 'norms' and 'substances'
+    """
+
+    rnd = random.Random(seed)
+
+    normsList = []
+    for i in range(nrNorms):
+        normsList.append({
+            'id': i,
+            'description': 'Norm description ' + str(i),
+            'compartmentName': 'Oppervlaktewater',
+            'categoryDescription': 'Category ' + str(i % 20),
+            'normCode': 'N' + str(i),
+            'normDescription': 'Normomschrijving ' + str(i),
+            'normSubgroupCode': 'SG' + str(i % 50),
+            'normSubgroupDescription': 'Subgroup ' + str(i % 50),
+            'compartmentCode': 'OW',
+            'compartmentDescription': 'Oppervlaktewater',
+            'compartmentSubgroupCode': 'ZOET',
+            'compartmentSubgroupDescription': 'Zoet oppervlaktewater',
+            'quantityCode': 'CONCTTE',
+            'quantityDescription': 'Concentratie',
+            'stateCode': STATE_CODES[i % len(STATE_CODES)],
+            'stateDescription': 'State ' + STATE_CODES[i % len(STATE_CODES)],
+            'valueProcessingMethodCode': VALUE_PROCESSING_METHOD_CODES[i % len(VALUE_PROCESSING_METHOD_CODES)],
+            'valueProcessingMethodDescription': 'Method ' + VALUE_PROCESSING_METHOD_CODES[i % len(VALUE_PROCESSING_METHOD_CODES)]
+        })
+
+    substancesList = []
+    for i in range(nrSubstances):
+        norms = []
+        for normID in rnd.sample(range(nrNorms), min(normsPerSubstance, nrNorms)):
+            norms.append({'id': normID, 'value': round(rnd.uniform(0.001, 100.0), 4)})
+
+        substancesList.append({
+            'aquoCode': aquoCode(i),
+            'name': 'Stof ' + str(i),
+            'englishName': 'Substance ' + str(i),
+            'casNumber': str(10000 + i) + '-00-0',
+            'hasZzsEntry': i % 7 == 0,
+            'norms': norms
+        })
+
+    return {'norms': normsList, 'substances': substancesList}
+
+
+def aquoCode(i):
+    """
+    :param i: sequence number of a substance
+    :return: the synthetic aquo code of the substance
+    """
+
+    return 'S' + str(i).zfill(5)
+
+
+# hoedanigheden of the synthetic waarnemingen; these are states of the synthetic norms (STATE_CODES), so each method
+# (JGM, MAX, P90, Other) occurs
+HOEDANIGHEID_CODES = STATE_CODES
+
+
+def makeCatalogusDict(nrLocations=100, nrParameters=50, parametersPerLocation=10, seed=1):
+    """
+    Create a metadata catalogue with the structure of the response of the DDL OphalenCatalogus service; the parameters
+    are substances of makeRIVMDict (the aquoCode of substance i), and one in ten is not a concentration (CONCTTE)
+    :param nrLocations: number of locations
+    :param nrParameters: number of parameters
+    :param parametersPerLocation: number of parameters measured at each location
+    :param seed: seed of the random generator
+    :return: dict with the keys 'AquoMetadataLijst', 'LocatieLijst' and 'AquoMetadataLocatieLijst'
+    """
+
+    rnd = random.Random(seed)
+
+    aquoMetadataLijst = []
+    for i in range(nrParameters):
+        aquoMetadataLijst.append({
+            'AquoMetadata_MessageID': i,
+            'Parameter': {'Code': aquoCode(i), 'Omschrijving': 'Stof ' + str(i)},
+            'Parameter_Wat_Omschrijving': 'Stof ' + str(i) + ' in oppervlaktewater',
+            'Grootheid': {'Code': 'CONCTTE' if i % 10 != 9 else 'T', 'Omschrijving': 'Concentratie'}
+        })
+
+    locatieLijst = []
+    for i in range(nrLocations):
+        # EPSG 25831 coordinates in the Netherlands
+        locatieLijst.append({
+            'Locatie_MessageID': i,
+            'Code': 'LOC' + str(i).zfill(4),
+            'Naam': 'Locatie ' + str(i),
+            'X': round(rnd.uniform(520000.0, 760000.0), 3),
+            'Y': round(rnd.uniform(5600000.0, 5920000.0), 3),
+            'Coordinatenstelsel': '25831'
+        })
+
+    aquoMetadataLocatieLijst = []
+    for i in range(nrLocations):
+        for parameterID in rnd.sample(range(nrParameters), min(parametersPerLocation, nrParameters)):
+            aquoMetadataLocatieLijst.append({'AquoMetaData_MessageID': parameterID, 'Locatie_MessageID': i})
+
+    return {'Succesvol': True, 'AquoMetadataLijst': aquoMetadataLijst, 'LocatieLijst': locatieLijst,
+            'AquoMetadataLocatieLijst': aquoMetadataLocatieLijst}
+
+
+def makeWaarnemingenDict(requestDict, seriesPerRequest=2, measurementsPerYear=50, seed=1):
+    """
+    Create a response of the DDL OnlineWaarnemingenService to a request of the Compute_3YearAvg_DDL script: time series
+    of the requested parameter at the requested location, with measurements in the years of the requested period. The
+    response is the same for the same request and seed. Some of the measurements are invalid (quality code, reference
+    plane) or have a limit symbol.
+    :param requestDict: the request, with the parameter code, the location code and the period
+    :param seriesPerRequest: number of time series (WaarnemingenLijst items); each has another hoedanigheid
+    :param measurementsPerYear: number of measurements per year of each time series
+    :return: dict with the keys 'Succesvol' and 'WaarnemingenLijst'
+    """
+
+    parCode = requestDict['AquoPlusWaarnemingMetadata']['AquoMetadata']['Parameter']['Code']
+    locCode = requestDict['Locatie']['Code']
+    startYear = int(requestDict['Periode']['Begindatumtijd'][:4])
+    endTime = requestDict['Periode']['Einddatumtijd']
+    endYear = int(endTime[:4]) if endTime[5:10] != '01-01' else int(endTime[:4]) - 1
+
+    rnd = random.Random(str(seed) + parCode + locCode + requestDict['Periode']['Begindatumtijd'] + endTime)
+
+    waarnemingenLijst = []
+    for i in range(seriesPerRequest):
+        hoedanigheidCode = HOEDANIGHEID_CODES[i % len(HOEDANIGHEID_CODES)]
+        metingenLijst = []
+        for year in range(startYear, endYear + 1):
+            for j in range(measurementsPerYear):
+                tijdstip = datetime(year, 1, 1) + timedelta(days=j * 365 // measurementsPerYear,
+                                                            minutes=rnd.randint(0, 24 * 60 - 1))
+                meetwaarde = {'Waarde_Numeriek': round(rnd.lognormvariate(0.0, 1.0), 4)}
+                if rnd.random() < 0.1:
+                    meetwaarde['Waarde_Limietsymbool'] = '<'
+                metingenLijst.append({
+                    'Tijdstip': tijdstip.strftime("%Y-%m-%dT%H:%M:%S.000+01:00"),
+                    'Meetwaarde': meetwaarde,
+                    'WaarnemingMetadata': {'KwaliteitswaardecodeLijst': ['00' if rnd.random() < 0.95 else '99'],
+                                           'ReferentievlakLijst': ['WATSGL' if rnd.random() < 0.95 else 'NAP']}
+                })
+
+        waarnemingenLijst.append({
+            'AquoMetadata': {'BemonsteringsSoort': {'Code': '2', 'Omschrijving': 'Steekmonster'},
+                             'Compartiment': {'Code': 'OW', 'Omschrijving': 'Oppervlaktewater'},
+                             'Hoedanigheid': {'Code': hoedanigheidCode,
+                                              'Omschrijving': 'Hoedanigheid ' + hoedanigheidCode},
+                             'Eenheid': {'Code': 'ug/l', 'Omschrijving': 'microgram per liter'},
+                             'Grootheid': {'Code': 'CONCTTE', 'Omschrijving': 'Concentratie'},
+                             'Parameter': {'Code': parCode}},
+            'Locatie': {'Code': locCode},
+            'MetingenLijst': metingenLijst
+        })
+
+    return {'Succesvol': True, 'WaarnemingenLijst': waarnemingenLijst}
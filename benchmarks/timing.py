@@ -0,0 +1,42 @@
+'''
+Timing helpers of the benchmarks
+'''
+
+import timeit
+
+
+def percentile(sortedValues, pct):
+    """
+    :param sortedValues: sorted list of values
+    :param pct: percentile between 0 and 100
+    :return: the value at the percentile (nearest rank)
+    """
+
+    index = int(round(pct / 100.0 * (len(sortedValues) - 1)))
+    return sortedValues[index]
+
+
+def timeLookups(lookup, keys):
+    """
+    :param lookup: function with one argument, e.g. a parCode
+    :param keys: the arguments to look up
+    :return: sorted list with the latency of each lookup in seconds
+    """
+
+    timings = []
+    for key in keys:
+        start = timeit.default_timer()
+        lookup(key)
+        timings.append(timeit.default_timer() - start)
+
+    return sorted(timings)
+
+
+def report(name, timings):
+    """
+    Print the mean and percentiles of the latency of the lookups
+    """
+
+    print "%-12s mean %9.3f ms  p50 %9.3f ms  p95 %9.3f ms  p99 %9.3f ms" % (
+        name, 1000 * sum(timings) / len(timings), 1000 * percentile(timings, 50),
+        1000 * percentile(timings, 95), 1000 * percentile(timings, 99))
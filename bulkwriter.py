@@ -0,0 +1,217 @@
+'''
+BulkWriter
+Buffered, unordered bulk writes to MongoDB.
+
+Writing each document with insert_one costs a network round trip and an acknowledgement per document. The BulkWriter
+collects write operations (e.g. pymongo ReplaceOne / UpdateOne) and sends them with one unordered bulk_write per
+collection when the buffer reaches a number of operations or bytes, every flushInterval seconds, and when the writer is
+closed. Functions registered with callAfterFlush (e.g. writing a checkpoint) are called after the operations that were
+added before them have been written.
+
+Only transient errors (a lost connection or a timeout) keep the operations in the buffer, to be written again by the
+next flush; the operations of this repository are upserts and $set / $addToSet updates, so writing them twice does no
+harm. An operation that fails by itself (e.g. a document over 16 MB) is logged and dropped, so it does not block the
+writes that follow it.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+from pymongo.errors import PyMongoError, BulkWriteError, ConnectionFailure, ExecutionTimeout, WTimeoutError
+
+
+# errors after which the operations are written again; ConnectionFailure includes AutoReconnect and NetworkTimeout
+TRANSIENT_ERRORS = (ConnectionFailure, ExecutionTimeout, WTimeoutError)
+
+
+class BulkWriter(object):
+    """
+    Buffer of MongoDB write operations, flushed in batches by a background thread and by the writing thread
+    """
+
+    def __init__(self, maxOperations=500, maxBytes=8 * 1024 * 1024, flushInterval=10, logger=None,
+                 batchObserver=None):
+        """
+        :param maxOperations: the buffer is flushed when it contains this number of operations
+        :param maxBytes: the buffer is flushed when the (estimated) size of the documents reaches this number of bytes
+        :param flushInterval: the buffer is flushed at least every flushInterval seconds
+        :param logger: logger for the batch statistics; optional
+        :param batchObserver: function(nrOperations, seconds) that is called after each written batch, e.g. to record
+        the write time in the metrics; optional
+        """
+
+        self.maxOperations = maxOperations
+        self.maxBytes = maxBytes
+        self.flushInterval = flushInterval
+        self.logger = logger
+        self.batchObserver = batchObserver
+
+        self.operations = []        # list of (collection, operation, size)
+        self.nrBytes = 0
+        self.callbacks = []
+        self.lock = threading.RLock()
+
+        self.startTime = time.time()
+        self.nrOperationsWritten = 0
+        self.nrOperationsFailed = 0
+        self.nrBatches = 0
+        self.maxBatchSize = 0
+        self.writeTime = 0.0
+
+        self.closed = threading.Event()
+        self.flushThread = threading.Thread(target=self.flushPeriodically)
+        self.flushThread.daemon = True
+        self.flushThread.start()
+
+    def add(self, collection, operation, size=0):
+        """
+        Add a write operation to the buffer
+        :param collection: the pymongo collection to write to
+        :param operation: pymongo write operation, e.g. ReplaceOne
+        :param size: the size of the document in bytes, for the maxBytes limit
+        """
+
+        with self.lock:
+            self.operations.append((collection, operation, size))
+            self.nrBytes += size
+
+            if len(self.operations) >= self.maxOperations or self.nrBytes >= self.maxBytes:
+                self.flush()
+
+    def callAfterFlush(self, function):
+        """
+        Call a function (without arguments) after the operations that are in the buffer now have been written
+        """
+
+        with self.lock:
+            if self.operations:
+                self.callbacks.append(function)
+            else:
+                function()
+
+    def logError(self, message):
+        if self.logger is not None:
+            self.logger.error(message)
+
+    def writeCollection(self, collection, operations):
+        """
+        Write the operations of a collection with an unordered bulk_write; a transient error is raised
+        :return: the number of operations that failed and were dropped
+        """
+
+        try:
+            collection.bulk_write(operations, ordered=False)
+            return 0
+        except BulkWriteError as err:
+            # the other operations have been written; the failed ones would fail again, so they are dropped
+            writeErrors = err.details.get('writeErrors', [])
+            for writeError in writeErrors:
+                self.logError("Write to %s failed and is dropped: %s" % (collection.full_name, writeError.get('errmsg')))
+            for writeConcernError in err.details.get('writeConcernErrors', []):
+                self.logError("Write concern error in writing to %s: %s" %
+                              (collection.full_name, writeConcernError.get('errmsg')))
+            return len(writeErrors)
+        except TRANSIENT_ERRORS:
+            raise
+        except PyMongoError as err:
+            # the batch was rejected as a whole (e.g. a document that is too large); write the operations one by one,
+            # so only the failing operations are dropped
+            self.logError("Bulk write to %s failed (%s), writing the operations one by one" % (collection.full_name, err))
+            nrFailed = 0
+            for operation in operations:
+                try:
+                    collection.bulk_write([operation], ordered=False)
+                except TRANSIENT_ERRORS:
+                    raise
+                except PyMongoError as err:
+                    self.logError("Write to %s failed and is dropped: %s" % (collection.full_name, err))
+                    nrFailed += 1
+            return nrFailed
+
+    def flush(self):
+        """
+        Write all buffered operations, with one unordered bulk_write per collection. After a transient error, the
+        operations of the collections that have not been written completely stay in the buffer and the error is raised.
+        """
+
+        with self.lock:
+            if self.operations:
+                # group the operations per collection, in the order of the first operation of each collection
+                operationsPerCollection = OrderedDict()
+                for collection, operation, size in self.operations:
+                    operationsPerCollection.setdefault(collection.full_name, (collection, []))[1].append(operation)
+
+                startTime = time.time()
+                nrFailed = 0
+                writtenCollections = set()
+                try:
+                    for collection, operations in operationsPerCollection.values():
+                        nrFailed += self.writeCollection(collection, operations)
+                        writtenCollections.add(collection.full_name)
+                except TRANSIENT_ERRORS:
+                    # the operations of the collections that have been written are removed from the buffer
+                    nrOperations = len(self.operations)
+                    self.operations = [(collection, operation, size) for collection, operation, size in self.operations
+                                       if collection.full_name not in writtenCollections]
+                    self.nrBytes = sum(size for collection, operation, size in self.operations)
+                    self.nrOperationsWritten += nrOperations - len(self.operations) - nrFailed
+                    self.nrOperationsFailed += nrFailed
+                    raise
+                batchTime = time.time() - startTime
+
+                self.writeTime += batchTime
+                self.nrBatches += 1
+                self.nrOperationsWritten += len(self.operations) - nrFailed
+                self.nrOperationsFailed += nrFailed
+                self.maxBatchSize = max(self.maxBatchSize, len(self.operations))
+
+                if self.logger is not None:
+                    self.logger.info("Written batch of %d operations (%d bytes) in %.3f s" %
+                                     (len(self.operations), self.nrBytes, batchTime))
+                if self.batchObserver is not None:
+                    self.batchObserver(len(self.operations), batchTime)
+
+                self.operations = []
+                self.nrBytes = 0
+
+            callbacks = self.callbacks
+            self.callbacks = []
+            for function in callbacks:
+                function()
+
+    def flushPeriodically(self):
+        """
+        Flush the buffer every flushInterval seconds, until the writer is closed
+        """
+
+        while not self.closed.wait(self.flushInterval):
+            try:
+                self.flush()
+            except Exception as err:   # the error is raised again by the next flush of the writing thread
+                if self.logger is not None:
+                    self.logger.error("Error in periodic flush: " + str(err))
+
+    def close(self):
+        """
+        Write the remaining operations and stop the background thread; can be called more than once
+        """
+
+        self.closed.set()
+        self.flush()
+
+    def getStats(self):
+        """
+        :return: dict with the number of written, failed (dropped) and buffered operations, the number of batches, the
+        mean batch size, the mean write latency of a batch in seconds and the throughput in operations per second since
+        the writer was created
+        """
+
+        with self.lock:
+            return {'nrOperations': self.nrOperationsWritten,
+                    'nrFailed': self.nrOperationsFailed,
+                    'nrBuffered': len(self.operations),
+                    'nrBatches': self.nrBatches,
+                    'meanBatchSize': self.nrOperationsWritten / float(self.nrBatches) if self.nrBatches else 0,
+                    'maxBatchSize': self.maxBatchSize,
+                    'meanWriteLatency': self.writeTime / self.nrBatches if self.nrBatches else 0,
+                    'operationsPerSecond': self.nrOperationsWritten / (time.time() - self.startTime)}
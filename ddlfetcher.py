@@ -0,0 +1,264 @@
+'''
+DDLFetcher
+Concurrent fetching of measurements from the Rijkswaterstaat Data Distributielaag (DDL).
+
+The OnlineWaarnemingenService answers slowly, so most of the time of a serial run is spent waiting for the network.
+The fetcher keeps a number of requests in flight with a pool of worker threads, which share a requests.Session so
+keep-alive connections are reused. A token bucket limits the number of requests per second; requests that fail with a
+connection error, 429 (Too Many Requests) or a 5xx status are retried with exponential backoff, and a 429 halves the
+request rate, which then slowly increases again while requests succeed.
+
+A response can be handled in the worker thread (see fetchAll), e.g. to write a large response to a file while it is
+downloaded (see ddlstream.spoolResponse), so the response body is never kept in memory as a whole.
+'''
+
+import itertools
+import random
+import threading
+import time
+import Queue
+import requests
+from requests.adapters import HTTPAdapter
+
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter with an adaptive rate
+    """
+
+    def __init__(self, rate, capacity=None, minRate=0.1):
+        """
+        :param rate: maximum number of tokens per second
+        :param capacity: maximum number of tokens that can be saved up; default is one second of tokens
+        :param minRate: the rate is never decreased below minRate
+        """
+
+        self.maxRate = float(rate)
+        self.rate = float(rate)
+        self.minRate = minRate
+        self.capacity = capacity or max(1.0, float(rate))
+        self.tokens = self.capacity
+        self.lastUpdate = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token; blocks until a token is available
+        """
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.lastUpdate) * self.rate)
+                self.lastUpdate = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                waitTime = (1 - self.tokens) / self.rate
+
+            time.sleep(waitTime)
+
+    def decreaseRate(self):
+        """
+        Halve the rate, after the server indicated that it receives too many requests
+        """
+
+        with self.lock:
+            self.rate = max(self.minRate, self.rate / 2.0)
+
+    def increaseRate(self):
+        """
+        Increase the rate by a small step, up to the maximum rate, after a successful request
+        """
+
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.maxRate / 100.0)
+
+
+class DDLFetcher(object):
+    """
+    Posts requests to a DDL service with a pool of worker threads
+    """
+
+    def __init__(self, url, nrWorkers=8, requestsPerSecond=10, maxRetries=5, backoffFactor=2.0, maxBackoff=300,
+                 timeout=600, logger=None):
+        """
+        :param url: the url of the DDL service
+        :param nrWorkers: maximum number of requests in flight
+        :param requestsPerSecond: maximum number of requests per second (including retries)
+        :param maxRetries: maximum number of retries of a request
+        :param backoffFactor: the n-th retry waits backoffFactor * 2 ** (n - 1) seconds (with jitter)
+        :param maxBackoff: maximum wait time in seconds before a retry
+        :param timeout: timeout of a request in seconds
+        :param logger: logger for the retries; optional
+        """
+
+        self.url = url
+        self.nrWorkers = nrWorkers
+        self.maxRetries = maxRetries
+        self.backoffFactor = backoffFactor
+        self.maxBackoff = maxBackoff
+        self.timeout = timeout
+        self.logger = logger
+        self.rateLimiter = TokenBucket(requestsPerSecond)
+
+        # one session for all workers; the connection pool keeps a keep-alive connection for each worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=nrWorkers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'content-type': 'application/json'})
+
+        self.statsLock = threading.Lock()
+        self.nrRequests = 0
+        self.nrRetries = 0
+        self.nrFailures = 0
+
+    def post(self, data, stream=False):
+        """
+        Post a request to the DDL service; retries on connection errors, 429 and 5xx
+        :param data: the (JSON) body of the request
+        :param stream: if True, the body of the response is not read yet (see requests stream=True)
+        :return: the requests Response; after the last retry the response can still have an error status
+        """
+
+        attempt = 0
+
+        while True:
+            self.rateLimiter.acquire()
+            self.countStat('nrRequests')
+
+            try:
+                r = self.session.post(self.url, data=data, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if attempt >= self.maxRetries:
+                    self.countStat('nrFailures')
+                    raise
+                retryReason = str(err)
+                retryAfter = None
+            else:
+                if r.status_code not in RETRY_STATUS_CODES:
+                    self.rateLimiter.increaseRate()
+                    return r
+                if attempt >= self.maxRetries:
+                    self.countStat('nrFailures')
+                    return r
+
+                retryReason = "status code " + str(r.status_code)
+                retryAfter = r.headers.get('Retry-After')
+                r.close()   # release the connection of a streamed response
+                if r.status_code == 429:
+                    self.rateLimiter.decreaseRate()
+
+            attempt += 1
+            self.countStat('nrRetries')
+
+            # wait the time requested by the server, or back off exponentially with jitter
+            if retryAfter is not None and retryAfter.isdigit():
+                waitTime = min(self.maxBackoff, int(retryAfter))
+            else:
+                waitTime = min(self.maxBackoff, self.backoffFactor * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+            if self.logger is not None:
+                self.logger.warning("Retry %d of DDL request after %.1f s (%s)" % (attempt, waitTime, retryReason))
+            time.sleep(waitTime)
+
+    def fetchAll(self, jobs, handleResponse=None):
+        """
+        Post the requests of the jobs with the worker threads, and yield the responses as they arrive. The jobs are
+        read lazily, so at most nrWorkers requests are in flight; stop iterating to stop fetching.
+        :param jobs: iterable of (job, data) tuples; job is returned with the response, data is the body of the request
+        :param handleResponse: optional function(job, response) that is called in the worker thread with the streamed
+        response (not read yet); its return value is yielded instead of the response
+        :return: generator of (job, response, error) tuples; error is the exception if the request failed, else None
+        """
+
+        jobs = iter(jobs)
+        jobQueue = Queue.Queue()
+        resultQueue = Queue.Queue()
+
+        for i in range(self.nrWorkers):
+            worker = threading.Thread(target=self.worker, args=(jobQueue, resultQueue, handleResponse))
+            worker.daemon = True
+            worker.start()
+
+        nrInFlight = 0
+
+        try:
+            for job in itertools.islice(jobs, self.nrWorkers):
+                jobQueue.put(job)
+                nrInFlight += 1
+
+            while nrInFlight > 0:
+                result = getFromQueue(resultQueue)
+                nrInFlight -= 1
+
+                # submit the next job before the result is processed, so the workers keep busy
+                for job in itertools.islice(jobs, 1):
+                    jobQueue.put(job)
+                    nrInFlight += 1
+
+                yield result
+        finally:
+            for i in range(self.nrWorkers):
+                jobQueue.put(None)  # stop the workers
+
+    def worker(self, jobQueue, resultQueue, handleResponse=None):
+        """
+        Post the requests of the jobs in jobQueue, until a None job is received
+        """
+
+        while True:
+            item = jobQueue.get()
+            if item is None:
+                return
+
+            job, data = item
+            try:
+                if handleResponse is None:
+                    resultQueue.put((job, self.post(data), None))
+                else:
+                    r = self.post(data, stream=True)
+                    try:
+                        resultQueue.put((job, handleResponse(job, r), None))
+                    finally:
+                        r.close()
+            except Exception as err:
+                resultQueue.put((job, None, err))
+
+    def countStat(self, name):
+        """
+        Increase one of the request counters
+        """
+
+        with self.statsLock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def getStats(self):
+        """
+        :return: dict with the number of requests, retries and failed requests, and the current request rate
+        """
+
+        with self.statsLock:
+            return {'nrRequests': self.nrRequests,
+                    'nrRetries': self.nrRetries,
+                    'nrFailures': self.nrFailures,
+                    'requestsPerSecond': self.rateLimiter.rate}
+
+
+def getFromQueue(queue):
+    """
+    Get an item from a queue; waits with a timeout in a loop, because in python 2 a blocking get without timeout can
+    not be interrupted with Ctrl-C
+    """
+
+    while True:
+        try:
+            return queue.get(True, 1)
+        except Queue.Empty:
+            pass
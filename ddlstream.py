@@ -0,0 +1,138 @@
+'''
+DDL stream
+Incremental parsing of the responses of the DDL OnlineWaarnemingenService.
+
+A response with a few years of high-frequency measurements can be hundreds of MB of JSON; parsed as a whole it takes
+several times that in python objects. The response is written to a file in chunks while it is downloaded, and the file
+is parsed incrementally: each meting of WaarnemingenLijst[*].MetingenLijst[*] is added to the MeasurementColumns of its
+waarneming as soon as it has been parsed, so only the columns of the measurements are kept in memory.
+
+The response is spooled to disk instead of being parsed from the network stream: the parsing runs in the processes of
+the pool of the compute script, not in the fetch worker threads, so a slow parse does not hold a DDL connection and the
+parse is not limited by the GIL of the main process. The cost is the disk space of the responses waiting to be parsed
+(at most maxPendingResponses) and a write and read of each response.
+
+The incremental parser uses ijson (pip install ijson); without ijson the response is parsed as a whole.
+'''
+
+import gzip
+import json
+import sys
+from eistatistics import MeasurementColumns
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:     # optional; the response is parsed as a whole
+    ijson = None
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+
+WAARNEMING_PREFIX = 'WaarnemingenLijst.item'
+METING_PREFIX = WAARNEMING_PREFIX + '.MetingenLijst.item'
+AQUOMETADATA_PREFIX = WAARNEMING_PREFIX + '.AquoMetadata'
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def parseWaarnemingen(stream):
+    """
+    Parse a response of the OnlineWaarnemingenService, adding the metingen to MeasurementColumns as they are read
+    :param stream: file-like object with the JSON response
+    :return: tuple (value of Succesvol or None, list of (AquoMetadata dict, MeasurementColumns) tuples)
+    """
+
+    if ijson is None:
+        resultJSON = json.load(stream)
+        waarnemingen = []
+        for waarnemingLijst in resultJSON.get('WaarnemingenLijst', []):
+            columns = MeasurementColumns()
+            columns.addAll(waarnemingLijst['MetingenLijst'])
+            waarnemingen.append((waarnemingLijst['AquoMetadata'], columns))
+
+        return resultJSON.get('Succesvol'), waarnemingen
+
+    succesvol = None
+    waarnemingen = []
+    columns = aquoMetadata = None
+    builder = builderPrefix = None  # builds the meting or AquoMetadata dict that is being read
+
+    for prefix, event, value in ijson.parse(stream):
+
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == builderPrefix and event == 'end_map':
+                if builderPrefix == METING_PREFIX:
+                    meetwaarde = builder.value['Meetwaarde']
+                    if meetwaarde.get('Waarde_Numeriek') is not None:   # ijson gives a Decimal
+                        meetwaarde['Waarde_Numeriek'] = float(meetwaarde['Waarde_Numeriek'])
+                    columns.add(builder.value)
+                else:
+                    aquoMetadata = builder.value
+                builder = None
+
+        elif event == 'start_map' and prefix in (METING_PREFIX, AQUOMETADATA_PREFIX):
+            builder = ObjectBuilder()
+            builder.event(event, value)
+            builderPrefix = prefix
+
+        elif prefix == WAARNEMING_PREFIX:
+            if event == 'start_map':
+                columns = MeasurementColumns()
+                aquoMetadata = None
+            elif event == 'end_map':
+                waarnemingen.append((aquoMetadata, columns))
+
+        elif prefix == 'Succesvol':
+            succesvol = value
+
+    return succesvol, waarnemingen
+
+
+def spoolResponse(r, fileName, chunkSize=READ_CHUNK_SIZE):
+    """
+    Write the body of a streamed requests Response to a file while it is downloaded, so it is never in memory as a whole
+    :param r: the Response, requested with stream=True
+    :param fileName: the file to write to
+    :return: the number of bytes written
+    """
+
+    nrBytes = 0
+    with open(fileName, 'wb') as fo:
+        for chunk in r.iter_content(chunkSize):     # decompresses a gzip response
+            fo.write(chunk)
+            nrBytes += len(chunk)
+
+    return nrBytes
+
+
+def parseWaarnemingenFile(fileName):
+    """
+    Parse a stored response of the OnlineWaarnemingenService; a file with extension .gz is decompressed while it is read
+    :return: see parseWaarnemingen
+    """
+
+    fi = gzip.open(fileName, 'rb') if fileName.endswith('.gz') else open(fileName, 'rb')
+    try:
+        return parseWaarnemingen(fi)
+    finally:
+        fi.close()
+
+
+def getPeakRSS():
+    """
+    :return: the peak resident set size of the process in MB; None if it can not be measured on this platform
+    """
+
+    if resource is None:
+        return None
+
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':    # bytes on macOS, kB on Linux
+        return maxRSS / (1024.0 * 1024.0)
+
+    return maxRSS / 1024.0
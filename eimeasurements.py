@@ -0,0 +1,269 @@
+'''
+EI measurements
+Store of the valid measurements of each time series, one document per measurement, for the averages of an arbitrary
+period.
+
+The statistics of the Compute_3YearAvg_DDL script are those of a fixed period. For another period the data aansluitpunt
+computes the statistics from <collection>_measurements with a MongoDB aggregation pipeline (/avg with start and end).
+A measurement document holds only valid measurements (see eistatistics), with the half of the detection limit as value
+for a value with a limit symbol:
+- aquoParCode, locID, compartimentCode, hoedanigheidCode, eenheidCode: the time series
+- year: the year of the measurement, as in the statistics of the years (the local year of the Tijdstip)
+- t: the time of the measurement (UTC)
+- value
+The _id is the seriesID with the position of the measurement in the series, so a retried bulk write (after a partial
+failure) replaces the measurements that were written already instead of adding them again. The time is not part of the
+_id: a series can have more than one measurement at the same time.
+The totalNrMeas, nrInvalidMeas and measLimit of a year can not be computed from the valid measurements, so they are
+not part of the statistics of a period.
+
+The measurements of the series collection (e.g. of years retrieved before the measurements were stored) are stored with:
+python eimeasurements.py [collection name, default EIData] [database name, default EI_Toets]
+'''
+
+import sys
+from datetime import datetime, timedelta
+import pymongo
+from pymongo import ReplaceOne
+from eiyears import SERIES_KEY_FIELDS
+from eiseries import getSeriesCollection, unpackValues, unpackTimes
+from bulkwriter import BulkWriter
+
+
+NO_VALUE = -9999    # as eistatistics.NO_VALUE; the data aansluitpunt does not depend on numpy
+
+# the times of the requested periods are local times of the Netherlands (UTC+01:00), as in the requests to the DDL
+PERIOD_UTC_OFFSET = timedelta(hours=1)
+
+MEASUREMENT_SIZE = 150  # approximate size of a measurement document in bytes (for BulkWriter.add)
+
+
+def getMeasurementsCollection(db, collectionName):
+    """
+    :return: the measurements collection of the data collection
+    """
+
+    return db[collectionName + "_measurements"]
+
+
+def createMeasurementIndexes(db, collectionName):
+    """
+    Create the index of the aggregation of a period: the measurements of a parameter at a location, by time
+    """
+
+    getMeasurementsCollection(db, collectionName).create_index([("aquoParCode", pymongo.ASCENDING),
+                                                                ("locID", pymongo.ASCENDING),
+                                                                ("t", pymongo.ASCENDING)])
+
+
+def getMeasurementDocuments(seriesDocument):
+    """
+    :param seriesDocument: the series document of a year of a time series (see eiseries.splitSeries)
+    :return: list with a measurement document for each measurement of the series
+    """
+
+    key = dict((field, seriesDocument[field]) for field in ['aquoParCode', 'locID', 'year'] + SERIES_KEY_FIELDS)
+
+    measurementDocuments = []
+    for i, (value, epochMillis) in enumerate(zip(unpackValues(seriesDocument['values']),
+                                                 unpackTimes(seriesDocument['times']))):
+        measurementDocument = dict(key)
+        measurementDocument['_id'] = seriesDocument['_id'] + "|" + str(i)
+        measurementDocument['t'] = datetime(1970, 1, 1) + timedelta(milliseconds=epochMillis)
+        measurementDocument['value'] = value
+        measurementDocuments.append(measurementDocument)
+
+    return measurementDocuments
+
+
+def deleteMeasurements(db, collectionName, parCode, locID, years, seriesKey=None):
+    """
+    Delete the stored measurements of a parameter at a location in the given years, before they are stored again.
+    This is not done with the BulkWriter: the unordered bulk writes do not keep the order of a delete and the inserts
+    that follow it. Without seriesKey, the measurements of all time series of the parameter at the location are
+    deleted, so the delete must precede the inserts of all these time series.
+    :param seriesKey: dict with the SERIES_KEY_FIELDS, to delete only the measurements of one time series; optional
+    """
+
+    if years:
+        deleteFilter = {'aquoParCode': parCode, 'locID': locID, 'year': {'$in': list(years)}}
+        if seriesKey is not None:
+            for field in SERIES_KEY_FIELDS:
+                deleteFilter[field] = seriesKey[field]
+        getMeasurementsCollection(db, collectionName).delete_many(deleteFilter)
+
+
+def getMeasurementUpdates(db, collectionName, seriesDocument):
+    """
+    :return: list of (measurements collection, pymongo ReplaceOne, size) tuples that store the measurements of a series;
+    the upserts on the _id can be retried
+    """
+
+    measurementsCollection = getMeasurementsCollection(db, collectionName)
+    return [(measurementsCollection,
+             ReplaceOne({'_id': measurementDocument['_id']}, measurementDocument, upsert=True), MEASUREMENT_SIZE)
+            for measurementDocument in getMeasurementDocuments(seriesDocument)]
+
+
+def getPeriodPipeline(parCode, locID, startTime, endTime, withValues=False):
+    """
+    :param startTime, endTime: datetimes (local time) of the start and (exclusive) end of the period
+    :param withValues: if True, the sorted values of each year are returned too, for the P90
+    :return: the aggregation pipeline that computes the statistics of each year of each time series of a parameter at a
+    location in the period
+    """
+
+    group = {'_id': dict([(field, '$' + field) for field in SERIES_KEY_FIELDS] + [('year', '$year')]),
+             'avg': {'$avg': '$value'},
+             'maxValue': {'$max': '$value'},
+             'minValue': {'$min': '$value'},
+             'nrValidMeas': {'$sum': 1},
+             'firstObsDate': {'$min': '$t'},
+             'lastObsDate': {'$max': '$t'}}
+
+    pipeline = [{'$match': {'aquoParCode': parCode, 'locID': locID,
+                            't': {'$gte': startTime - PERIOD_UTC_OFFSET, '$lt': endTime - PERIOD_UTC_OFFSET}}}]
+    if withValues:
+        pipeline.append({'$sort': {'value': 1}})    # $push keeps the order, so the values of a year are sorted
+        group['values'] = {'$push': '$value'}
+    pipeline.append({'$group': group})
+
+    return pipeline
+
+
+def getPercentile(sortedValues, percentile):
+    """
+    :return: the linear interpolated percentile of the sorted values, as numpy.percentile
+    """
+
+    rank = (len(sortedValues) - 1) * percentile / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(sortedValues) - 1)
+    return sortedValues[lower] + (sortedValues[upper] - sortedValues[lower]) * (rank - lower)
+
+
+def formatTime(utcTime):
+    """
+    :return: the UTC datetime as local time, in the format of the Tijdstip of the DDL
+    """
+
+    localTime = utcTime + PERIOD_UTC_OFFSET
+    return localTime.strftime("%Y-%m-%dT%H:%M:%S") + ".%03d+01:00" % (localTime.microsecond // 1000)
+
+
+def computePeriodAverages(db, collectionName, features, startTime, endTime):
+    """
+    Compute the statistics of each year and the multi-year average of time series in another period than the one of
+    the stored averages
+    :param features: the stored time series (features of the data collection) of one parameter at one location; a
+    time series has a feature for each period that was computed
+    :param startTime, endTime: datetimes (local time) of the start and (exclusive) end of the period
+    :return: a feature for each time series, with the statistics of the period in EIData; time series without valid
+    measurements in the period are left out
+    """
+
+    if not features:
+        return []
+
+    # one feature per time series: the feature of the most recent period (features stored before the period was
+    # recorded have no endTimeReq)
+    featuresByKey = {}
+    for feature in sorted(features, key=lambda feature: feature['properties']['EIData'].get('endTimeReq') or '',
+                          reverse=True):
+        featuresByKey.setdefault(tuple(feature['properties']['EIData'][field] for field in SERIES_KEY_FIELDS), feature)
+    keptFeatures = set(id(feature) for feature in featuresByKey.values())
+    features = [feature for feature in features if id(feature) in keptFeatures]   # in the stored order
+
+    parCode = features[0]['properties']['aquoParCode']
+    locID = features[0]['properties']['locID']
+    withValues = any(feature['properties']['EIData'].get('valueProcessingMethodCode') == 'P90' for feature in features)
+
+    pipeline = getPeriodPipeline(parCode, locID, startTime, endTime, withValues)
+    yearsByKey = {}
+    for group in getMeasurementsCollection(db, collectionName).aggregate(pipeline, allowDiskUse=True):
+        key = tuple(group['_id'][field] for field in SERIES_KEY_FIELDS)
+        yearsByKey.setdefault(key, []).append(group)
+
+    startTimeReq = startTime.strftime("%Y-%m-%dT%H:%M:%S")
+    endTimeReq = endTime.strftime("%Y-%m-%dT%H:%M:%S")
+
+    periodFeatures = []
+    for feature in features:
+        EIData = feature['properties']['EIData']
+        groups = yearsByKey.get(tuple(EIData[field] for field in SERIES_KEY_FIELDS))
+        if not groups:
+            continue
+
+        EIYearData = []
+        for group in sorted(groups, key=lambda group: group['_id']['year']):
+            if EIData.get('valueProcessingMethodCode') in ['JGM', 'MAX']:
+                avg = group['avg']
+            elif EIData.get('valueProcessingMethodCode') == 'P90':
+                avg = getPercentile(group['values'], 90)
+            else:
+                avg = NO_VALUE
+
+            EIYearData.append({'year': group['_id']['year'],
+                               'avg': avg,
+                               'nrValidMeas': group['nrValidMeas'],
+                               'maxValue': group['maxValue'],
+                               'minValue': group['minValue'],
+                               'startTimeReq': startTimeReq,
+                               'endTimeReq': endTimeReq,
+                               'firstObsDate': formatTime(group['firstObsDate']),
+                               'lastObsDate': formatTime(group['lastObsDate'])})
+
+        avgYears = [EIYearDict['avg'] for EIYearDict in EIYearData]
+        EIData['yearData'] = EIYearData
+        EIData['avg'] = sum(avgYears) / float(len(avgYears))
+        EIData['startTimeReq'] = startTimeReq
+        EIData['endTimeReq'] = endTimeReq
+        periodFeatures.append(feature)
+
+    return periodFeatures
+
+
+def fillFromSeries(db, collectionName):
+    """
+    Store the measurements of the series collection, e.g. of the years that were retrieved before the measurements
+    were stored
+    :return: the number of series
+    """
+
+    createMeasurementIndexes(db, collectionName)
+    writer = BulkWriter()
+    nrSeries = 0
+
+    try:
+        for seriesDocument in getSeriesCollection(db, collectionName).find():
+            # only the measurements of this series: the inserts of the other series of the parameter at the location
+            # may have been written already
+            deleteMeasurements(db, collectionName, seriesDocument['aquoParCode'], seriesDocument['locID'],
+                               [seriesDocument['year']], seriesDocument)
+            for measurementsCollection, update, size in getMeasurementUpdates(db, collectionName, seriesDocument):
+                writer.add(measurementsCollection, update, size)
+            nrSeries += 1
+    finally:
+        writer.close()
+
+    return nrSeries
+
+
+if __name__ == '__main__':
+
+    collectionName = sys.argv[1] if len(sys.argv) > 1 else "EIData"
+    databaseName = sys.argv[2] if len(sys.argv) > 2 else "EI_Toets"
+
+    client = pymongo.MongoClient(serverSelectionTimeoutMS=1)
+
+    # test if connection to MongoDB works
+    try:
+        client.server_info()
+    except pymongo.errors.ServerSelectionTimeoutError as err:
+        print(err)
+        print "Error in connecting to MongoDB; have you started MongoDB?"
+        sys.exit()
+
+    nrSeries = fillFromSeries(client[databaseName], collectionName)
+    print "Stored the measurements of " + str(nrSeries) + " series in " + \
+          getMeasurementsCollection(client[databaseName], collectionName).name
@@ -0,0 +1,202 @@
+'''
+EI series
+Compact store of the valid measurements of each year of each time series.
+
+The measurements (validMeasValues and validMeasTimes of the yearData) are by far the largest part of a time series
+document, but only a few clients need them. They are stored in a separate collection, <collection>_series, with one
+document per time series and year:
+- _id: the seriesID (see getSeriesID), which the yearData of the time series holds instead of the measurements
+- aquoParCode, locID, compartimentCode, hoedanigheidCode, eenheidCode, year, nrValues
+- values: the values as packed little-endian float64 (binary)
+- times: the times as packed little-endian int64, milliseconds since 1970-01-01 UTC (binary)
+The data aansluitpunt returns the measurements with /series.
+
+Existing data collections are migrated with:
+python eiseries.py [collection name, default EIData] [database name, default EI_Toets]
+'''
+
+import calendar
+import struct
+import sys
+from bson.binary import Binary
+import pymongo
+from pymongo import ReplaceOne, UpdateOne
+from dateutil import parser
+from eiyears import SERIES_KEY_FIELDS, getYearCollections
+from eisummaries import bumpDataVersion
+from bulkwriter import BulkWriter
+
+
+def getSeriesCollection(db, collectionName):
+    """
+    :return: the series collection of the data collection
+    """
+
+    return db[collectionName + "_series"]
+
+
+def createSeriesIndexes(db, collectionName):
+    """
+    Create the index used by /series to find the series of a parameter at a location
+    """
+
+    getSeriesCollection(db, collectionName).create_index([("aquoParCode", pymongo.ASCENDING),
+                                                          ("locID", pymongo.ASCENDING),
+                                                          ("year", pymongo.ASCENDING)])
+
+
+def getSeriesID(parCode, locID, EIData, year):
+    """
+    :param EIData: dict with the SERIES_KEY_FIELDS of the time series
+    :return: the ID of the series of a time series and year
+    """
+
+    return "|".join([parCode, locID] + [EIData[field] for field in SERIES_KEY_FIELDS] + [str(year)])
+
+
+def toEpochMillis(tijdstip):
+    """
+    :param tijdstip: time as given by the DDL, e.g. 2012-03-01T10:00:00.000+01:00
+    :return: milliseconds since 1970-01-01 UTC
+    """
+
+    try:
+        # fast path for the format of the DDL
+        seconds = calendar.timegm((int(tijdstip[0:4]), int(tijdstip[5:7]), int(tijdstip[8:10]),
+                                   int(tijdstip[11:13]), int(tijdstip[14:16]), int(tijdstip[17:19])))
+        millis = int(tijdstip[20:23]) if tijdstip[19] == '.' else 0
+        offset = tijdstip[23:] if tijdstip[19] == '.' else tijdstip[19:]
+        if offset == 'Z':
+            offsetMinutes = 0
+        else:
+            offsetMinutes = (int(offset[1:3]) * 60 + int(offset[4:6])) * (-1 if offset[0] == '-' else 1)
+        return (seconds - offsetMinutes * 60) * 1000 + millis
+    except (ValueError, IndexError):
+        time = parser.parse(tijdstip)
+        offset = time.utcoffset()
+        seconds = calendar.timegm(time.timetuple()) - (offset.days * 86400 + offset.seconds if offset else 0)
+        return seconds * 1000 + time.microsecond // 1000
+
+
+def packValues(values):
+    return Binary(struct.pack('<%dd' % len(values), *values))
+
+
+def unpackValues(data):
+    return list(struct.unpack('<%dd' % (len(data) // 8), data))
+
+
+def packTimes(epochMillis):
+    return Binary(struct.pack('<%dq' % len(epochMillis), *epochMillis))
+
+
+def unpackTimes(data):
+    return list(struct.unpack('<%dq' % (len(data) // 8), data))
+
+
+def splitSeries(parCode, locID, EIData, EIYearDict):
+    """
+    Move the measurements of a year of a time series to a series document; the yearData gets the seriesID instead
+    :param EIData: dict with the SERIES_KEY_FIELDS of the time series
+    :param EIYearDict: the statistics of the year, with validMeasValues and validMeasTimes; changed in place
+    :return: the series document
+    """
+
+    values = EIYearDict.pop('validMeasValues')
+    times = EIYearDict.pop('validMeasTimes')
+    seriesID = getSeriesID(parCode, locID, EIData, EIYearDict['year'])
+    EIYearDict['seriesID'] = seriesID
+
+    seriesDocument = {'_id': seriesID, 'aquoParCode': parCode, 'locID': locID, 'year': EIYearDict['year'],
+                      'nrValues': len(values), 'values': packValues(values),
+                      'times': packTimes([toEpochMillis(tijdstip) for tijdstip in times])}
+    for field in SERIES_KEY_FIELDS:
+        seriesDocument[field] = EIData[field]
+
+    return seriesDocument
+
+
+def getSeriesUpdate(db, collectionName, seriesDocument):
+    """
+    :return: tuple (series collection, pymongo ReplaceOne) that stores the series document, and the size of the
+    document in bytes (for BulkWriter.add)
+    """
+
+    return getSeriesCollection(db, collectionName), \
+        ReplaceOne({'_id': seriesDocument['_id']}, seriesDocument, upsert=True), \
+        16 * seriesDocument['nrValues']
+
+
+def decodeSeries(seriesDocument):
+    """
+    :return: the series document as JSON serializable dict, with the values and times as lists
+    """
+
+    decoded = dict((key, value) for key, value in seriesDocument.items() if key not in ('_id', 'values', 'times'))
+    decoded['seriesID'] = seriesDocument['_id']
+    decoded['values'] = unpackValues(seriesDocument['values'])
+    decoded['times'] = unpackTimes(seriesDocument['times'])
+    return decoded
+
+
+def migrateCollection(db, collectionName):
+    """
+    Move the measurements in the yearData of the documents of the data collection and of its years collection to the
+    series collection
+    :return: the number of migrated documents
+    """
+
+    createSeriesIndexes(db, collectionName)
+    writer = BulkWriter()
+    nrMigrated = 0
+
+    try:
+        # time series documents: the yearData is in properties.EIData
+        for record in db[collectionName].find({'properties.EIData.yearData.validMeasValues': {'$exists': True}},
+                                              {'properties.aquoParCode': 1, 'properties.locID': 1,
+                                               'properties.EIData': 1}):
+            properties = record['properties']
+            EIData = properties['EIData']
+            for EIYearDict in EIData['yearData']:
+                if 'validMeasValues' in EIYearDict:
+                    seriesCollection, update, size = getSeriesUpdate(
+                        db, collectionName, splitSeries(properties['aquoParCode'], properties['locID'], EIData, EIYearDict))
+                    writer.add(seriesCollection, update, size)
+            writer.add(db[collectionName], UpdateOne({'_id': record['_id']},
+                                                     {'$set': {'properties.EIData.yearData': EIData['yearData']}}))
+            nrMigrated += 1
+
+        # year documents
+        yearsCollection, coverageCollection = getYearCollections(db, collectionName)
+        for record in yearsCollection.find({'yearData.validMeasValues': {'$exists': True}}):
+            seriesCollection, update, size = getSeriesUpdate(
+                db, collectionName, splitSeries(record['aquoParCode'], record['locID'], record['series'], record['yearData']))
+            writer.add(seriesCollection, update, size)
+            writer.add(yearsCollection, UpdateOne({'_id': record['_id']}, {'$set': {'yearData': record['yearData']}}))
+            nrMigrated += 1
+    finally:
+        writer.close()
+
+    return nrMigrated
+
+
+if __name__ == '__main__':
+
+    collectionName = sys.argv[1] if len(sys.argv) > 1 else "EIData"
+    databaseName = sys.argv[2] if len(sys.argv) > 2 else "EI_Toets"
+
+    client = pymongo.MongoClient(serverSelectionTimeoutMS=1)
+
+    # test if connection to MongoDB works
+    try:
+        client.server_info()
+    except pymongo.errors.ServerSelectionTimeoutError as err:
+        print(err)
+        print "Error in connecting to MongoDB; have you started MongoDB?"
+        sys.exit()
+
+    nrMigrated = migrateCollection(client[databaseName], collectionName)
+    print "Moved the measurements of " + str(nrMigrated) + " documents of " + databaseName + "." + collectionName + \
+          " to " + getSeriesCollection(client[databaseName], collectionName).name
+    # let the data aansluitpunt know that the data has changed
+    bumpDataVersion(client[databaseName], collectionName)
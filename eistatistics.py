@@ -0,0 +1,161 @@
+'''
+EI statistics
+Per-year statistics of the measurements of a DDL time series, for the 3-year average of the EI-toets.
+
+The measurements (metingen) of a time series are collected in columns (MeasurementColumns), after which the statistics
+of all years are computed with NumPy array operations:
+- a measurement is valid if its quality code (KwaliteitswaardecodeLijst) is below 50 and its reference plane
+  (ReferentievlakLijst) is WATSGL
+- a value with a limit symbol (Waarde_Limietsymbool, e.g. '<') is a detection limit and counts for half its value
+- the year value is the mean of the valid values (JGM and MAX) or the 90th (linear interpolated) percentile (P90)
+'''
+
+import numpy as np
+from dateutil import parser
+
+
+NO_VALUE = -9999    # value of statistics that can not be computed, e.g. for a year without valid measurements
+
+
+class MeasurementColumns(object):
+    """
+    The measurements of one time series as columns, filled one meting at a time
+    """
+
+    def __init__(self):
+        self.times = []             # Tijdstip as string
+        self.values = []            # Waarde_Numeriek
+        self.isLimit = []           # True if the value has a Waarde_Limietsymbool
+        self.qualityCodes = []      # first KwaliteitswaardecodeLijst code
+        self.referentievlakken = [] # first ReferentievlakLijst value
+
+    def add(self, meting):
+        """
+        Add a meting from the MetingenLijst of the DDL OnlineWaarnemingenService
+        """
+
+        metadata = meting['WaarnemingMetadata']
+        meetwaarde = meting['Meetwaarde']
+
+        self.times.append(meting['Tijdstip'])
+        self.values.append(meetwaarde.get('Waarde_Numeriek'))
+        self.isLimit.append("Waarde_Limietsymbool" in meetwaarde)
+        self.qualityCodes.append(int(metadata['KwaliteitswaardecodeLijst'][0]))
+        self.referentievlakken.append(metadata['ReferentievlakLijst'][0])
+
+    def addAll(self, metingen):
+        """
+        Add all metingen of a MetingenLijst
+        """
+
+        for meting in metingen:
+            self.add(meting)
+
+    def __len__(self):
+        """
+        :return: the number of measurements
+        """
+
+        return len(self.times)
+
+
+def parseYears(times):
+    """
+    Get the year of each Tijdstip. The year is that of the local time of the Tijdstip (including the UTC offset, e.g.
+    2012-01-01T00:30:00.000+01:00 is in 2012), as given by dateutil.parser.parse(tijdstip).year
+    :param times: list of Tijdstip strings
+    :return: numpy array with the years
+    """
+
+    if not times:
+        return np.array([], dtype=int)
+
+    try:
+        # parse the date and time without the fraction of seconds and UTC offset in one array operation
+        localTimes = np.array([tijdstip[:19] for tijdstip in times], dtype='datetime64[s]')
+    except ValueError:
+        # other formats are parsed one at a time
+        localTimes = np.array([parser.parse(tijdstip).replace(tzinfo=None) for tijdstip in times], dtype='datetime64[s]')
+
+    return localTimes.astype('datetime64[Y]').astype(int) + 1970
+
+
+def computeYearStatistics(columns, valueProcessingMethodCode, startTimeReq, endTimeReq):
+    """
+    Compute the statistics of each year of a time series
+    :param columns: the MeasurementColumns of the time series
+    :param valueProcessingMethodCode: JGM, MAX or P90
+    :param startTimeReq: start of the requested period, stored with each year
+    :param endTimeReq: end of the requested period, stored with each year
+    :return: list with a dict with the statistics of each year, sorted by year
+    """
+
+    years = parseYears(columns.times)
+    values = np.array(columns.values, dtype=float)
+    isLimit = np.array(columns.isLimit, dtype=bool)
+    isValid = (np.array(columns.qualityCodes, dtype=int) < 50) & \
+              (np.array(columns.referentievlakken, dtype=object) == "WATSGL")
+
+    # a value with a limit symbol is the detection limit; half of the limit is used
+    validValues = np.where(isLimit, values * 0.5, values)
+
+    uniqYears, yearIndex = np.unique(years, return_inverse=True)
+    nrYears = len(uniqYears)
+    totalNrMeas = np.bincount(yearIndex, minlength=nrYears)
+    nrValidMeas = np.bincount(yearIndex[isValid], minlength=nrYears)
+
+    # indices of the valid measurements grouped by year; the stable sort keeps the order of the measurements in a year
+    validIndices = np.flatnonzero(isValid)
+    validIndices = validIndices[np.argsort(yearIndex[validIndices], kind='mergesort')]
+    groupEnds = np.cumsum(nrValidMeas)
+
+    EIYearData = []
+
+    for i in range(nrYears):
+        indices = validIndices[groupEnds[i] - nrValidMeas[i]:groupEnds[i]]
+        yearValues = validValues[indices]
+
+        if len(indices) > 0:
+            maxValue = float(yearValues.max())
+            minValue = float(yearValues.min())
+
+            if valueProcessingMethodCode in ['JGM', 'MAX']:
+                avg = float(yearValues.mean())
+            elif valueProcessingMethodCode == 'P90':
+                avg = float(np.percentile(yearValues, 90))  # gives the 90th (linear interpolated) percentile
+            else:
+                avg = NO_VALUE
+
+            validMeasTimes = [columns.times[index] for index in indices]
+            firstObsDate = validMeasTimes[0]
+            lastObsDate = validMeasTimes[-1]
+        else:
+            avg = maxValue = minValue = NO_VALUE
+            validMeasTimes = []
+            firstObsDate = lastObsDate = NO_VALUE
+
+        # the last detection limit of the year
+        limitIndices = indices[isLimit[indices]]
+        measLimit = float(values[limitIndices[-1]]) if len(limitIndices) > 0 else NO_VALUE
+
+        EIYearDict = {
+            # EI-toets specific info
+            'year': int(uniqYears[i]),
+            'avg': avg,
+            'totalNrMeas': int(totalNrMeas[i]),
+            'nrInvalidMeas': int(totalNrMeas[i] - nrValidMeas[i]),
+            'nrValidMeas': int(nrValidMeas[i]),
+            'validMeasValues': yearValues.tolist(),
+            'validMeasTimes': validMeasTimes,
+            'maxValue': maxValue,
+            'minValue': minValue,
+            'startTimeReq': startTimeReq,
+            'endTimeReq': endTimeReq,
+            'firstObsDate': firstObsDate,
+            'lastObsDate': lastObsDate,
+            'measLimit': measLimit
+        }
+
+        EIYearData.append(EIYearDict)
+
+    return EIYearData
@@ -0,0 +1,183 @@
+'''
+EI summaries
+Summary collections of the locations and parameters in an EI data collection (e.g. EIData).
+
+The /locations and /parameters endpoints of the data aansluitpunt only need the unique locations and parameters,
+not the time series. The Compute_3YearAvg_DDL script keeps two small summary collections up to date for each stored
+time series, so the endpoints can read these instead of scanning the whole data collection:
+- <collection>_locations: one GeoJSON Feature per locID, with the list of aquoParCodes measured at the location
+- <collection>_parameters: one document per aquoParCode
+
+The metadata collection holds a data version stamp per data collection, which the script increases after each run so
+the data aansluitpunt knows when its cached responses are outdated.
+
+For an existing data collection the summaries can be rebuilt with:
+python eisummaries.py [collection name, default EIData] [database name, default EI_Toets]
+'''
+
+import sys
+from datetime import datetime
+import pymongo
+from pymongo import UpdateOne
+
+
+METADATA_COLLECTION = "metadata"
+
+
+def getSummaryCollections(db, collectionName):
+    """
+    :param db: the pymongo database
+    :param collectionName: name of the data collection
+    :return: tuple with the locations and the parameters summary collection of the data collection
+    """
+
+    return db[collectionName + "_locations"], db[collectionName + "_parameters"]
+
+
+def createDataIndexes(db, collectionName):
+    """
+    Create the indexes used by the data aansluitpunt to query the data collection: on parameter and location, and a
+    2dsphere index on the GeoJSON geometry for spatial selections
+    """
+
+    collection = db[collectionName]
+    collection.create_index([("properties.aquoParCode", pymongo.ASCENDING), ("properties.locID", pymongo.ASCENDING)])
+    collection.create_index("properties.locID")
+    collection.create_index([("geometry", pymongo.GEOSPHERE)])
+
+
+def createSummaryIndexes(db, collectionName):
+    """
+    Create the indexes used by the data aansluitpunt to query the summary collections
+    """
+
+    locationsCollection, parametersCollection = getSummaryCollections(db, collectionName)
+    locationsCollection.create_index("aquoParCodes")
+    locationsCollection.create_index([("geometry", pymongo.GEOSPHERE)])
+    locationsCollection.create_index("properties.locName")
+    parametersCollection.create_index("aquoParOmschrijving")
+
+
+def getResultFilter(result):
+    """
+    Get the filter that identifies a time series in the data collection, so storing it again replaces the stored
+    document: the parameter, location, compartiment, hoedanigheid, eenheid and the requested period
+    :param result: the GeoJSON feature of the time series
+    :return: the filter dict for an upsert
+    """
+
+    properties = result['properties']
+    EIData = properties['EIData']
+
+    return {'properties.aquoParCode': properties['aquoParCode'],
+            'properties.locID': properties['locID'],
+            'properties.EIData.compartimentCode': EIData['compartimentCode'],
+            'properties.EIData.hoedanigheidCode': EIData['hoedanigheidCode'],
+            'properties.EIData.eenheidCode': EIData['eenheidCode'],
+            'properties.EIData.startTimeReq': EIData['startTimeReq'],
+            'properties.EIData.endTimeReq': EIData['endTimeReq']}
+
+
+def getSummaryUpdates(db, collectionName, result):
+    """
+    Get the upserts that add the location and parameter of a stored time series to the summary collections
+    :param result: the GeoJSON feature of the time series, as stored in the data collection
+    :return: list of (summary collection, pymongo UpdateOne) tuples
+    """
+
+    locationsCollection, parametersCollection = getSummaryCollections(db, collectionName)
+    properties = result['properties']
+
+    locationUpdate = UpdateOne(
+        {'_id': properties['locID']},
+        {'$set': {'type': 'Feature',
+                  'properties': {'source': properties['source'],
+                                 'locID': properties['locID'],
+                                 'locName': properties['locName']},
+                  'geometry': result['geometry']},
+         '$addToSet': {'aquoParCodes': properties['aquoParCode']}},
+        upsert=True)
+
+    parameterUpdate = UpdateOne(
+        {'_id': properties['aquoParCode']},
+        {'$set': {'aquoParCode': properties['aquoParCode'],
+                  'aquoParOmschrijving': properties['aquoParOmschrijving'],
+                  'parDescription': properties['parDescription']}},
+        upsert=True)
+
+    return [(locationsCollection, locationUpdate), (parametersCollection, parameterUpdate)]
+
+
+def rebuildSummaries(db, collectionName):
+    """
+    Replace the summary collections by the unique locations and parameters in the data collection
+    """
+
+    locationsCollection, parametersCollection = getSummaryCollections(db, collectionName)
+    collection = db[collectionName]
+
+    # $out replaces the summary collection when the pipeline has finished, so the app never sees a partial summary
+    collection.aggregate([
+        {'$group': {'_id': '$properties.locID',
+                    'source': {'$last': '$properties.source'},
+                    'locName': {'$last': '$properties.locName'},
+                    'geometry': {'$last': '$geometry'},
+                    'aquoParCodes': {'$addToSet': '$properties.aquoParCode'}}},
+        {'$project': {'type': {'$literal': 'Feature'},
+                      'properties': {'source': '$source', 'locID': '$_id', 'locName': '$locName'},
+                      'geometry': 1,
+                      'aquoParCodes': 1}},
+        {'$out': locationsCollection.name}
+    ], allowDiskUse=True)
+
+    collection.aggregate([
+        {'$group': {'_id': '$properties.aquoParCode',
+                    'aquoParOmschrijving': {'$last': '$properties.aquoParOmschrijving'},
+                    'parDescription': {'$last': '$properties.parDescription'}}},
+        {'$project': {'aquoParCode': '$_id', 'aquoParOmschrijving': 1, 'parDescription': 1}},
+        {'$out': parametersCollection.name}
+    ], allowDiskUse=True)
+
+    createSummaryIndexes(db, collectionName)
+    bumpDataVersion(db, collectionName)
+
+
+def getDataVersion(db, collectionName):
+    """
+    :return: the data version stamp of the data collection; 0 if the collection has never been updated
+    """
+
+    metadata = db[METADATA_COLLECTION].find_one({'_id': collectionName}, {'dataVersion': 1})
+    if metadata is None:
+        return 0
+
+    return metadata['dataVersion']
+
+
+def bumpDataVersion(db, collectionName):
+    """
+    Increase the data version stamp of the data collection, after the data or the summaries have changed
+    """
+
+    db[METADATA_COLLECTION].update_one({'_id': collectionName},
+                                       {'$inc': {'dataVersion': 1}, '$set': {'updated': datetime.utcnow()}},
+                                       upsert=True)
+
+
+if __name__ == '__main__':
+
+    collectionName = sys.argv[1] if len(sys.argv) > 1 else "EIData"
+    databaseName = sys.argv[2] if len(sys.argv) > 2 else "EI_Toets"
+
+    client = pymongo.MongoClient(serverSelectionTimeoutMS=1)
+
+    # test if connection to MongoDB works
+    try:
+        client.server_info()
+    except pymongo.errors.ServerSelectionTimeoutError as err:
+        print(err)
+        print "Error in connecting to MongoDB; have you started MongoDB?"
+        sys.exit()
+
+    rebuildSummaries(client[databaseName], collectionName)
+    print "Rebuilt summary collections of " + databaseName + "." + collectionName
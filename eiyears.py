@@ -0,0 +1,149 @@
+'''
+EI years
+Store of the statistics of each year of each time series, so a new period (e.g. the next 3-year window) only needs the
+measurements of the years that have not been computed before.
+
+For a data collection (e.g. EIData) there are two collections:
+- <collection>_years: one document per time series (parameter, location, compartiment, hoedanigheid, eenheid) and year,
+  with the metadata of the time series and the statistics of the year (see eistatistics.computeYearStatistics)
+- <collection>_coverage: per parameter / location combination the years that have been retrieved from the DDL, also
+  the years without measurements, so these are not requested again
+
+The Compute_3YearAvg_DDL script requests only the missing years of a period, and combines the stored years of the
+period into the multi-year average of each time series (combineYears).
+'''
+
+from datetime import datetime
+import pymongo
+from pymongo import ReplaceOne, UpdateOne
+
+
+# the metadata of a time series, stored with each year
+SERIES_FIELDS = ['bemonsteringsSoortOmschrijving', 'bemonsteringsSoortCode', 'compartimentOmschrijving',
+                 'compartimentCode', 'hoedanigheidOmschrijving', 'hoedanigheidCode', 'eenheidOmschrijving',
+                 'eenheidCode', 'valueProcessingMethodCode']
+
+# the fields that identify a time series of a parameter at a location
+SERIES_KEY_FIELDS = ['compartimentCode', 'hoedanigheidCode', 'eenheidCode']
+
+
+def getYearCollections(db, collectionName):
+    """
+    :return: tuple with the years and the coverage collection of the data collection
+    """
+
+    return db[collectionName + "_years"], db[collectionName + "_coverage"]
+
+
+def createYearIndexes(db, collectionName):
+    """
+    Create the index on the years collection that identifies a time series and year
+    """
+
+    yearsCollection, coverageCollection = getYearCollections(db, collectionName)
+    yearsCollection.create_index([("aquoParCode", pymongo.ASCENDING), ("locID", pymongo.ASCENDING),
+                                  ("year", pymongo.ASCENDING)])
+
+
+def getPeriodYears(startTime, endTime):
+    """
+    :param startTime, endTime: datetimes of the start and (exclusive) end of a period, e.g. 1 January 2012 and
+    1 January 2015
+    :return: list of the years in the period, e.g. [2012, 2013, 2014]
+    """
+
+    lastYear = endTime.year if endTime > datetime(endTime.year, 1, 1) else endTime.year - 1
+    return range(startTime.year, lastYear + 1)
+
+
+def getCompleteYears(years, now=None):
+    """
+    :return: the years that have ended; the measurements of the current year are not final, so it is requested again
+    """
+
+    now = now or datetime.now()
+    return [year for year in years if datetime(year + 1, 1, 1) <= now]
+
+
+def readCoverage(db, collectionName):
+    """
+    :return: dict parCode + "_" + locID -> set of the years that have been retrieved from the DDL
+    """
+
+    yearsCollection, coverageCollection = getYearCollections(db, collectionName)
+    return dict((record['_id'], set(record['years'])) for record in coverageCollection.find())
+
+
+def getCoverageUpdate(db, collectionName, parCode, locID, years):
+    """
+    :return: (coverage collection, pymongo UpdateOne) that adds the retrieved years of a parameter / location combination
+    """
+
+    yearsCollection, coverageCollection = getYearCollections(db, collectionName)
+    return coverageCollection, UpdateOne({'_id': parCode + "_" + locID},
+                                         {'$addToSet': {'years': {'$each': list(years)}}}, upsert=True)
+
+
+def getYearDocuments(parCode, locID, EIData, EIYearData):
+    """
+    :param EIData: dict with (at least) the SERIES_FIELDS of the time series
+    :param EIYearData: the list of statistics of each year, as computed by computeYearStatistics
+    :return: list with a document for the years collection for each year
+    """
+
+    series = dict((field, EIData[field]) for field in SERIES_FIELDS)
+    return [{'aquoParCode': parCode, 'locID': locID, 'year': EIYearDict['year'], 'series': series,
+             'yearData': EIYearDict} for EIYearDict in EIYearData]
+
+
+def getYearUpdates(db, collectionName, yearDocuments):
+    """
+    :return: list of (years collection, pymongo ReplaceOne) tuples that store the year documents
+    """
+
+    yearsCollection, coverageCollection = getYearCollections(db, collectionName)
+
+    updates = []
+    for yearDocument in yearDocuments:
+        keyFilter = {'aquoParCode': yearDocument['aquoParCode'], 'locID': yearDocument['locID'],
+                     'year': yearDocument['year']}
+        for field in SERIES_KEY_FIELDS:
+            keyFilter['series.' + field] = yearDocument['series'][field]
+        updates.append((yearsCollection, ReplaceOne(keyFilter, yearDocument, upsert=True)))
+
+    return updates
+
+
+def readYearDocuments(db, collectionName, parCode, locID, years):
+    """
+    :return: the stored year documents of all time series of a parameter at a location, for the given years
+    """
+
+    if not years:
+        return []
+
+    yearsCollection, coverageCollection = getYearCollections(db, collectionName)
+    return list(yearsCollection.find({'aquoParCode': parCode, 'locID': locID, 'year': {'$in': list(years)}},
+                                     {'_id': 0}))
+
+
+def combineYears(yearDocuments):
+    """
+    Group the year documents by time series, and compute the multi-year average of each time series: the mean of the
+    year values
+    :return: list of (series dict, list of the statistics of each year sorted by year, multi-year average)
+    """
+
+    seriesByKey = {}
+    for yearDocument in yearDocuments:
+        key = tuple(yearDocument['series'][field] for field in SERIES_KEY_FIELDS)
+        seriesByKey.setdefault(key, (yearDocument['series'], {}))[1][yearDocument['year']] = yearDocument['yearData']
+
+    combined = []
+    for key in sorted(seriesByKey.keys()):
+        series, yearDataByYear = seriesByKey[key]
+        EIYearData = [yearDataByYear[year] for year in sorted(yearDataByYear.keys())]
+        avgYears = [EIYearDict['avg'] for EIYearDict in EIYearData]
+        combined.append((series, EIYearData, sum(avgYears) / float(len(avgYears))))
+
+    return combined
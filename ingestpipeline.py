@@ -0,0 +1,216 @@
+'''
+IngestPipeline
+Staged pipeline for fetching and processing the time series of the DDL.
+
+The stages run concurrently:
+- fetch: the DDLFetcher posts the requests with a pool of threads (network I/O)
+- process: a pool of processes parses the responses and computes the results (CPU); with nrProcesses = 0 the responses
+  are processed in the fetch thread, in the current process
+- write: the caller iterates over the processed results in the main thread, e.g. to write them to MongoDB
+
+The number of responses that are fetched but not yet consumed by the write stage is limited to maxPending: when the
+process or write stage falls behind, the fetch stage waits, which in turn stops the DDLFetcher from sending new requests.
+'''
+
+import multiprocessing
+import signal
+import threading
+import time
+import Queue
+from ddlfetcher import getFromQueue
+
+
+FETCH_DONE = 'fetchDone'    # put in the result queue after the last job has been fetched
+
+
+def initProcessWorker(initializer, initargs):
+    """
+    Initialize a process of the pool; Ctrl-C is handled by the main process only, which stops the pool
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def callProcessFunction(processFunction, job, response):
+    """
+    Call the process function of a job; the exception is returned, because the pool of python 2 has no error callback
+    :return: tuple (job, result, error, processing time in seconds)
+    """
+
+    startTime = time.time()
+    try:
+        return job, processFunction(job, response), None, time.time() - startTime
+    except Exception as err:
+        return job, None, err, time.time() - startTime
+
+
+class IngestPipeline(object):
+    """
+    Fetches the jobs with a DDLFetcher and processes the responses with a pool of processes
+    """
+
+    def __init__(self, fetcher, processFunction, nrProcesses=None, maxPending=None, initializer=None, initargs=(),
+                 logger=None):
+        """
+        :param fetcher: the DDLFetcher
+        :param processFunction: function(job, response) that processes a fetched response in a process of the pool;
+        it must be a module level function, and the job, response and result must be picklable
+        :param nrProcesses: number of processes of the pool; default is the number of cores; 0 processes the responses in
+        the fetch thread
+        :param maxPending: max number of fetched responses that are being processed or waiting to be written; default
+        is twice the number of processes
+        :param initializer, initargs: initializer(*initargs) is called in each process of the pool, e.g. to set up data
+        that is used to process all responses
+        :param logger: logger; optional
+        """
+
+        if nrProcesses is None:
+            nrProcesses = multiprocessing.cpu_count()
+
+        self.fetcher = fetcher
+        self.processFunction = processFunction
+        self.nrProcesses = nrProcesses
+        self.maxPending = maxPending or max(2, 2 * nrProcesses)
+        self.initializer = initializer
+        self.initargs = initargs
+        self.logger = logger
+
+        self.pool = None
+        self.pendingSlots = Queue.Queue(self.maxPending)    # holds an item for each pending response
+        self.resultQueue = Queue.Queue()
+        self.stopped = threading.Event()
+        self.fetchError = None
+
+        self.startTime = None
+        self.statsLock = threading.Lock()
+        self.nrFetched = 0
+        self.nrFetchErrors = 0
+        self.nrProcessed = 0
+        self.nrProcessErrors = 0
+        self.processTime = 0.0
+        self.nrConsumed = 0
+
+    def run(self, jobs, handleResponse=None):
+        """
+        Run the fetch and process stages, and yield the processed results in the order in which they are finished
+        :param jobs: iterable of (job, data) tuples for DDLFetcher.fetchAll
+        :param handleResponse: function(job, response) that reads the streamed response in the fetch thread (see
+        DDLFetcher.fetchAll); its return value is passed to the process function
+        :return: generator of (job, result, error) tuples; error is the exception of the fetch or process stage, else None
+        """
+
+        self.startTime = time.time()
+
+        if self.nrProcesses > 0:
+            self.pool = multiprocessing.Pool(self.nrProcesses, initProcessWorker, (self.initializer, self.initargs))
+        elif self.initializer is not None:
+            self.initializer(*self.initargs)
+
+        fetchThread = threading.Thread(target=self.fetchStage, args=(jobs, handleResponse))
+        fetchThread.daemon = True
+        fetchThread.start()
+
+        nrSubmitted = None  # known when all jobs have been fetched
+
+        try:
+            while nrSubmitted is None or self.nrConsumed < nrSubmitted:
+                item = getFromQueue(self.resultQueue)
+
+                if item[0] == FETCH_DONE:
+                    nrSubmitted = item[1]
+                    if self.fetchError is not None:
+                        raise self.fetchError
+                    continue
+
+                job, result, error, processTime = item
+                with self.statsLock:
+                    self.nrConsumed += 1
+                    if processTime is not None:
+                        self.nrProcessed += 1
+                        self.processTime += processTime
+                        if error is not None:
+                            self.nrProcessErrors += 1
+                self.pendingSlots.get()
+
+                yield job, result, error
+        finally:
+            self.stop()
+
+    def fetchStage(self, jobs, handleResponse):
+        """
+        Fetch the jobs and submit the responses to the process stage; runs in its own thread
+        """
+
+        nrSubmitted = 0
+        fetched = self.fetcher.fetchAll(jobs, handleResponse)
+
+        try:
+            for job, response, error in fetched:
+                # wait for a free slot; this is the backpressure on the fetcher
+                while not self.stopped.is_set():
+                    try:
+                        self.pendingSlots.put(None, True, 1)
+                        break
+                    except Queue.Full:
+                        pass
+
+                if self.stopped.is_set():
+                    break
+
+                nrSubmitted += 1
+                with self.statsLock:
+                    self.nrFetched += 1
+                    if error is not None:
+                        self.nrFetchErrors += 1
+
+                if error is not None:
+                    self.resultQueue.put((job, None, error, None))
+                elif self.pool is not None:
+                    self.pool.apply_async(callProcessFunction, (self.processFunction, job, response),
+                                          callback=self.resultQueue.put)
+                else:
+                    self.resultQueue.put(callProcessFunction(self.processFunction, job, response))
+        except Exception as err:
+            self.fetchError = err
+            if self.logger is not None:
+                self.logger.error("Error in fetch stage: " + str(err))
+        finally:
+            fetched.close()     # stops the fetch workers
+            self.resultQueue.put((FETCH_DONE, nrSubmitted))
+
+    def stop(self):
+        """
+        Stop fetching and processing; the responses that are being processed are discarded. Can be called more than once
+        """
+
+        self.stopped.set()
+
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def getStats(self):
+        """
+        :return: dict with the number of responses and the throughput (per second) of each stage, the mean processing
+        time of a response and the queue depths: the number of responses waiting for or in the process stage and the
+        number of results waiting for the write stage
+        """
+
+        with self.statsLock:
+            elapsedTime = max(time.time() - (self.startTime or time.time()), 1e-6)
+            nrWaitingForWrite = self.resultQueue.qsize()
+
+            return {'nrFetched': self.nrFetched,
+                    'nrFetchErrors': self.nrFetchErrors,
+                    'fetchedPerSecond': self.nrFetched / elapsedTime,
+                    'nrProcessed': self.nrProcessed,
+                    'nrProcessErrors': self.nrProcessErrors,
+                    'processedPerSecond': self.nrProcessed / elapsedTime,
+                    'meanProcessTime': self.processTime / self.nrProcessed if self.nrProcessed else 0,
+                    'nrConsumed': self.nrConsumed,
+                    'consumedPerSecond': self.nrConsumed / elapsedTime,
+                    'processQueueDepth': max(0, self.pendingSlots.qsize() - nrWaitingForWrite),
+                    'writeQueueDepth': nrWaitingForWrite}
@@ -0,0 +1,297 @@
+'''
+Metrics
+Counters, gauges and histograms in the Prometheus text exposition format (version 0.0.4), for the /metrics route of the
+data aansluitpunt and the ingest statistics of the Compute_3YearAvg_DDL script.
+
+registry = MetricsRegistry()
+requestCounter = registry.counter('ei_http_requests_total', 'Number of HTTP requests', ['route'])
+requestCounter.inc(route='/avg')
+registry.exposition()   # the text for Prometheus
+
+A gauge can be given a function, which is called when the metrics are exposed, e.g. for the age of a catalogue or the
+depth of a queue. A script without an HTTP server writes the metrics to a file for the textfile collector of the
+node_exporter, or pushes them to a Prometheus Pushgateway (MetricsExporter).
+'''
+
+import math
+import os
+import threading
+import requests
+
+
+# default buckets of the duration histograms, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def escapeLabelValue(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def formatLabels(labelNames, labelValues, extra=None):
+    """
+    :return: the labels of a sample, e.g. {route="/avg",status="200"}; an empty string without labels
+    """
+
+    pairs = zip(labelNames, labelValues) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, escapeLabelValue(value)) for name, value in pairs) + '}'
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+        return repr(value)
+    return str(value)
+
+
+class Metric(object):
+    """
+    Base class of the metrics: a value (or histogram) for each combination of label values
+    """
+
+    metricType = None
+
+    def __init__(self, name, helpText, labelNames=()):
+        self.name = name
+        self.helpText = helpText
+        self.labelNames = tuple(labelNames)
+        self.values = {}    # tuple of label values -> value
+        self.lock = threading.Lock()
+
+    def getLabelValues(self, labels):
+        if len(labels) != len(self.labelNames):
+            raise ValueError("Metric %s has labels %s" % (self.name, ', '.join(self.labelNames)))
+        return tuple(labels[name] for name in self.labelNames)
+
+    def getSamples(self):
+        """
+        :return: list of (name suffix, label values, extra labels, value) tuples
+        """
+
+        with self.lock:
+            return [('', labelValues, None, value) for labelValues, value in sorted(self.values.items())]
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.helpText.replace('\\', '\\\\').replace('\n', '\\n')),
+                 '# TYPE %s %s' % (self.name, self.metricType)]
+        for suffix, labelValues, extra, value in self.getSamples():
+            lines.append(self.name + suffix + formatLabels(self.labelNames, labelValues, extra) + ' ' +
+                         formatValue(value))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Value that only increases, e.g. the number of requests
+    """
+
+    metricType = 'counter'
+
+    def inc(self, amount=1, **labels):
+        labelValues = self.getLabelValues(labels)
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down, e.g. a queue depth; with a function, the value is read when the metrics are exposed
+    """
+
+    metricType = 'gauge'
+
+    def __init__(self, name, helpText, labelNames=(), function=None, metricType=None, logger=None):
+        """
+        :param function: optional function without arguments that returns the value, or for a gauge with labels a
+        dict with tuples of label values as keys; a value None is left out
+        :param metricType: 'counter' for a function that returns a counter kept elsewhere (e.g. the retries of the
+        DDLFetcher); default 'gauge'
+        :param logger: logger for the errors of the function; optional, the errors are printed without it
+        """
+
+        Metric.__init__(self, name, helpText, labelNames)
+        self.function = function
+        self.logger = logger
+        if metricType is not None:
+            self.metricType = metricType
+
+    def set(self, value, **labels):
+        labelValues = self.getLabelValues(labels)
+        with self.lock:
+            self.values[labelValues] = value
+
+    def getSamples(self):
+        if self.function is None:
+            return Metric.getSamples(self)
+
+        try:
+            value = self.function()
+        except Exception as err:    # e.g. MongoDB is not reachable; the metric is left out
+            message = "Error in reading the metric " + self.name + ": " + repr(err)
+            if self.logger is not None:
+                self.logger.error(message)
+            else:
+                print message
+            return []
+
+        if isinstance(value, dict):
+            return [('', labelValues, None, labelValue) for labelValues, labelValue in sorted(value.items())
+                    if labelValue is not None]
+        return [('', (), None, value)] if value is not None else []
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (e.g. durations) in cumulative buckets, with their sum and count
+    """
+
+    metricType = 'histogram'
+
+    def __init__(self, name, helpText, labelNames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, helpText, labelNames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        labelValues = self.getLabelValues(labels)
+        with self.lock:
+            counts = self.values.get(labelValues)
+            if counts is None:
+                counts = self.values[labelValues] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts['buckets'][i] += 1
+                    break
+            counts['sum'] += value
+            counts['count'] += 1
+
+    def getSamples(self):
+        samples = []
+        with self.lock:
+            for labelValues, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts['buckets']):
+                    cumulative += count
+                    samples.append(('_bucket', labelValues, [('le', formatValue(float(bound)))], cumulative))
+                samples.append(('_bucket', labelValues, [('le', '+Inf')], counts['count']))
+                samples.append(('_sum', labelValues, None, counts['sum']))
+                samples.append(('_count', labelValues, None, counts['count']))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    The metrics of a process, exposed together
+    """
+
+    def __init__(self, logger=None):
+        """
+        :param logger: logger for the errors of the functions of the gauges; optional, the errors are printed without it
+        """
+
+        self.metrics = []
+        self.logger = logger
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if any(registered.name == metric.name for registered in self.metrics):
+                raise ValueError("Metric " + metric.name + " is already registered")
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, helpText, labelNames=()):
+        return self.register(Counter(name, helpText, labelNames))
+
+    def gauge(self, name, helpText, labelNames=(), function=None, metricType=None):
+        return self.register(Gauge(name, helpText, labelNames, function, metricType, self.logger))
+
+    def histogram(self, name, helpText, labelNames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, helpText, labelNames, buckets))
+
+    def exposition(self):
+        """
+        :return: the metrics in the Prometheus text format
+        """
+
+        with self.lock:
+            metrics = list(self.metrics)
+        return '\n'.join(metric.exposition() for metric in metrics) + '\n'
+
+    def writeTextfile(self, fileName):
+        """
+        Write the metrics to a file for the textfile collector of the node_exporter; the file is written under a
+        temporary name and renamed, so the collector never reads a partial file
+        """
+
+        tmpFileName = fileName + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpFileName, 'w') as fo:
+            fo.write(self.exposition().encode('utf-8'))
+        if os.name == 'nt' and os.path.exists(fileName):    # on Windows, rename does not replace an existing file
+            os.remove(fileName)
+        os.rename(tmpFileName, fileName)
+
+    def push(self, gatewayUrl, job, timeout=10):
+        """
+        Replace the metrics of the job in a Prometheus Pushgateway
+        """
+
+        r = requests.put(gatewayUrl.rstrip('/') + '/metrics/job/' + job, data=self.exposition().encode('utf-8'),
+                         headers={'Content-Type': 'text/plain; version=0.0.4'}, timeout=timeout)
+        r.raise_for_status()
+
+
+class MetricsExporter(object):
+    """
+    Writes the metrics to a textfile and / or pushes them to a Pushgateway every interval seconds, and once more when
+    it is stopped
+    """
+
+    def __init__(self, registry, textFile=None, pushUrl=None, job='ei_ingest', interval=15, logger=None):
+        """
+        :param textFile: file for the textfile collector of the node_exporter; optional
+        :param pushUrl: url of the Pushgateway; optional
+        :param job: the job label of the pushed metrics
+        :param logger: logger for export errors; optional
+        """
+
+        self.registry = registry
+        self.textFile = textFile
+        self.pushUrl = pushUrl
+        self.job = job
+        self.interval = interval
+        self.logger = logger
+
+        self.stopped = threading.Event()
+        self.thread = None
+        if textFile or pushUrl:
+            self.thread = threading.Thread(target=self.exportPeriodically)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def export(self):
+        try:
+            if self.textFile:
+                self.registry.writeTextfile(self.textFile)
+            if self.pushUrl:
+                self.registry.push(self.pushUrl, self.job)
+        except Exception as err:    # the metrics must not stop the script
+            if self.logger is not None:
+                self.logger.error("Error in exporting the metrics: " + str(err))
+
+    def exportPeriodically(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        """
+        Stop the periodic export and export the final values; can be called more than once
+        """
+
+        if self.thread is not None and not self.stopped.is_set():
+            self.stopped.set()
+            self.thread.join()
+            self.export()
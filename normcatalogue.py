@@ -0,0 +1,279 @@
+'''
+NormCatalogue
+Indexed, in-memory view of the RIVM normendatabase (https://rvs.rivm.nl/zoeksysteem/Data/SubtanceNormValues).
+
+The RIVM database is a JSON document with a list of 'substances' (each with a list of norm ids and values) and a list
+of 'norms' (the description of each norm id). Looking up the norms of a substance by scanning both lists is slow, so
+the catalogue builds dictionaries once when the data is loaded and pre-assembles the response per substance.
+
+A catalogue can be stored as a snapshot (a pickle of the catalogue), which is much faster to load at startup than
+downloading and parsing the RIVM database; a new version is downloaded with a conditional GET, so the RIVM database is
+only transferred when it has changed.
+'''
+
+import os
+import json
+import gzip
+import hashlib
+import cPickle
+from datetime import datetime
+from email.utils import parsedate_tz, mktime_tz
+from io import BytesIO
+import requests
+
+try:
+    import brotli   # optional; if not installed the full catalogue is only available uncompressed and gzipped
+except ImportError:
+    brotli = None
+
+
+# fields of a RIVM norm that are returned by the data aansluitpunt for each norm of a substance
+NORM_INFO_FIELDS = ['id', 'description', 'compartmentName', 'categoryDescription', 'normCode', 'normDescription',
+                    'normSubgroupCode', 'normSubgroupDescription', 'compartmentCode', 'compartmentDescription',
+                    'compartmentSubgroupCode', 'compartmentSubgroupDescription', 'quantityCode', 'quantityDescription',
+                    'stateCode', 'stateDescription', 'valueProcessingMethodCode', 'valueProcessingMethodDescription']
+
+# fields of a RIVM substance that are returned by the data aansluitpunt
+SUBSTANCE_INFO_FIELDS = ['aquoCode', 'name', 'englishName', 'casNumber', 'hasZzsEntry']
+
+# fields of a RIVM norm that are stored by the Compute_3YearAvg_DDL script with each time series
+NORM_RESOLUTION_FIELDS = ['valueProcessingMethodCode', 'valueProcessingMethodDescription', 'id', 'stateCode',
+                          'stateDescription', 'normDescription']
+
+# value processing methods for which an average is computed, in order of priority
+VALUE_PROCESSING_METHODS = ['JGM', 'MAX', 'P90']
+
+# increase when the attributes of NormCatalogue change, so old snapshots are not used anymore
+SNAPSHOT_VERSION = 1
+
+
+class NormCatalogue(object):
+    """
+    Lookup tables for the RIVM norm database. A catalogue is built once and never modified afterwards, so it can be
+    shared between threads; a refresh creates a new catalogue.
+    """
+
+    def __init__(self, RIVMDict, lastModified=None, sourceETag=None, sourceLastModified=None):
+        """
+        :param RIVMDict: the RIVM norm database as a python dict, with the keys 'norms' and 'substances'
+        :param lastModified: datetime (UTC) of the last change of the RIVM data; default is the current time
+        :param sourceETag: the ETag header of the RIVM download, used for the next conditional GET
+        :param sourceLastModified: the Last-Modified header of the RIVM download, used for the next conditional GET
+        """
+
+        self.sourceETag = sourceETag
+        self.sourceLastModified = sourceLastModified
+
+        self.RIVMDict = RIVMDict
+        self.normsList = RIVMDict['norms']
+        self.substancesList = RIVMDict['substances']
+
+        # norm id -> projected norm info; if an id occurs more than once, the last one is used
+        self.normInfoByID = {}
+        for norm in self.normsList:
+            self.normInfoByID[norm['id']] = dict((field, norm[field]) for field in NORM_INFO_FIELDS)
+
+        # aquoCode -> list of substances; the RIVM database may contain more than one substance with the same aquoCode
+        self.substancesByAquoCode = {}
+        for substance in self.substancesList:
+            self.substancesByAquoCode.setdefault(substance['aquoCode'], []).append(substance)
+
+        # aquoCode -> JSON string with the substance info and all its norms, as returned by the /norms endpoint
+        self.normsResponseByAquoCode = {}
+        for aquoCode in self.substancesByAquoCode:
+            self.normsResponseByAquoCode[aquoCode] = json.dumps(self.getSubstanceInfo(aquoCode))
+
+        self.emptyNormsResponse = json.dumps({'norms': []})
+
+        #region serialize the full catalogue once, as returned by the /norms endpoint without query string
+        self.lastModified = lastModified or datetime.utcnow().replace(microsecond=0)
+        self.fullResponse = {'identity': json.dumps(RIVMDict)}
+        self.fullResponse['gzip'] = gzipBytes(self.fullResponse['identity'])
+        if brotli is not None:
+            self.fullResponse['br'] = brotli.compress(self.fullResponse['identity'])
+
+        # the content hash of the serialized catalogue is used as ETag
+        self.etag = hashlib.sha1(self.fullResponse['identity']).hexdigest()
+        #endregion
+
+    def getSubstanceInfo(self, aquoCode):
+        """
+        Assemble the substance info and the info of all norms of a substance
+        :param aquoCode: the aquo code of the substance
+        :return: dict with the substance info and a list 'norms' with the value and info of each norm
+        """
+
+        allInfo = {}
+        normsForSubstance = []
+
+        for substance in self.substancesByAquoCode.get(aquoCode, []):
+
+            # store info of this substance; if there are multiple substances, the info of the last one is used
+            for field in SUBSTANCE_INFO_FIELDS:
+                allInfo[field] = substance[field]
+
+            for norm in substance['norms']:
+                normData = {}
+                normData['value'] = norm['value']
+                normData['info'] = self.normInfoByID.get(norm['id'], {})
+                normsForSubstance.append(normData)
+
+        allInfo['norms'] = normsForSubstance
+
+        return allInfo
+
+    def getNormsResponse(self, aquoCode):
+        """
+        :param aquoCode: the aquo code of the substance
+        :return: the pre-assembled JSON string with all norms of the substance
+        """
+
+        return self.normsResponseByAquoCode.get(aquoCode, self.emptyNormsResponse)
+
+
+def gzipBytes(data):
+    """
+    :param data: the bytes to compress
+    :return: the gzip compressed bytes; the gzip header does not contain a timestamp so equal data gives equal output
+    """
+
+    buf = BytesIO()
+    gzipFile = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    gzipFile.write(data)
+    gzipFile.close()
+
+    return buf.getvalue()
+
+
+def downloadCatalogue(url, currentCatalogue=None, timeout=300):
+    """
+    Download the RIVM norm database and build a new catalogue. If the current catalogue was downloaded before, the
+    request is conditional (If-None-Match / If-Modified-Since), so the server does not send an unchanged database.
+    :param url: the url of the RIVM norm database
+    :param currentCatalogue: the NormCatalogue that is in use, or None
+    :param timeout: timeout of the request in seconds
+    :return: the new NormCatalogue, or None if the RIVM norm database has not changed
+    """
+
+    headers = {}
+    if currentCatalogue is not None:
+        if currentCatalogue.sourceETag:
+            headers['If-None-Match'] = currentCatalogue.sourceETag
+        if currentCatalogue.sourceLastModified:
+            headers['If-Modified-Since'] = currentCatalogue.sourceLastModified
+
+    r = requests.get(url, headers=headers, timeout=timeout)
+
+    if r.status_code == 304:
+        return None
+    r.raise_for_status()
+
+    RIVMDict = json.loads(r.content)    # convert json string to python dict
+
+    lastModified = None
+    if r.headers.get('Last-Modified'):
+        parsedDate = parsedate_tz(r.headers['Last-Modified'])
+        if parsedDate is not None:
+            lastModified = datetime.utcfromtimestamp(mktime_tz(parsedDate))
+
+    return NormCatalogue(RIVMDict, lastModified, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+
+
+def saveSnapshot(catalogue, snapshotFile, jsonFile=None):
+    """
+    Store the catalogue as a snapshot, and optionally the RIVM norm database as JSON file. The files are written to a
+    temporary file first, so a crash while writing never leaves a partial snapshot.
+    """
+
+    writeFileAtomic(snapshotFile, cPickle.dumps((SNAPSHOT_VERSION, catalogue), cPickle.HIGHEST_PROTOCOL))
+    if jsonFile is not None:
+        writeFileAtomic(jsonFile, catalogue.fullResponse['identity'])
+
+
+def loadSnapshot(snapshotFile, jsonFile=None):
+    """
+    Load a catalogue from a snapshot. If there is no (valid) snapshot, the catalogue is built from the RIVM norm
+    database JSON file, if given.
+    :return: the NormCatalogue, or None if neither file could be loaded
+    """
+
+    try:
+        with open(snapshotFile, 'rb') as fi:
+            version, catalogue = cPickle.load(fi)
+        if version == SNAPSHOT_VERSION:
+            return catalogue
+    except Exception:
+        pass
+
+    if jsonFile is None:
+        return None
+
+    try:
+        with open(jsonFile) as RIVMDataFile:
+            RIVMDict = json.load(RIVMDataFile)
+        return NormCatalogue(RIVMDict, datetime.utcfromtimestamp(int(os.path.getmtime(jsonFile))))
+    except Exception:
+        return None
+
+
+def writeFileAtomic(fileName, data):
+    """
+    Write data to a temporary file and replace fileName by it
+    """
+
+    tmpFileName = fileName + '.tmp'
+    with open(tmpFileName, 'wb') as fo:
+        fo.write(data)
+
+    if os.name == 'nt' and os.path.exists(fileName):     # on Windows, rename does not replace an existing file
+        os.remove(fileName)
+    os.rename(tmpFileName, fileName)
+
+
+def buildNormResolutionTable(RIVMDict):
+    """
+    Resolve, in one pass over the RIVM norm database, the norms and the value processing method (JGM, MAX, P90 or Other)
+    of each combination of a substance and a state (hoedanigheid)
+    :param RIVMDict: the RIVM norm database as a python dict, with the keys 'norms' and 'substances'
+    :return: dict (aquoCode, stateCode) -> (valueProcessingMethodCode, list of the norms of the substance with the
+    stateCode); use resolveNorms for the lookup
+    """
+
+    # norm id -> info of all norms with the id
+    normInfoByID = {}
+    for norm in RIVMDict['norms']:
+        normInfoByID.setdefault(norm['id'], []).append(dict((field, norm[field]) for field in NORM_RESOLUTION_FIELDS))
+
+    # (aquoCode, stateCode) -> norms of the substance with the stateCode, in the order of the RIVM database
+    normsByAquoCodeAndState = {}
+    for substance in RIVMDict['substances']:
+        for norm in substance['norms']:
+            for normInfo in normInfoByID.get(norm['id'], []):
+                normsByAquoCodeAndState.setdefault((substance['aquoCode'], normInfo['stateCode']), []).append(normInfo)
+
+    normResolutionTable = {}
+    for key, normsForSubstanceStateCodeList in normsByAquoCodeAndState.items():
+        valueProcessingMethodCodeList = [normInfo['valueProcessingMethodCode'] for normInfo in normsForSubstanceStateCodeList]
+
+        valueProcessingMethodCode = "Other"
+        for method in VALUE_PROCESSING_METHODS:
+            if method in valueProcessingMethodCodeList:
+                valueProcessingMethodCode = method
+                break
+
+        normResolutionTable[key] = (valueProcessingMethodCode, normsForSubstanceStateCodeList)
+
+    return normResolutionTable
+
+
+def resolveNorms(normResolutionTable, aquoCode, stateCode):
+    """
+    :param normResolutionTable: the table made by buildNormResolutionTable
+    :param aquoCode: the aquo code of the substance (the parCode of the DDL)
+    :param stateCode: the state of the substance (the hoedanigheidCode of the DDL)
+    :return: tuple with the value processing method code and a new list with the norms of the substance with the state
+    """
+
+    valueProcessingMethodCode, normsForSubstanceStateCodeList = normResolutionTable.get((aquoCode, stateCode), ("Other", []))
+
+    return valueProcessingMethodCode, list(normsForSubstanceStateCodeList)
@@ -0,0 +1,169 @@
+'''
+Profiling
+Opt-in profiles (cProfile) of single requests of the data aansluitpunt and of a sample of the time series of the
+Compute_3YearAvg_DDL script, to see where the time of a slow request or series goes.
+
+Each profile is stored in a bounded on-disk ring (ProfileStore): the pstats file of the profile (<name>.prof, to be
+read with pstats or a viewer such as snakeviz) and a JSON file with its description (<name>.json), e.g. the route and
+the time spent waiting for MongoDB and in json.dumps. When the ring is full, the oldest profiles are removed. The names
+start with the UTC time, so they sort from old to new; the store can be shared by processes.
+
+store = ProfileStore('profiles', maxProfiles=100)
+result = profileCall(store, {'stage': 'process'}, function, arg)
+store.list()                    # the descriptions of the profiles, newest first
+store.getText(name)             # the functions with the highest cumulative time
+'''
+
+import cProfile
+import hashlib
+import itertools
+import json
+import os
+import pstats
+import re
+import threading
+import time
+from datetime import datetime
+from StringIO import StringIO
+
+
+PROFILE_NAME_PATTERN = re.compile(r'^\d{8}T\d{12}_\d+_\d+$')
+
+
+def isSampled(key, sampleRate):
+    """
+    :return: True if the item with the key is in the sample; the same key is in the sample in each process (unlike a
+    random sample), so e.g. a time series is profiled both in the parse process and in the main process
+    """
+
+    return int(hashlib.md5(key).hexdigest()[:8], 16) < sampleRate * 0x100000000
+
+
+class ProfileStore(object):
+    """
+    Directory with at most maxProfiles profiles
+    """
+
+    def __init__(self, directory, maxProfiles=100):
+        """
+        :param directory: the directory of the profiles; created if it does not exist
+        :param maxProfiles: max number of profiles; the oldest profiles are removed
+        """
+
+        self.directory = directory
+        self.maxProfiles = maxProfiles
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:     # created by another process
+                if not os.path.isdir(directory):
+                    raise
+
+    def newName(self):
+        """
+        :return: a new, unique name for a profile
+        """
+
+        with self.lock:
+            number = next(self.counter)
+        return datetime.utcnow().strftime('%Y%m%dT%H%M%S%f') + '_' + str(os.getpid()) + '_' + str(number)
+
+    def getFileName(self, name, extension='.prof'):
+        """
+        :return: the name of the file of a profile, or None if the name is not valid or the profile does not exist
+        (anymore)
+        """
+
+        if not PROFILE_NAME_PATTERN.match(name):
+            return None
+        fileName = os.path.join(self.directory, name + extension)
+        return fileName if os.path.exists(fileName) else None
+
+    def save(self, profile, info, name=None):
+        """
+        Store a profile with its description, and remove the oldest profiles if the ring is full
+        :param profile: the (disabled) cProfile.Profile
+        :param info: dict with the description of the profile; the name and time are added
+        :param name: the name of the profile, from newName; optional
+        :return: the name of the profile
+        """
+
+        name = name or self.newName()
+        info = dict(info, name=name, time=datetime.utcnow().isoformat() + 'Z')
+
+        # the files are written under a temporary name and renamed, so a listing never sees a partial profile
+        fileName = os.path.join(self.directory, name)
+        profile.dump_stats(fileName + '.prof.tmp')
+        with open(fileName + '.json.tmp', 'w') as fo:
+            json.dump(info, fo)
+        os.rename(fileName + '.prof.tmp', fileName + '.prof')
+        os.rename(fileName + '.json.tmp', fileName + '.json')
+
+        self.prune()
+        return name
+
+    def getNames(self):
+        """
+        :return: the names of the stored profiles, from old to new
+        """
+
+        return sorted(fileName[:-len('.json')] for fileName in os.listdir(self.directory)
+                      if fileName.endswith('.json') and PROFILE_NAME_PATTERN.match(fileName[:-len('.json')]))
+
+    def prune(self):
+        for name in self.getNames()[:-self.maxProfiles]:
+            for extension in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.directory, name + extension))
+                except OSError:     # removed by another process
+                    pass
+
+    def list(self):
+        """
+        :return: list with the descriptions of the stored profiles, newest first
+        """
+
+        infos = []
+        for name in reversed(self.getNames()):
+            try:
+                with open(os.path.join(self.directory, name + '.json')) as fi:
+                    infos.append(json.load(fi))
+            except (IOError, ValueError):   # removed while listing
+                pass
+        return infos
+
+    def getText(self, name, sortKey='cumulative', nrFunctions=50):
+        """
+        :return: the nrFunctions functions of a profile with the highest time (sortKey as in pstats, e.g. 'cumulative'
+        or 'tottime') and their callers, as text; None if the profile does not exist
+        """
+
+        fileName = self.getFileName(name)
+        if fileName is None:
+            return None
+
+        stream = StringIO()
+        stats = pstats.Stats(fileName, stream=stream)
+        stats.sort_stats(sortKey).print_stats(nrFunctions)
+        stats.print_callers(nrFunctions)
+        return stream.getvalue()
+
+
+def profileCall(store, info, function, *args, **kwargs):
+    """
+    Call a function with the profiler enabled, and store the profile with the description info and the duration of
+    the call (also if the function raises an exception)
+    :return: the result of the function
+    """
+
+    profile = cProfile.Profile()
+    startTime = time.time()
+    profile.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profile.disable()
+        store.save(profile, dict(info, seconds=time.time() - startTime))
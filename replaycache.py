@@ -0,0 +1,240 @@
+'''
+ReplayCache
+Compressed on-disk cache of the responses of the DDL and the RIVM normendatabase, for reruns and benchmarks.
+
+Each response is stored gzip compressed under the SHA-1 hash of the request: the url and the (canonical) JSON body,
+which for the OnlineWaarnemingenService holds the parameter, the location and the period. A rerun of the
+Compute_3YearAvg_DDL script, e.g. after a change of the averaging, can then read the responses from disk instead of
+downloading them again, and a filled cache is a fixed set of responses for performance tests.
+
+Modes:
+- off: the cache is not used
+- first: responses are read from the cache; missing responses are downloaded and added to the cache
+- only: responses are only read from the cache; a missing response is an error (CacheMissError)
+'''
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import requests
+
+
+CACHE_OFF = 'off'
+CACHE_FIRST = 'first'
+CACHE_ONLY = 'only'
+
+
+class CacheMissError(Exception):
+    """
+    The response of a request is not in the cache, and the cache is in mode 'only'
+    """
+    pass
+
+
+class ReplayCache(object):
+    """
+    Directory with gzip compressed responses, addressed by the hash of the request
+    """
+
+    def __init__(self, cacheDir, mode=CACHE_FIRST):
+        """
+        :param cacheDir: the cache directory; it is created if it does not exist
+        :param mode: CACHE_OFF, CACHE_FIRST or CACHE_ONLY
+        """
+
+        if mode not in (CACHE_OFF, CACHE_FIRST, CACHE_ONLY):
+            raise ValueError("Unknown replay cache mode: " + str(mode))
+
+        self.cacheDir = cacheDir
+        self.mode = mode
+
+        if mode != CACHE_OFF and not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+
+        self.statsLock = threading.Lock()
+        self.nrHits = 0
+        self.nrMisses = 0
+        self.nrStored = 0
+
+    def getKey(self, url, data=None):
+        """
+        :param url: the url of the request
+        :param data: the JSON body of the request (string); None for a GET request
+        :return: the hash of the request; the JSON body is normalized, so the order of its keys does not matter
+        """
+
+        if data is not None:
+            data = json.dumps(json.loads(data), sort_keys=True, separators=(',', ':'))
+
+        return hashlib.sha1(url + "\n" + (data or "")).hexdigest()
+
+    def getFileName(self, url, data=None):
+        """
+        :return: the name of the cache file of the request; the files are spread over subdirectories
+        """
+
+        key = self.getKey(url, data)
+        return os.path.join(self.cacheDir, key[:2], key + '.json.gz')
+
+    def lookup(self, url, data=None):
+        """
+        Look up a request in the cache, and count the hit or miss
+        :return: the name of the cache file; None if the cache is off or the response is not in the cache
+        :raise CacheMissError: if the response is not in the cache in mode 'only'
+        """
+
+        if self.mode == CACHE_OFF:
+            return None
+
+        fileName = self.getFileName(url, data)
+        hit = os.path.exists(fileName)
+
+        with self.statsLock:
+            if hit:
+                self.nrHits += 1
+            else:
+                self.nrMisses += 1
+
+        if hit:
+            return fileName
+        if self.mode == CACHE_ONLY:
+            raise CacheMissError("Response not in replay cache: " + url + " " + (data or ""))
+
+        return None
+
+    def put(self, url, data, chunks):
+        """
+        Store a response in the cache; the file is written under a temporary name and renamed when it is complete
+        :param url, data: the request
+        :param chunks: iterable of the (byte string) chunks of the response body, e.g. Response.iter_content()
+        :return: tuple (name of the cache file, size of the uncompressed response)
+        """
+
+        fileName = self.getFileName(url, data)
+        if not os.path.exists(os.path.dirname(fileName)):
+            try:
+                os.makedirs(os.path.dirname(fileName))
+            except OSError:     # created by another thread
+                pass
+
+        # unique temporary file per thread, so concurrent downloads of the same request do not collide
+        tmpFileName = "%s.%d.%d.tmp" % (fileName, os.getpid(), threading.current_thread().ident)
+        nrBytes = 0
+        fo = gzip.open(tmpFileName, 'wb', 6)    # level 6 compresses almost as well as 9, and faster
+        try:
+            for chunk in chunks:
+                fo.write(chunk)
+                nrBytes += len(chunk)
+        except:
+            fo.close()
+            os.remove(tmpFileName)
+            raise
+        fo.close()
+
+        if os.name == 'nt' and os.path.exists(fileName):     # on Windows, rename does not replace an existing file
+            os.remove(fileName)
+        os.rename(tmpFileName, fileName)
+
+        with self.statsLock:
+            self.nrStored += 1
+
+        return fileName, nrBytes
+
+    def getStats(self):
+        """
+        :return: dict with the number of cache hits, misses and stored responses
+        """
+
+        with self.statsLock:
+            return {'nrHits': self.nrHits, 'nrMisses': self.nrMisses, 'nrStored': self.nrStored}
+
+
+def openCacheFile(fileName):
+    """
+    Open a file of the cache for reading the (uncompressed) response
+    """
+
+    return gzip.open(fileName, 'rb')
+
+
+def cachedRequest(cache, url, data=None, headers=None, timeout=600):
+    """
+    Do a request through the cache: a POST request with the data as body, or a GET request if data is None
+    :param cache: the ReplayCache; None to always do the request
+    :return: the body of the response as string
+    """
+
+    fileName = cache.lookup(url, data) if cache is not None else None
+    if fileName is not None:
+        fi = openCacheFile(fileName)
+        try:
+            return fi.read()
+        finally:
+            fi.close()
+
+    if data is None:
+        r = requests.get(url, headers=headers, timeout=timeout)
+    else:
+        r = requests.post(url, data=data, headers=headers, timeout=timeout)
+    r.raise_for_status()
+
+    if cache is not None and cache.mode != CACHE_OFF:
+        cache.put(url, data, [r.content])
+
+    return r.content
+
+
+class CachedFetcher(object):
+    """
+    Wrapper of a DDLFetcher that takes the responses from a ReplayCache; only the requests that are not in the cache are
+    sent to the DDL. The caller stores the fetched responses in the cache with ReplayCache.put.
+    """
+
+    def __init__(self, fetcher, cache, handleCached):
+        """
+        :param fetcher: the DDLFetcher
+        :param cache: the ReplayCache
+        :param handleCached: function(job, name of the cache file) that is called for a job whose response is in the
+        cache; its return value is yielded instead of the return value of handleResponse
+        """
+
+        self.fetcher = fetcher
+        self.url = fetcher.url
+        self.cache = cache
+        self.handleCached = handleCached
+
+    def fetchAll(self, jobs, handleResponse=None):
+        """
+        Yield the responses from the cache, then fetch the other jobs; see DDLFetcher.fetchAll
+        """
+
+        notCachedJobs = []
+        for job, data in jobs:
+            try:
+                fileName = self.cache.lookup(self.url, data)
+            except CacheMissError as err:
+                yield job, None, err
+                continue
+
+            if fileName is not None:
+                yield job, self.handleCached(job, fileName), None
+            else:
+                notCachedJobs.append((job, data))
+
+        fetched = self.fetcher.fetchAll(notCachedJobs, handleResponse)
+        try:
+            for item in fetched:
+                yield item
+        finally:
+            fetched.close()
+
+    def getStats(self):
+        """
+        :return: the statistics of the fetcher and of the cache
+        """
+
+        stats = self.fetcher.getStats()
+        stats.update(self.cache.getStats())
+        return stats
@@ -0,0 +1,139 @@
+'''
+ResponseCache
+In-process LRU cache of the JSON responses of the data aansluitpunt.
+
+The data behind the endpoints only changes when the Compute_3YearAvg_DDL script has run. The script increases a data
+version stamp in the metadata collection after each run (see eisummaries.bumpDataVersion); the cache compares the
+stamp at most once per versionCheckInterval seconds and drops all responses when it has changed.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """
+    LRU cache of response strings, bounded by the number of entries and by the total size of the responses
+    """
+
+    def __init__(self, getDataVersion, maxEntries=1000, maxBytes=64 * 1024 * 1024, versionCheckInterval=5):
+        """
+        :param getDataVersion: function without arguments that returns the current data version stamp
+        :param maxEntries: maximum number of cached responses
+        :param maxBytes: maximum total size of the cached responses; larger responses are not cached
+        :param versionCheckInterval: minimum number of seconds between two checks of the data version stamp
+        """
+
+        self.getDataVersion = getDataVersion
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.versionCheckInterval = versionCheckInterval
+
+        self.entries = OrderedDict()    # key -> response; the least recently used entry is first
+        self.nrBytes = 0
+        self.dataVersion = None
+        self.lastVersionCheck = 0
+        self.lock = threading.Lock()    # flask can serve requests in multiple threads
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.versionCheckErrors = 0
+
+    def checkDataVersion(self):
+        """
+        Drop all cached responses if the data version stamp has changed since the last check. If the stamp can not be
+        read (e.g. MongoDB is not reachable), the last known version is kept until the next check.
+        """
+
+        now = time.time()
+        if now - self.lastVersionCheck < self.versionCheckInterval:
+            return
+
+        self.lastVersionCheck = now
+        try:
+            dataVersion = self.getDataVersion()
+        except Exception:
+            with self.lock:
+                self.versionCheckErrors += 1
+            return
+
+        with self.lock:
+            if dataVersion != self.dataVersion:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.nrBytes = 0
+                self.dataVersion = dataVersion
+
+    def get(self, key):
+        """
+        :param key: the cache key of the request
+        :return: the cached response, or None if the response is not in the cache
+        """
+
+        self.checkDataVersion()
+
+        with self.lock:
+            response = self.entries.pop(key, None)
+            if response is None:
+                self.misses += 1
+                return None
+
+            self.entries[key] = response    # move to the end: most recently used
+            self.hits += 1
+            return response
+
+    def getCurrentVersion(self):
+        """
+        :return: the data version stamp of the cached responses; to be read before a response is computed, and given
+        to put
+        """
+
+        with self.lock:
+            return self.dataVersion
+
+    def put(self, key, response, dataVersion):
+        """
+        Add a response to the cache and evict the least recently used responses if the cache is full
+        :param dataVersion: the data version stamp (getCurrentVersion) before the response was computed; the response
+        is not cached if the data has changed since, as it may have been computed from the old data
+        """
+
+        size = len(response)
+        if size > self.maxBytes:
+            return
+
+        with self.lock:
+            if dataVersion != self.dataVersion:
+                return
+
+            if key in self.entries:
+                self.nrBytes -= len(self.entries.pop(key))
+
+            while self.entries and (len(self.entries) >= self.maxEntries or self.nrBytes + size > self.maxBytes):
+                evictedKey, evictedResponse = self.entries.popitem(last=False)
+                self.nrBytes -= len(evictedResponse)
+                self.evictions += 1
+
+            self.entries[key] = response
+            self.nrBytes += size
+
+    def getStats(self):
+        """
+        :return: dict with the hit, miss, eviction and invalidation counters and the size of the cache
+        """
+
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'versionCheckErrors': self.versionCheckErrors,
+                    'entries': len(self.entries),
+                    'bytes': self.nrBytes,
+                    'maxEntries': self.maxEntries,
+                    'maxBytes': self.maxBytes,
+                    'dataVersion': self.dataVersion}